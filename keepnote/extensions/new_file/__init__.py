@@ -243,7 +243,7 @@ class Extension (extension.Extension):
             sibling = nodes[0]
             if sibling.get_parent():
                 parent = sibling.get_parent()
-                index = sibling.get_attr("order") + 1
+                index = sibling.get_position() + 1
             else:
                 parent = sibling
 
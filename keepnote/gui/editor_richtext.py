@@ -529,7 +529,8 @@ class RichTextEditor (KeepNoteEditor):
             results = []
 
             # TODO: clean up icon handling.
-            for nodeid, title in self._notebook.search_node_titles(text)[:self._maxlinks]:
+            for nodeid, title in self._notebook.search_node_titles(
+                    text, limit=self._maxlinks):
                 icon = self._notebook.get_attr_by_id(nodeid, "icon")
                 if icon is None:
                     icon = "note.png"
@@ -91,6 +91,15 @@ _ = keepnote.translate
 DEFAULT_WINDOW_SIZE = (1024, 600)
 DEFAULT_WINDOW_POS = (-1, -1)
 
+# number of ranked search results fetched at a time
+SEARCH_PAGE_SIZE = 50
+
+# search box completion
+COMPLETION_DELAY = 150          # msec of typing pause before a query
+COMPLETION_LIMIT = 10           # number of titles shown
+COMPLETION_FETCH_LIMIT = 200    # number of titles fetched for the cache
+COMPLETION_CACHE_SIZE = 50      # number of cached queries
+
 
 #=============================================================================
 
@@ -912,7 +921,7 @@ class KeepNoteWindow (gtk.Window):
                 notebook.clear_index()
 
             try:
-                for node in notebook.index_all():
+                for node in notebook.index_all(task):
                     # terminate if search is canceled
                     if task.aborted():
                         break
@@ -1576,6 +1585,77 @@ gobject.signal_new("error", KeepNoteWindow, gobject.SIGNAL_RUN_LAST,
 
 
 
+class TitleCompletionCache (object):
+    """
+    Cache of title search results, keyed by query
+
+    A complete result set for a query also answers any longer query that
+    starts with it, since every title containing the longer query contains
+    the shorter one.  Such queries are answered by filtering instead of
+    searching the notebook again.
+    """
+
+    def __init__(self, fetch_limit, size=COMPLETION_CACHE_SIZE):
+        self._fetch_limit = fetch_limit
+        self._size = size
+        self._results = {}  # lowercase query -> (results, complete)
+        self._order = []    # cached queries, oldest first
+        self.version = 0    # incremented when the cache is cleared
+
+
+    def clear(self):
+        self._results.clear()
+        self._order = []
+        self.version += 1
+
+
+    def add(self, query, results):
+        """Add the results of a query fetched with 'fetch_limit'"""
+        key = query.lower()
+        if key not in self._results:
+            self._order.append(key)
+            if len(self._order) > self._size:
+                del self._results[self._order.pop(0)]
+        self._results[key] = (results, len(results) < self._fetch_limit)
+
+
+    def get(self, query):
+        """Returns the results of a query, or None if they are not cached"""
+        key = query.lower()
+        entry = self._results.get(key)
+        if entry:
+            return entry[0]
+
+        # narrow the results of the longest complete prefix
+        for i in range(len(key) - 1, 0, -1):
+            entry = self._results.get(key[:i])
+            if entry and entry[1]:
+                results = rank_titles(
+                    key, [x for x in entry[0] if key in x[1].lower()])
+                self.add(query, results)
+                return results
+
+        return None
+
+
+def rank_titles(query, results):
+    """
+    Order (nodeid, title) results like NodeIndex.search_node_titles():
+    exact matches, prefix matches, other matches, and then alphabetically
+    """
+    query = query.lower()
+    def key(result):
+        title = result[1].lower()
+        if title == query:
+            return (0, result[1])
+        elif title.startswith(query):
+            return (1, result[1])
+        else:
+            return (2, result[1])
+    return sorted(results, key=key)
+
+
+
 class SearchBox (gtk.Entry):
 
     def __init__(self, window):
@@ -1595,7 +1675,13 @@ class SearchBox (gtk.Entry):
         self.search_box_completion.set_model(self.search_box_list)
         self.search_box_completion.set_text_column(0)
         self.set_completion(self.search_box_completion)
-        
+
+        # title queries run in a thread after a pause in typing
+        self._completion_cache = TitleCompletionCache(COMPLETION_FETCH_LIMIT)
+        self._completion_notebook = None
+        self._completion_timer = None
+        self._completion_running = False
+
 
         
 
@@ -1632,25 +1718,20 @@ class SearchBox (gtk.Entry):
                 more = True
 
                 try:
-                    maxstep = 20
-                    for i in range(maxstep):
-                        # check if search is aborted
-                        if task.aborted():
-                            more = False
-                            break
-
-                        # skip if queue is empty
-                        if queue.empty():
-                            break
-                        node = queue.get()
+                    # check if search is aborted
+                    if task.aborted():
+                        more = False
+                    elif not queue.empty():
+                        nodes = queue.get()
 
                         # no more nodes left, finish
-                        if node is None:
+                        if nodes is None:
                             more = False
-                            break
-
-                        # add result to gui
-                        self._window.get_viewer().add_search_result(node)
+                        else:
+                            # add a page of results to gui
+                            viewer = self._window.get_viewer()
+                            for node in nodes:
+                                viewer.add_search_result(node)
                         
                 except Exception as e:
                     self._window.error(_("Unexpected error"), e)
@@ -1666,24 +1747,48 @@ class SearchBox (gtk.Entry):
 
             # init search
             notebook = self._window.get_notebook()
-            try:
-                nodes = (notebook.get_node_by_id(nodeid)
-                         for nodeid in 
-                         notebook.search_node_contents(" ".join(words))
-                         if nodeid)
-            except:
-                keepnote.log_error()
+            text = " ".join(words)
+
+            def iter_ranked():
+                # fetch best matches first, one page at a time
+                offset = 0
+                while True:
+                    results = notebook.search_node_contents_ranked(
+                        text, limit=SEARCH_PAGE_SIZE, offset=offset)
+                    yield [nodeid for nodeid, score, snippet in results]
+                    if len(results) < SEARCH_PAGE_SIZE:
+                        break
+                    offset += len(results)
+
+            def iter_pages():
+                # group unranked matches into pages
+                page = []
+                for nodeid in notebook.search_node_contents(text):
+                    page.append(nodeid)
+                    if len(page) == SEARCH_PAGE_SIZE:
+                        yield page
+                        page = []
+                yield page
 
             
             # do search in thread
             try:
+                if notebook.has_fulltext_search():
+                    pages = iter_ranked()
+                else:
+                    pages = iter_pages()
+
                 lock.acquire()
-                for node in nodes:
+                for nodeids in pages:
                     if task.aborted():
                         break
+                    # resolve a whole page of matches at once
+                    nodes = [node for node in notebook.get_nodes_by_ids(
+                                 nodeid for nodeid in nodeids if nodeid)
+                             if node]
                     lock.release()
-                    if node:
-                        queue.put(node)
+                    if nodes:
+                        queue.put(nodes)
                     lock.acquire()
                 lock.release()
                 queue.put(None)
@@ -1705,9 +1810,15 @@ class SearchBox (gtk.Entry):
             e, t, tr = task.exc_info()
             keepnote.log_error(e, tr)
 
-            
+
         self._window.get_viewer().end_search_result()
 
+        # searches only wait so long for background indexing
+        if not self._window.get_notebook().is_fulltext_current():
+            self._window.set_status(
+                _("Notebook is still being indexed, "
+                  "search results may be incomplete"))
+
 
     def focus_on_search_box(self):
         """Place cursor in search box"""
@@ -1719,17 +1830,108 @@ class SearchBox (gtk.Entry):
         self.search_box_update_completion()
 
     def search_box_update_completion(self):
+        """
+        Update the completion list for the text in the search box
 
-        if not self._window.get_notebook():
+        Cached results are shown at once.  Otherwise, a title query is
+        started once typing pauses for COMPLETION_DELAY msec.
+        """
+
+        notebook = self._window.get_notebook()
+        if not notebook:
             return
+        self._set_completion_notebook(notebook)
+
+        # cancel any query waiting for typing to pause
+        if self._completion_timer is not None:
+            gobject.source_remove(self._completion_timer)
+            self._completion_timer = None
 
         text = unicode_gtk(self.get_text())
-        
+        if len(text) == 0:
+            self._set_completion_results([])
+            return
+
+        results = self._completion_cache.get(text)
+        if results is not None:
+            self._set_completion_results(results)
+        else:
+            self._completion_timer = gobject.timeout_add(
+                COMPLETION_DELAY, self._start_completion_query)
+
+
+    def _set_completion_notebook(self, notebook):
+        """Watch the notebook for title changes, which invalidate the cache"""
+        if notebook is self._completion_notebook:
+            return
+
+        if self._completion_notebook:
+            self._completion_notebook.node_changed.remove(
+                self._on_completion_node_changed)
+        self._completion_cache.clear()
+        self._completion_notebook = notebook
+        notebook.node_changed.add(self._on_completion_node_changed)
+
+
+    def _on_completion_node_changed(self, actions):
+        self._completion_cache.clear()
+
+
+    def _set_completion_results(self, results):
         self.search_box_list.clear()
-        if len(text) > 0:
-            results = self._window.get_notebook().search_node_titles(text)[:10]
-            for nodeid, title in results:
-                self.search_box_list.append([title, nodeid])
+        for nodeid, title in results[:COMPLETION_LIMIT]:
+            self.search_box_list.append([title, nodeid])
+
+
+    def _start_completion_query(self):
+        """Query the titles matching the search box text in a thread"""
+
+        self._completion_timer = None
+
+        # only one query runs at a time, the latest text is queried next
+        if self._completion_running:
+            return False
+        self._completion_running = True
+
+        notebook = self._window.get_notebook()
+        text = unicode_gtk(self.get_text())
+        version = self._completion_cache.version
+
+        def run():
+            try:
+                results = notebook.search_node_titles(
+                    text, limit=COMPLETION_FETCH_LIMIT)
+            except Exception:
+                keepnote.log_error()
+                results = None
+            gobject.idle_add(self._on_completion_query_done,
+                             notebook, text, results, version)
+
+        thread = threading.Thread(target=run)
+        thread.setDaemon(True)
+        thread.start()
+        return False
+
+
+    def _on_completion_query_done(self, notebook, text, results, version):
+        """Show the results of a completion query, unless superseded"""
+
+        self._completion_running = False
+
+        # titles may have changed during the query
+        if (results is not None and notebook is self._completion_notebook and
+            version == self._completion_cache.version):
+            self._completion_cache.add(text, results)
+
+        if notebook is not self._window.get_notebook():
+            return False
+        if text == unicode_gtk(self.get_text()):
+            if results is not None:
+                self._set_completion_results(results)
+        elif self._completion_timer is None:
+            # text changed while querying, and its timer already fired
+            self.search_box_update_completion()
+        return False
 
     def _on_search_box_completion_match(self, completion, model, iter):
 
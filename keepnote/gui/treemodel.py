@@ -383,7 +383,7 @@ class BaseTreeModel (gtk.GenericTreeModel):
         path = []
         node = rowref
         while node not in self._root_set:
-            path.append(node.get_attr("order"))
+            path.append(node.get_position())
             node = node.get_parent()
             if node is None:
                 raise Exception("treeiter is not part of model")
@@ -408,7 +408,7 @@ class BaseTreeModel (gtk.GenericTreeModel):
                 return self._roots[n+1]
         
         children = parent.get_children()
-        order = rowref.get_attr("order")
+        order = rowref.get_position()
         assert 0 <= order < len(children)
         
         if order == len(children) - 1:
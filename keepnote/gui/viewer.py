@@ -122,7 +122,7 @@ class Viewer (gtk.VBox):
             parent = self._notebook
 
         if pos == "sibling" and parent.get_parent() is not None:
-            index = parent.get_attr("order") + 1
+            index = parent.get_position() + 1
             parent = parent.get_parent()
         else:
             index = None
@@ -57,6 +57,7 @@ import keepnote
 from keepnote.notebook.connection.fs import get_valid_unique_filename
 from keepnote.notebook.connection.fs import index as notebook_index
 from keepnote.notebook import sync
+from keepnote.notebook import plaintext
 
 _ = trans.translate
 
@@ -92,6 +93,10 @@ CONTENT_TYPE_UNKNOWN = "application/x-notebook-unknown"
 
 NULL = object()
 
+# spacing of the 'order' attr of siblings, so that a node can be inserted
+# between two siblings without renumbering the others
+ORDER_GAP = 1024
+
 # the node id of the implied root of all nodes everywhere
 UNIVERSAL_ROOT = "b810760f-f246-4e42-aebb-50ce51c3d1ed"
 
@@ -200,32 +205,17 @@ def normalize_notebook_dirname(filename, longpath=None):
 #=============================================================================
 # HTML functions
 
-TAG_PATTERN = re.compile("<[^>]*>")
+TAG_PATTERN = plaintext.TAG_PATTERN
 def strip_tags(line):
     return re.sub(TAG_PATTERN, "", line)
 
 def read_data_as_plain_text(infile):
-    """Read a Note data file as plain text"""
-
-    # TODO: need to handle case when <body> and </body> are on same line
-
-    for line in infile:
-        # skip until body tag
-        if "<body>" in line:
-            pos = line.find("<body>")
-            if pos != -1:
-                yield strip_tags(line[pos+6:])
-                break
-
-    # yield until </body>
-    for line in infile:
-        pos = line.find("</body>")
-        if pos != -1:
-            yield strip_tags(line[:pos])
-            break
+    """
+    Read a Note data file as plain text
 
-        # strip tags
-        yield strip_tags(line)
+    Iterates over the lines of text in the page body.
+    """
+    return plaintext.iter_plain_text(infile)
 
 
 
@@ -396,17 +386,30 @@ _datatype_defaults = {
     "float": 0.0,
     "bool": False}
 
+# column types of indexed attrs
+_datatype_index_types = {
+    "string": "TEXT",
+    "integer": "INTEGER",
+    "float": "FLOAT",
+    "timestamp": "INTEGER",
+    "bool": "INTEGER"}
+
 class AttrDef (object):
     """
     An AttrDef defines the type of an notebook attr
     """
 
-    def __init__(self, key, datatype, name, default=None):
+    def __init__(self, key, datatype, name, default=None,
+                 index=False, index_value=False):
 
         self.key = key
         self.datatype = datatype
         self.name = name
 
+        # index attr in notebook index (optionally with index on its value)
+        self.index = index or index_value
+        self.index_value = index_value
+
         # default value
         if default is None:
             self.default = _datatype_defaults.get(datatype, None)
@@ -419,10 +422,20 @@ class AttrDef (object):
         Returns dict representation
         """
 
-        return {"key": self.key,
-                "datatype": self.datatype,
-                "name": self.name,
-                "default": self.default}
+        dct = {"key": self.key,
+               "datatype": self.datatype,
+               "name": self.name,
+               "default": self.default}
+        if self.index:
+            dct["index"] = True
+        if self.index_value:
+            dct["index_value"] = True
+        return dct
+
+
+    def get_index_type(self):
+        """Returns the SQL type of the attr's index column"""
+        return _datatype_index_types.get(self.datatype, "TEXT")
 
 
 class AttrDefs (object):
@@ -446,6 +459,9 @@ class AttrDefs (object):
     def get(self, key):
         return self._attr_defs.get(key, None)
 
+    def __iter__(self):
+        return iter(self._attr_defs.values())
+
     def parse(self, lst):
         for item in lst:
             self.add(parse_attr_def(item))
@@ -464,7 +480,9 @@ def parse_attr_def(attr_def_dict):
     return AttrDef(attr_def_dict["key"],
                    attr_def_dict["datatype"],
                    attr_def_dict.get("name", attr_def_dict["key"]),
-                   default=attr_def_dict.get("default", None))
+                   default=attr_def_dict.get("default", None),
+                   index=attr_def_dict.get("index", False),
+                   index_value=attr_def_dict.get("index_value", False))
 
 def iter_attr_defs(lst):
     for item in lst:
@@ -475,16 +493,17 @@ def iter_attr_defs(lst):
 
 g_default_attr_defs = [
     AttrDef("nodeid", "string", "Node ID"),
-    AttrDef("content_type", "string", "Content type", default=CONTENT_TYPE_DIR),
-    AttrDef("title", "string", "Title"),
-    AttrDef("order", "integer", "Order", default=sys.maxsize),
+    AttrDef("content_type", "string", "Content type", default=CONTENT_TYPE_DIR,
+            index_value=True),
+    AttrDef("title", "string", "Title", index_value=True),
+    AttrDef("order", "integer", "Order", default=sys.maxsize, index=True),
     AttrDef("created_time", "timestamp", "Created time"),
     AttrDef("modified_time", "timestamp", "Modified time"),
     AttrDef("expanded", "bool", "Expaned", default=True),
     AttrDef("expanded2", "bool", "Expanded2", default=True),
     AttrDef("info_sort", "string", "Folder sort", default="order"),
     AttrDef("info_sort_dir", "integer", "Folder sort direction", default=1),
-    AttrDef("icon", "string", "Icon"),
+    AttrDef("icon", "string", "Icon", index=True),
     AttrDef("icon_open", "string", "Icon open"),
     AttrDef("payload_filename", "string", "Filename"),
     AttrDef("duplicate_of", "string", "Duplicate of"),
@@ -560,9 +579,20 @@ def iter_attr_tables(lst):
 
 BUILTIN_ATTR = ("nodeid", "parentids", "childrenids", "order")
 
+# attrs known for nodes read from the index when loading a notebook
+# (see NoteBook.load()).  Other indexed attrs are read as well, so that
+# list view columns of indexed attrs do not need the node files.
+SKELETON_ATTR = ("nodeid", "parentids", "childrenids", "title",
+                 "content_type", "order", "icon")
+
 class NoteBookNode (object):
     """A general base class for all nodes in a NoteBook"""
 
+    # nodes are numerous, so avoid a per-node __dict__
+    __slots__ = ("_notebook", "_conn", "_parent", "_children", 
+                 "_has_children", "_valid", "_skeleton", "_attr",
+                 "_position")
+
     def __init__(self, title="", parent=None, notebook=None,
                  content_type=CONTENT_TYPE_DIR, conn=None,
                  attr=None):
@@ -572,6 +602,8 @@ class NoteBookNode (object):
         self._children = None
         self._has_children = None
         self._valid = True
+        self._skeleton = None  # original attrs, if only skeleton attrs known
+        self._position = 0  # index in parent's children list
 
         self._attr = {"version": NOTEBOOK_FORMAT_VERSION,
                       "title": title,
@@ -614,6 +646,7 @@ class NoteBookNode (object):
     
     def clear_attr(self, title="", content_type=CONTENT_TYPE_DIR):
         """Clear attributes (set them to defaults)"""
+        self._load_attr()
         for key in list(self._attr.keys()):
             if key not in BUILTIN_ATTR:
                 del self._attr[key]
@@ -625,6 +658,9 @@ class NoteBookNode (object):
     
     def get_attr(self, name, default=None):
         """Get the value of an attribute"""
+        if (self._skeleton is not None and
+            name not in self._notebook._skeleton_attrs):
+            self._load_attr()
         return self._attr.get(name, default)
 
 
@@ -638,6 +674,9 @@ class NoteBookNode (object):
 
     def has_attr(self, name):
         """Returns True if node has the attribute"""
+        if (self._skeleton is not None and
+            name not in self._notebook._skeleton_attrs):
+            self._load_attr()
         return name in self._attr
 
 
@@ -645,6 +684,7 @@ class NoteBookNode (object):
         """Delete an attribute from the node"""
 
         # TODO: check against un-deletable attributes
+        self._load_attr()
         if name in self._attr:
             del self._attr[name]
         self._set_dirty(True)
@@ -652,9 +692,27 @@ class NoteBookNode (object):
 
     def iter_attr(self):
         """Iterate through attributes of the node"""
+        self._load_attr()
         return iter(self._attr.items())
     
 
+    def _load_attr(self):
+        """Replace skeleton attrs with the node's full attrs from disk"""
+        skeleton = self._skeleton
+        if skeleton is None:
+            return
+        self._skeleton = None
+
+        attr = self._conn.read_node(self._attr["nodeid"])
+
+        # keep any changes made to the skeleton attrs
+        for key, value in self._attr.items():
+            if skeleton.get(key, NULL) != value:
+                attr[key] = value
+        self._attr.update(attr)
+        self._init_attr()
+
+
     def _init_attr(self):
         """Initialize attributes from a dict"""
         t = get_timestamp()
@@ -672,6 +730,18 @@ class NoteBookNode (object):
         return self._parent
 
 
+    def get_position(self):
+        """
+        Returns the index of the node in its parent's children list
+
+        The 'order' attr only sorts siblings and may have gaps.
+        """
+        # positions are assigned when the parent loads its children
+        if self._parent is not None:
+            self._parent.get_children()
+        return self._position
+
+
     def get_title(self):
         """Returns the display title of a node"""
         return self._attr.get("title", "")
@@ -752,6 +822,8 @@ class NoteBookNode (object):
         if not allowed:
             raise error
 
+        position = self.get_position()
+
         # perform delete on disk
         def walk(node):
             for child in node.get_children():
@@ -761,13 +833,13 @@ class NoteBookNode (object):
         
         # update data structure
         self._parent._remove_child(self)
-        self._parent._set_child_order()
         self._set_dirty(False)
         
         # TODO: this will change with multiple parents.  Need GC of some sort
         # make sure to recursively invalidate
         def walk(node):
             node._valid = False
+            self._notebook._nodes.pop(node._attr["nodeid"], None)
             if node._children is not None:
                 for child in node._children:                    
                     walk(child)
@@ -775,7 +847,7 @@ class NoteBookNode (object):
 
         # parent node notifies listeners of change
         self._notebook.node_changed.notify(
-            [("removed", self._parent, self._attr["order"])])
+            [("removed", self._parent, position)])
     
     
     def trash(self):
@@ -821,7 +893,7 @@ class NoteBookNode (object):
         
         assert self != parent
         old_parent = self._parent
-        old_index = self._attr["order"]
+        old_index = self.get_position()
 
         # check whether move is allowed
         allowed, error = self._notebook.move_allowed(self, parent, index)
@@ -848,11 +920,10 @@ class NoteBookNode (object):
         # perform move in NoteBook data structure
         self._parent._remove_child(self)
         if self._parent != parent:
-            self._parent._set_child_order()
             self._parent = parent
             self._parent._add_child(self, index)
         else:
-            if self._attr["order"] < index:
+            if index is not None and old_index < index:
                 index -= 1
             self._parent._add_child(self, index)
         self.save(True)
@@ -881,12 +952,18 @@ class NoteBookNode (object):
 
         # perform sync subtree between connections
         try:
+            # skeleton nodes only know some of their attrs
+            self._load_attr()
+
             # change parent pointer
             self._attr["parentids"] = [parent._attr["nodeid"]]
             def walk(node):
+                # load children first, the sync may reset childrenids
+                node._load_attr()
+                children = node.get_children()
                 sync.sync_node(node._attr["nodeid"], conn1, conn2, 
                                attr=node._attr)
-                for child in node.get_children():
+                for child in children:
                     walk(child)
             walk(self)
         except:
@@ -998,6 +1075,9 @@ class NoteBookNode (object):
 
     def _write_attr(self, attr):
         
+        # never write skeleton attrs, they are incomplete
+        self._load_attr()
+
         #self._notebook._mask_attr.set_dict(attr)
         #self._conn.update_node(attr["nodeid"], self._notebook._mask_attr)
         self._conn.update_node(attr["nodeid"], attr)
@@ -1044,6 +1124,16 @@ class NoteBookNode (object):
         self._children.sort(key=lambda x: x._attr.get("order", sys.maxsize))
         self._set_child_order()
 
+        # renumber siblings whose orders are missing or repeated
+        last = None
+        for child in self._children:
+            order = child._attr.get("order")
+            if (not isinstance(order, int) or order == sys.maxsize or
+                (last is not None and order <= last)):
+                self._rebalance_child_order()
+                break
+            last = order
+
 
     def _iter_children(self):
         """Iterate through children
@@ -1059,12 +1149,41 @@ class NoteBookNode (object):
 
     
     
-    def _set_child_order(self):
-        """Ensures that child know their order in the children list"""
+    def _set_child_order(self, start=0):
+        """Ensures that child know their position in the children list"""
+        for i in range(start, len(self._children)):
+            self._children[i]._position = i
+
+
+    def _rebalance_child_order(self):
+        """Spread the 'order' attrs of all children ORDER_GAP apart"""
         for i, child in enumerate(self._children):
-            if child._attr.get("order") != i:
-                child._attr["order"] = i
+            order = (i + 1) * ORDER_GAP
+            if child._attr.get("order") != order:
+                child._attr["order"] = order
                 child._set_dirty(True)
+
+
+    def _set_order_between(self, child):
+        """
+        Set the 'order' attr of a newly inserted child between the orders
+        of its siblings
+
+        Only the child is changed, unless there is no gap left between its
+        siblings, in which case all children are renumbered.
+        """
+        i = child._position
+        prev_order = (self._children[i-1]._attr["order"] if i > 0 
+                      else 0)
+        if i + 1 < len(self._children):
+            next_order = self._children[i+1]._attr["order"]
+        else:
+            next_order = prev_order + 2 * ORDER_GAP
+
+        if next_order - prev_order >= 2:
+            child._attr["order"] = (prev_order + next_order) // 2
+        else:
+            self._rebalance_child_order()
         
 
     def _add_child(self, child, index=None):
@@ -1078,19 +1197,30 @@ class NoteBookNode (object):
         if self._children is None:
             self._get_children()
         
-        if index is not None:
-            # insert child at index
-            self._children.insert(index, child)
-            self._set_child_order()
-        elif (self._notebook and len(self._children) > 0 and 
-              self._children[-1] == self._notebook.get_trash()):
-            # append child before trash
-            self._children.insert(len(self._children)-1, child)
-            self._set_child_order()
+        trash = None
+        if index is None:
+            if (self._notebook and len(self._children) > 0 and 
+                self._children[-1] == self._notebook.get_trash()):
+                # append child before trash
+                trash = self._children[-1]
+                index = len(self._children) - 1
+            else:
+                # append child at end of list
+                index = len(self._children)
+        self._children.insert(index, child)
+        self._set_child_order(index)
+
+        if trash is not None:
+            # order child after its previous sibling and move the trash 
+            # past it, rather than halving the gap before the trash
+            order = (self._children[index-1]._attr["order"] if index > 0
+                     else 0) + ORDER_GAP
+            child._attr["order"] = order
+            if trash._attr["order"] <= order:
+                trash._attr["order"] = order + ORDER_GAP
+                trash._set_dirty(True)
         else:
-            # append child at end of list
-            child._attr["order"] = len(self._children)
-            self._children.append(child)
+            self._set_order_between(child)
             
         child._set_dirty(True)
     
@@ -1100,6 +1230,7 @@ class NoteBookNode (object):
         if self._children is None:
             self._get_children()
         self._children.remove(child)
+        self._set_child_order(min(child._position, len(self._children)))
 
 
     #==============================================
@@ -1265,6 +1396,9 @@ class NoteBook (NoteBookNode):
         self._filename = None
         self._dirty = set()
         self._trash = None
+        self._skeletons = None
+        self._skeleton_attrs = SKELETON_ATTR
+        self._nodes = {}  # identity map of loaded nodes (nodeid -> node)
         self.attr_defs = AttrDefs()
         self.attr_tables = AttrTables()
         self._necessary_attrs = []
@@ -1314,6 +1448,9 @@ class NoteBook (NoteBookNode):
     def add_attr_def(self, attr_def):
         """Adds a new attribute definition to the notebook"""
         self.attr_defs.add(attr_def)
+        self._set_dirty(True)
+        if attr_def.index and self._conn:
+            self._index_attr_def(attr_def)
     
 
     def clear_attr_defs(self):
@@ -1332,6 +1469,13 @@ class NoteBook (NoteBookNode):
         self.attr_defs.parse(self._attr.get("attr_defs", ()))
         self.attr_tables.parse(self._attr.get("attr_tables", ()))
 
+        # builtin attrs stay indexed
+        for attr_def in g_default_attr_defs:
+            if attr_def.index:
+                attr_def2 = self.attr_defs.get(attr_def.key)
+                attr_def2.index = True
+                attr_def2.index_value |= attr_def.index_value
+
 
     def _write_attr_defs(self):
         self._attr["attr_defs"] = self.attr_defs.format()
@@ -1349,6 +1493,7 @@ class NoteBook (NoteBookNode):
 
         self._attr["nodeid"] = new_nodeid()
         self._init_attr()
+        self._nodes = {self._attr["nodeid"]: self}
 
 
         self._conn.connect(filename)
@@ -1388,6 +1533,30 @@ class NoteBook (NoteBookNode):
                     if index_dir and os.path.exists(index_dir):
                         self._conn._set_index_file(
                             os.path.join(index_dir, notebook_index.INDEX_FILE))
+
+                    # watch for unmanaged changes (e.g. external syncing)
+                    if self.pref.get("watch_changes", default=False):
+                        self._conn.enable_watch(True)
+
+                    # index page texts in the background
+                    if self.pref.get("background_fulltext", default=False):
+                        self._conn.enable_background_fulltext(True)
+
+                    # write saved nodes in the background
+                    if self.pref.get("background_save", default=False):
+                        self._conn.enable_background_save(True)
+
+                    # format of node meta data ("xml", "json" or "pack"),
+                    # existing meta data is converted in the background
+                    meta_format = self.pref.get("meta_format", default="")
+                    if meta_format:
+                        try:
+                            self._conn.set_meta_format(meta_format)
+                            self._conn.enable_background_migrate(True)
+                        except connection.ConnectionError as e:
+                            keepnote.log_message(
+                                "ignoring meta_format preference: %s\n" %
+                                e)
                 except:
                     pass
 
@@ -1405,10 +1574,26 @@ class NoteBook (NoteBookNode):
         attr = self._conn.read_node(self._conn.get_rootid())
         self._attr.update(attr)
         self._init_attr()
+        self._nodes = {self._attr["nodeid"]: self}
 
-        self._init_trash()
-
+        # index the notebook's own indexed attrs
         self._read_attr_defs()
+        self._init_index()
+
+        # if requested and the index is up to date, build the node tree 
+        # from the index alone.  Node files are read only once a node's
+        # other attrs are needed.
+        self._skeletons = None
+        if (isinstance(self._conn, connection_fs.NoteBookConnectionFS) and
+            self.pref.get("load_from_index", default=False) and 
+            not self._conn.index_needed()):
+            self._skeleton_attrs = self._get_skeleton_attrs()
+            self._skeletons = self._conn.read_node_skeletons(
+                self._skeleton_attrs)
+            self._skeletons.pop(self._attr["nodeid"], None)
+            self._convert_skeletons()
+
+        self._init_trash()
 
         self.read_preferences()
 
@@ -1429,14 +1614,39 @@ class NoteBook (NoteBookNode):
         self._set_dirty(False)
 
         if force:
-            for node in self.get_children():
-                node.save(force=force)
+            nodes = self.get_children()
         else:
-            for node in list(self._dirty):
-                node.save()
-        self._conn.save()
-        
+            nodes = list(self._dirty)
+        # nodes of failed background writes are marked dirty again while
+        # saving, see _on_save_error()
         self._dirty.clear()
+        self._save_nodes(nodes)
+        self._conn.save()
+
+
+    def _save_nodes(self, nodes):
+        """Write the attrs of many nodes in one batch"""
+
+        nodes = [node for node in nodes if node._valid]
+        for node in nodes:
+            # never write skeleton attrs, they are incomplete
+            node._load_attr()
+        try:
+            self._conn.update_nodes([(node._attr["nodeid"], node._attr)
+                                     for node in nodes],
+                                    on_error=self._on_save_error)
+        except:
+            for node in nodes:
+                node._set_dirty(True)
+            raise
+
+
+    def _on_save_error(self, nodeids):
+        """Mark nodes dirty again whose background write failed"""
+        for nodeid in nodeids:
+            node = self._nodes.get(nodeid)
+            if node is not None and node._valid:
+                node._set_dirty(True)
 
 
     def close(self, save=True):
@@ -1446,6 +1656,7 @@ class NoteBook (NoteBookNode):
         if save:
             self.save()
         self._conn.close()
+        self._nodes.clear()
         self.close_event.notify(self)
 
 
@@ -1464,8 +1675,39 @@ class NoteBook (NoteBookNode):
         # TODO: ideally I would like to do index_attr()'s before 
         # conn.init_index(), so that the initial indexing properly 
         # catches all the desired attr's
-        self._conn.index_attr("icon", "TEXT")
-        self._conn.index_attr("title", "TEXT", index_value=True)
+        for attr_def in self.attr_defs:
+            if attr_def.index:
+                self._index_attr_def(attr_def)
+
+
+    def _index_attr_def(self, attr_def):
+        """
+        Index an attr in the notebook index
+
+        The connection fills a new index table for existing nodes in
+        the background.
+        """
+        self._conn.index_attr(attr_def.key, attr_def.get_index_type(),
+                              index_value=attr_def.index_value)
+
+
+    def _convert_skeletons(self):
+        """Convert index values of skeleton attrs to their datatypes"""
+        keys = [attr_def.key for attr_def in self.attr_defs
+                if attr_def.datatype == "bool" and
+                attr_def.key in self._skeleton_attrs]
+        for attr in self._skeletons.values():
+            for key in keys:
+                if key in attr:
+                    attr[key] = bool(attr[key])
+
+
+    def _get_skeleton_attrs(self):
+        """Returns the attrs that skeleton nodes read from the index"""
+        pending = set(self._conn.index(["backfill_pending"]) or ())
+        return set(SKELETON_ATTR).union(
+            attr_def.key for attr_def in self.attr_defs
+            if attr_def.index and attr_def.key not in pending)
 
 
     #--------------------------------------
@@ -1484,6 +1726,7 @@ class NoteBook (NoteBookNode):
                             content_type=content_type, 
                             attr=attr)
         node.create()
+        self._nodes[node._attr["nodeid"]] = node
         return node
 
 
@@ -1529,13 +1772,26 @@ class NoteBook (NoteBookNode):
     def _read_node(self, nodeid, parent=None, 
                    default_content_type=CONTENT_TYPE_DIR):
 
-        attr = self._conn.read_node(nodeid)
+        # reuse node if it is already loaded
+        node = self._nodes.get(nodeid)
+        if node is not None and parent is not None and node._parent is parent:
+            return node
+
+        # use skeleton attrs from the index if available
+        skeleton = (self._skeletons.pop(nodeid, None)
+                    if self._skeletons else None)
+        attr = self._conn.read_node(nodeid) if skeleton is None else skeleton
+        
         node = NoteBookNode(
             attr.get("title", DEFAULT_PAGE_NAME), 
             parent=parent, notebook=self,
             content_type=attr.get("content_type", default_content_type),
             attr=attr)
-        node._init_attr()
+        if skeleton is None:
+            node._init_attr()
+        else:
+            node._skeleton = dict(node._attr)
+        self._nodes[nodeid] = node
 
         return node
 
@@ -1690,40 +1946,114 @@ class NoteBook (NoteBookNode):
     def get_node_by_id(self, nodeid):
         """Lookup node by nodeid"""
 
-        # TODO: could make this more efficient by not loading all uncles
+        node = self._nodes.get(nodeid)
+        if node is not None:
+            return node
+
+        return self._get_node_by_path(
+            nodeid, self._conn.get_node_path_by_id(nodeid))
+
+
+    def get_nodes_by_ids(self, nodeids):
+        """
+        Lookup many nodes by nodeid
+
+        Returns a list of nodes in the order of 'nodeids', with None for
+        nodes that are not found.  The paths of all nodes are fetched
+        with one index query, and ancestors shared by several nodes are
+        read only once.
+        """
+
+        nodeids = list(nodeids)
+        missing = [nodeid for nodeid in nodeids if nodeid not in self._nodes]
+        paths = self._conn.get_node_paths_by_id(missing) if missing else {}
 
-        path = self._conn.get_node_path_by_id(nodeid)
-        if path is None:
+        nodes = []
+        for nodeid in nodeids:
+            node = self._nodes.get(nodeid)
+            if node is None:
+                node = self._get_node_by_path(nodeid, paths.get(nodeid))
+            nodes.append(node)
+        return nodes
+
+
+    def _get_node_by_path(self, nodeid, path):
+        """Read the nodes on the path to node 'nodeid' and return it"""
+
+        if path is None or path[0] != self._attr["nodeid"]:
             keepnote.log_message("node %s not found\n" % nodeid)
             return None
         
-        def walk(node, path, i):
-            if i >= len(path):
-                return node
-            
-            # search children
-            nodeid2 = path[i]
-            for child in node.get_children():
-                if child.get_attr("nodeid") == nodeid2:
-                    return walk(child, path, i+1)
-            
-            # node not found
-            keepnote.log_message("node %s not found\n" % str(path))
-            return None
-        return walk(self._notebook, path[1:], 0)
+        # walk down from the root, only reading the nodes on the path.
+        # Siblings are read later, once their parent's children are needed.
+        node = self
+        for nodeid2 in path[1:]:
+            child = self._nodes.get(nodeid2)
+            if child is None:
+                if (node._children is not None or 
+                    nodeid2 not in node._attr["childrenids"]):
+                    # node not found
+                    keepnote.log_message("node %s not found\n" % str(path))
+                    return None
+                try:
+                    child = self._read_node(nodeid2, parent=node)
+                except Exception as e:
+                    keepnote.log_error(e)
+                    return None
+            node = child
+
+        return node
     
     def get_node_path_by_id(self, nodeid):
         """Lookup node path by nodeid"""
         return self._conn.get_node_path_by_id(nodeid)
 
-    def search_node_titles(self, text):
-        """Search nodes by title"""
-        return self._conn.search_node_titles(text)
+    def get_node_paths_by_id(self, nodeids):
+        """Lookup node paths for many nodeids (dict nodeid -> path)"""
+        return self._conn.get_node_paths_by_id(nodeids)
+
+    def search_node_titles(self, text, limit=None):
+        """
+        Search nodes by title
+
+        Returns a list of (nodeid, title), best matches first.
+        """
+        return self._conn.search_node_titles(text, limit=limit)
+
+    def query_nodes(self, conditions, order_by=None, limit=None):
+        """
+        Iterate over the nodeids of nodes whose indexed attributes match
+        'conditions'
+
+        For example, the first ten folders by title are
+
+          query_nodes({"content_type": CONTENT_TYPE_DIR},
+                      order_by="title", limit=10)
+
+        Only indexed attributes can be queried.
+        """
+        return self._conn.query_nodes(conditions, order_by=order_by,
+                                      limit=limit)
 
     def search_node_contents(self, text):
         """Search nodes by content"""
         return self._conn.search_node_contents(text)
 
+    def search_node_contents_ranked(self, text, limit=None, offset=0,
+                                    prefix=False):
+        """
+        Search nodes by content, best matches first
+
+        Returns a list of (nodeid, score, snippet) tuples for one page of
+        results.  'snippet' is an excerpt of the match (or None).
+        """
+        return self._conn.search_node_contents_ranked(
+            text, limit=limit, offset=offset, prefix=prefix)
+
+    def highlight_node_contents(self, nodeid, text, prefix=False):
+        """Returns the text of a node with matching words marked"""
+        return self._conn.highlight_node_contents(nodeid, text, prefix=prefix)
+
     def has_fulltext_search(self):
         """Returns True if full text indexed search is availble"""
         return self._conn.index(["has_fulltext"])
@@ -1732,6 +2062,13 @@ class NoteBook (NoteBookNode):
         """Returns True if full text indexed search is availble"""
         return self._conn.index(["enable_fulltext", enabled])
 
+    def is_fulltext_current(self):
+        """
+        Returns False if page texts are still queued for indexing, in which
+        case fulltext search results may be stale
+        """
+        return not self._conn.index(["fulltext_pending"])
+
     def get_attr_by_id(self, nodeid, key):
         """Returns attr value for a node with id 'nodeid'"""
         return self._conn.get_attr_by_id(nodeid, key)
@@ -1749,8 +2086,8 @@ class NoteBook (NoteBookNode):
     def clear_index(self):
         return self._conn.clear_index()
 
-    def index_all(self):
-        for node in self._conn.index_all():
+    def index_all(self, task=None):
+        for node in self._conn.index_all(task=task):
             yield node
 
 
@@ -63,6 +63,10 @@ class CorruptIndex (ConnectionError):
     def __init__(self, msg="index error", error=None):
         ConnectionError.__init__(self, msg, error)
 
+class QueryError (ConnectionError):
+    def __init__(self, msg="invalid query", error=None):
+        ConnectionError.__init__(self, msg, error)
+
     
 
 #=============================================================================
@@ -141,6 +145,16 @@ class NoteBookConnection (object):
         """Write node attr"""
         raise NotImplementedError("update_node")
 
+    def update_nodes(self, records, on_error=None):
+        """
+        Write the attr of many nodes given as (nodeid, attr) pairs
+
+        Connections that write in the background call on_error(nodeids)
+        for nodes whose write failed.
+        """
+        for nodeid, attr in records:
+            self.update_node(nodeid, attr)
+
     def delete_node(self, nodeid):
         """Delete node"""
         raise NotImplementedError("delete_node")
@@ -261,6 +275,7 @@ class NoteBookConnection (object):
         # ["has_fulltext"]
         # ["node_path", nodeid]
         # ["get_attr", nodeid, key]
+        # ["query", conditions, (order_by), (limit)]
 
         if query[0] == "index_attr":
             index_value = query[3] if len(query) == 4 else False
@@ -282,6 +297,9 @@ class NoteBookConnection (object):
         elif query[0] == "get_attr":
             return self.get_attr_by_id(query[1], query[2])
 
+        elif query[0] == "query":
+            return self.query_nodes(*query[1:])
+
 
         # FS-specific
         elif query[0] == "init":
@@ -304,21 +322,76 @@ class NoteBookConnection (object):
         """Add indexing for an attribute"""
         return self.index(["index_attr", key, datatype, index_value])
 
-    def search_node_titles(self, text):
-        """Search nodes by title"""
-        return self.index(["search", "title", text])
+    def search_node_titles(self, text, limit=None):
+        """
+        Search nodes by title
+
+        Returns a list of (nodeid, title), with at most 'limit' results.
+        """
+        results = self.index(["search", "title", text])
+        if limit is not None:
+            results = results[:limit]
+        return results
 
     def search_node_contents(self, text):
         """Search nodes by content"""
         return self.index(["search_fulltext", text])
+
+    def search_node_contents_ranked(self, text, limit=None, offset=0,
+                                    prefix=False):
+        """
+        Search nodes by content, best matches first
+
+        Returns a list of (nodeid, score, snippet) tuples.  Connections
+        without ranked search return unranked matches without snippets.
+        """
+        results = []
+        for nodeid in self.search_node_contents(text):
+            if nodeid is None:
+                continue
+            if offset > 0:
+                offset -= 1
+                continue
+            if limit is not None and len(results) >= limit:
+                break
+            results.append((nodeid, None, None))
+        return results
+
+    def highlight_node_contents(self, nodeid, text, prefix=False):
+        """
+        Returns the text of a node with the words matching 'text' marked,
+        or None if not supported
+        """
+        return None
     
     def get_node_path_by_id(self, nodeid):
         """Lookup node path by nodeid"""
         return self.index(["node_path", nodeid])
 
+    def get_node_paths_by_id(self, nodeids):
+        """
+        Lookup node paths for many nodeids
+
+        Returns a dict nodeid -> path (None if nodeid is unknown)
+        """
+        return dict((nodeid, self.get_node_path_by_id(nodeid))
+                    for nodeid in nodeids)
+
     def get_attr_by_id(self, nodeid, key):
         return self.index(["get_attr", nodeid, key])
 
+    def query_nodes(self, conditions, order_by=None, limit=None):
+        """
+        Iterate over the nodeids of nodes whose indexed attributes match
+        'conditions'
+
+        'conditions' maps attribute names to a value, or to a list
+        [op, value] (op is one of =, !=, <, <=, >, >=, like, in).  Results
+        are ordered by attribute 'order_by', descending if its name is
+        prefixed with '-'.
+        """
+        return self.index(["query", conditions, order_by, limit])
+
 
 
     #---------------------------------------
@@ -335,7 +408,7 @@ class NoteBookConnection (object):
     def clear_index(self):
         return self.index(["clear_index"])
 
-    def index_all(self):
+    def index_all(self, task=None):
         return self.index(["index_all"])
 
 
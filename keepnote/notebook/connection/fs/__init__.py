@@ -67,6 +67,17 @@ DETECT: The mtime for the payload file should be newer than the last indexed
 UPDATE: Perhaps at this time unmanaged changes to payload files are not
         re-indexed.
 
+
+CHANGE: Moving/renaming a node directory of a notebook whose meta data is kept
+        in the pack (__NOTEBOOK__/meta.pack).
+DETECT: Not supported.  Pack entries are keyed by directory path, so the moved
+        directory and its subtree have no meta data and are no longer seen
+        as nodes.  Unpack the notebook (set_meta_format() and
+        migrate_meta_format()) before moving its directories by hand.
+UPDATE: Renames done by the connection move the pack entries first and then
+        the directory.  If the directory was not renamed (error or crash),
+        the move is undone, see _recover_pack_move().
+
 """
 
 
@@ -81,12 +92,21 @@ UPDATE: Perhaps at this time unmanaged changes to payload files are not
 
 
 # python imports
+import codecs
+from concurrent import futures
+import copy
+import errno
 import gettext
+import hashlib
+from io import StringIO
+import json
 import mimetypes
 import os
 import sys
 import shutil
 import re
+import tempfile
+import threading
 import traceback
 from os.path import join, isdir, isfile
 from os import listdir
@@ -99,6 +119,9 @@ import xml.etree.cElementTree as ET
 from keepnote import safefile, plist, maskdict
 from keepnote import trans
 from keepnote.notebook.connection.fs import index as notebook_index
+from keepnote.notebook.connection.fs import nodexml
+from keepnote.notebook.connection.fs import pack as meta_pack
+from keepnote.notebook.connection.fs import watch as notebook_watch
 from keepnote.notebook.connection import \
     NoteBookConnection, UnknownNode, FileError, UnknownFile, NodeExists, \
     CorruptIndex, ConnectionError, path_basename
@@ -115,19 +138,65 @@ XML_HEADER = """\
 """
 
 NODE_META_FILE = "node.xml"
+NODE_META_JSON_FILE = "node.json"
+META_PACK_FILE = "meta.pack"
 NOTEBOOK_META_DIR = "__NOTEBOOK__"
+PATH_CACHE_FILE = "path_cache.json"
+PATH_CACHE_VERSION = 2
 LOSTDIR = "lost_found"
 ORPHANDIR = "orphans"
 MAX_LEN_NODE_FILENAME = 40
+
+# number of threads update_nodes() uses for writing node files
+SAVE_WORKERS = 4
+
+# formats of node meta data files
+META_FORMAT_XML = "xml"
+META_FORMAT_JSON = "json"
+META_FORMATS = (META_FORMAT_XML, META_FORMAT_JSON)
+NODE_META_FILES = {META_FORMAT_XML: NODE_META_FILE,
+                   META_FORMAT_JSON: NODE_META_JSON_FILE}
+
+# meta data of all nodes in one pack file (see pack.py)
+META_FORMAT_PACK = "pack"
+
+# number of nodes converted between index updates by migrate_meta_format()
+MIGRATE_BATCH_SIZE = 100
 NULL = object()
 
 
 #=============================================================================
 # filenaming scheme
 
-def get_node_meta_file(nodepath):
+def get_node_meta_file(nodepath, meta_format=META_FORMAT_XML):
     """Returns the metadata file for a node"""
-    return os.path.join(nodepath, NODE_META_FILE)
+    return os.path.join(nodepath, NODE_META_FILES[meta_format])
+
+def find_node_meta_file(nodepath, meta_format=META_FORMAT_XML):
+    """
+    Returns the existing metadata file for a node, or None if nodepath is
+    not a node.  The file in 'meta_format' is preferred.
+    """
+    for meta_format2 in iter_meta_formats(meta_format):
+        filename = get_node_meta_file(nodepath, meta_format2)
+        if os.path.isfile(filename):
+            return filename
+    return None
+
+def iter_meta_formats(meta_format):
+    """Iterate through all meta data formats, starting with 'meta_format'"""
+    yield meta_format
+    for meta_format2 in META_FORMATS:
+        if meta_format2 != meta_format:
+            yield meta_format2
+
+def get_meta_format(filename):
+    """Returns the meta data format of a node meta data file"""
+    basename = os.path.basename(filename)
+    for meta_format, basename2 in NODE_META_FILES.items():
+        if basename == basename2:
+            return meta_format
+    return None
 
 def get_pref_file(nodepath):
     """Returns the filename of the notebook preference file"""
@@ -289,14 +358,14 @@ def new_filename_list(filenames, new_filename, ext="", sep=" ", number=2,
 # low-level functions
 
 
-def iter_child_node_paths(path):
+def iter_child_node_paths(path, meta_format=META_FORMAT_XML):
     """Given a path to a node, return the paths of the child nodes"""
 
     children = os.listdir(path)
 
     for child in children:
         child_path = os.path.join(path, child)
-        if os.path.isfile(os.path.join(child_path, "node.xml")):
+        if find_node_meta_file(child_path, meta_format):
             yield child_path
 
 
@@ -324,8 +393,9 @@ def last_node_change(path):
 
     for dirpath, dirnames, filenames in os.walk(path):
         mtime = max(mtime, stat(dirpath).st_mtime)
-        if "node.xml" in filenames:
-            mtime = max(mtime, stat(join(dirpath, "node.xml")).st_mtime)
+        for filename in NODE_META_FILES.values():
+            if filename in filenames:
+                mtime = max(mtime, stat(join(dirpath, filename)).st_mtime)
     
     return mtime
 
@@ -364,18 +434,49 @@ def mark_path_outdated(path):
         del _mtime_cache[path]
 
 
+def copy_attr(attr):
+    """Returns a copy of attr that shares only immutable values"""
+    return dict((key, value if isinstance(value, _immutable_types)
+                 else copy.deepcopy(value))
+                for key, value in attr.items())
+
+_immutable_types = (str, int, float, bool, type(None))
+
+
+def load_json_dict(pairs):
+    """Makes the dicts of a node.json file match those of plist.load()"""
+    return plist.OrderDict((sys.intern(key), value) for key, value in pairs)
+
+
 #=============================================================================
 # path cache
 
 class PathCacheNode (object):
     """Cache information for a node"""
 
+    __slots__ = ("nodeid", "basename", "parent", "children", 
+                 "children_complete")
+
     def __init__(self, nodeid, basename, parent):
         self.nodeid = nodeid
         self.basename = basename
         self.parent = parent
-        self.children = set()
+        self.children = None  # set of child nodes, made on first child
         self.children_complete = False
+
+    def add_child(self, child):
+        if self.children is None:
+            self.children = set()
+        self.children.add(child)
+
+    def remove_child(self, child):
+        if self.children is not None:
+            self.children.discard(child)
+            if not self.children:
+                self.children = None
+
+    def iter_children(self):
+        return iter(self.children) if self.children else iter(())
         
 
 
@@ -387,6 +488,7 @@ class PathCache (object):
     def __init__(self, rootid=None, rootpath=""):
         self._root_parent = object()
         self._nodes = {None: self._root_parent}
+        self._snapshot = None
         
         if rootid:
             self.add(rootid, rootpath, self._root_parent)
@@ -396,11 +498,86 @@ class PathCache (object):
         """Clears cache"""
         self._nodes.clear()
         self._nodes[None] = self._root_parent
+        self._snapshot = None
+
+
+    def set_snapshot(self, load):
+        """
+        Set a function that returns the rows of a snapshot of the cache
+
+        The rows (see get_snapshot()) are loaded on the first lookup of a
+        node that is not cached, or before a node is moved or removed.
+        Nodes that are already cached are kept.
+        """
+        self._snapshot = load
+
+
+    def load_snapshot(self):
+        """Load the pending snapshot, if any"""
+
+        load = self._snapshot
+        if load is None:
+            return
+        self._snapshot = None
+
+        try:
+            rows = load()
+        except Exception as e:
+            keepnote.log_error(e, sys.exc_info()[2])
+            return
+
+        # parents come before their children
+        nodes = []
+        for nodeid, parent_row, basename, children_complete in rows:
+            parent = (nodes[parent_row] if parent_row >= 0 
+                      else self._root_parent)
+            node = self._nodes.get(nodeid, None)
+            if node is None:
+                node = self._nodes[nodeid] = PathCacheNode(
+                    nodeid, basename, parent)
+                node.children_complete = children_complete
+                if parent is not self._root_parent:
+                    parent.add_child(node)
+            nodes.append(node)
+
+
+    def get_snapshot(self, rootid):
+        """
+        Returns rows (nodeid, parent_row, basename, children_complete) for
+        the nodes cached under 'rootid'
+
+        'parent_row' is the index of the parent's row, which always comes
+        first, or -1 for the root.
+        """
+
+        self.load_snapshot()
+        root = self._nodes.get(rootid, None)
+        if root is None:
+            return []
+
+        rows = [(rootid, -1, root.basename, root.children_complete)]
+        stack = [(root, 0)]
+        while stack:
+            node, row = stack.pop()
+            for child in node.iter_children():
+                rows.append((child.nodeid, row, child.basename, 
+                             child.children_complete))
+                stack.append((child, len(rows) - 1))
+        return rows
+
+
+    def _get_node(self, nodeid):
+        """Returns the cached node, loading the pending snapshot if needed"""
+        node = self._nodes.get(nodeid, None)
+        if node is None and self._snapshot is not None:
+            self.load_snapshot()
+            node = self._nodes.get(nodeid, None)
+        return node
 
 
     def has_node(self, nodeid):
         """Returns True if node in cache"""
-        return nodeid in self._nodes
+        return self._get_node(nodeid) is not None
 
 
     def get_path_list(self, nodeid):
@@ -409,7 +586,7 @@ class PathCache (object):
         Returns None if nodeid is not cached
         """
         path_list = []
-        node = self._nodes.get(nodeid, None)
+        node = self._get_node(nodeid)
 
         # node is not in cache
         if node is None:
@@ -434,7 +611,7 @@ class PathCache (object):
         """
 
         path_list = []
-        node = self._nodes.get(nodeid, None)
+        node = self._get_node(nodeid)
 
         # node is not in cache
         if node is None:
@@ -457,7 +634,7 @@ class PathCache (object):
         Returns basename of path for a nodeid
         Returns None if nodeid is not cached
         """
-        node = self._nodes.get(nodeid, None)
+        node = self._get_node(nodeid)
         if node:
             return node.basename
         else:
@@ -469,7 +646,7 @@ class PathCache (object):
         Returns parentid of a nodeid
         Returns None if nodeid is not cached
         """
-        node = self._nodes.get(nodeid, None)
+        node = self._get_node(nodeid)
         if node and node.parent and node.parent is not self._root_parent:
             return node.parent.nodeid
         else:
@@ -481,14 +658,14 @@ class PathCache (object):
         Returns iterator of the child ids of a nodeid
         Returns None if nodeid is not cached or children have not been read
         """
-        node = self._nodes.get(nodeid, None)
+        node = self._get_node(nodeid)
         if node and node.children_complete:
-            return (child.nodeid for child in node.children)
+            return (child.nodeid for child in node.iter_children())
         else:
             return None
 
     def set_children_complete(self, nodeid, complete):
-        node = self._nodes.get(nodeid, None)
+        node = self._get_node(nodeid)
         if node:
             node.children_complete = complete
     
@@ -496,7 +673,7 @@ class PathCache (object):
     def add(self, nodeid, basename, parentid):
         """Add a new nodeid, basename, and parentid to the cache"""
         
-        parent = self._nodes.get(parentid, None)
+        parent = self._get_node(parentid)
         #if parent is 0:
             # TODO: should I allow unknown parent?
             #raise UnknownNode("unknown parent %s" % 
@@ -508,33 +685,35 @@ class PathCache (object):
         else:
             node = self._nodes[nodeid] = PathCacheNode(nodeid, basename, parent)
         if parent and parent is not self._root_parent:
-            parent.children.add(node)
+            parent.add_child(node)
 
         
     def remove(self, nodeid):
         """Remove a nodeid from the cache"""
+        self.load_snapshot()
         if nodeid in self._nodes:
             node = self._nodes.get(nodeid)
             if node.parent and node.parent is not self._root_parent:
-                node.parent.children.remove(node)
+                node.parent.remove_child(node)
             del self._nodes[nodeid]
 
 
     def move(self, nodeid, new_basename, parentid):
         """move nodeid to a new parent"""
+        self.load_snapshot()
         node = self._nodes.get(nodeid, None)
         parent = self._nodes.get(parentid, None)
         
         if node is not None:
             if node.parent and node.parent is not self._root_parent:
-                node.parent.children.remove(node)
+                node.parent.remove_child(node)
 
             node.parent = parent
             node.basename = new_basename
 
             if parent and parent is not self._root_parent:
                 # update cache
-                parent.children.add(node)
+                parent.add_child(node)
                 
 
 
@@ -549,10 +728,38 @@ class NoteBookConnectionFS (NoteBookConnection):
 
         self._index_file = None
 
+        # optional watcher of unmanaged changes
+        self._use_watch = False
+        self._watcher = None
+
+        # optional background fulltext indexing
+        self._use_background_fulltext = False
+
+        # optional background writing of update_nodes()
+        self._use_background_save = False
+        self._save_thread = None
+        self._save_failed = None   # (on_error, nodeids) of a failed write
+
+        # format of the node meta data files we write, and optional
+        # background conversion of the files of other formats
+        self._meta_format = META_FORMAT_XML
+        self._meta_file_format = META_FORMAT_XML
+        self._pack = None
+        self._use_background_migrate = False
+        self._migrate_thread = None
+        self._migrate_stop = False
+        self._migrate_lock = threading.Lock()
+
         # attributes to not write to disk, they can be derived
         self._attr_suppress = set(["parentids", "childrenids"])
         self._attr_mask = maskdict.MaskDict({}, self._attr_suppress)
 
+        # node meta data files we last wrote (filename -> 
+        # (digest, mtime, size)), for skipping unchanged writes
+        self._attr_fingerprints = {}
+        self._write_stats = {"written": 0, "skipped": 0}
+        self._write_stats_lock = threading.Lock()
+
     
 
     #================================
@@ -617,6 +824,275 @@ class NoteBookConnectionFS (NoteBookConnection):
         return path
 
 
+    def enable_watch(self, enabled=True):
+        """
+        Watch the notebook for unmanaged changes (Linux only)
+
+        When watching, nodes are only checked for unmanaged changes after
+        the filesystem reports a change, rather than on every read.
+        Must be called before connect().
+        """
+        self._use_watch = enabled
+
+
+    def enable_background_fulltext(self, enabled=True):
+        """
+        Index page texts in a background thread
+
+        Node reads and writes only queue pages for indexing, and fulltext
+        searches wait for the queue to be indexed.
+        """
+        self._use_background_fulltext = enabled
+        if self._index:
+            self._index.enable_background_fulltext(enabled)
+
+
+    def enable_background_save(self, enabled=True):
+        """
+        Write the node files of update_nodes() in a background thread
+
+        update_nodes() then returns once the attrs are copied.  Any other
+        node I/O waits for the pending writes to finish first.
+        """
+        self._use_background_save = enabled
+
+
+    def _wait_save(self):
+        """
+        Wait for background writes of update_nodes() to finish
+
+        If they failed, the error is already logged and the on_error
+        callback given to update_nodes() is called.  The waiting call
+        itself goes on.
+        """
+        thread = self._save_thread
+        if thread is not None:
+            thread.join()
+            self._save_thread = None
+            failed, self._save_failed = self._save_failed, None
+            if failed is not None:
+                on_error, nodeids = failed
+                if on_error:
+                    on_error(nodeids)
+
+
+    def set_meta_format(self, meta_format):
+        """
+        Set the format of the node meta data written from now on
+
+        The formats are node.xml files, node.json files, or the pack file
+        __NOTEBOOK__/meta.pack.  Every format is read.  A node's meta data
+        is moved to the new format whenever the node is written, see
+        migrate_meta_format() for converting all nodes at once.
+        """
+        if meta_format not in META_FORMATS + (META_FORMAT_PACK,):
+            raise ConnectionError(
+                _("Unknown meta data format '%s'") % meta_format)
+        self._meta_format = meta_format
+        self._meta_file_format = (meta_format if meta_format in META_FORMATS
+                                  else META_FORMAT_XML)
+        if self._filename is not None:
+            self._open_pack()
+
+
+    def get_meta_format(self):
+        """Returns the format of the node meta data files written"""
+        return self._meta_format
+
+
+    def enable_background_migrate(self, enabled=True):
+        """
+        Convert the meta data files of all nodes to the current format in
+        a background thread
+
+        Must be called before connect().
+        """
+        self._use_background_migrate = enabled
+
+
+    def _start_migrate(self):
+        """Start the background conversion of meta data files if enabled"""
+        if not self._use_background_migrate:
+            return
+        self._migrate_stop = False
+        self._migrate_thread = threading.Thread(
+            target=self._migrate_background)
+        self._migrate_thread.daemon = True
+        self._migrate_thread.start()
+
+
+    def _migrate_background(self):
+        try:
+            count = self.migrate_meta_format()
+            if count:
+                keepnote.log_message(
+                    "converted %d node meta data files to '%s'\n" %
+                    (count, self._meta_format))
+        except Exception as e:
+            keepnote.log_error(e, sys.exc_info()[2])
+
+
+    def _wait_migrate(self):
+        """Wait for the background conversion of meta data files to finish"""
+        thread = self._migrate_thread
+        if thread is not None:
+            thread.join()
+            self._migrate_thread = None
+
+
+    def _stop_migrate(self):
+        """Stop the background conversion of meta data files"""
+        self._migrate_stop = True
+        self._wait_migrate()
+
+
+    def _get_pack_file(self):
+        return os.path.join(self._filename, NOTEBOOK_META_DIR, META_PACK_FILE)
+
+
+    def _open_pack(self):
+        """Open the meta data pack if it exists or is the current format"""
+        if self._pack is not None:
+            return
+        filename = self._get_pack_file()
+        if (self._meta_format != META_FORMAT_PACK and 
+            not os.path.exists(filename)):
+            return
+
+        pack = meta_pack.MetaPack(filename)
+        try:
+            if not os.path.exists(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            pack.open()
+            self._recover_pack_move(pack)
+        except Exception as e:
+            raise ConnectionError(
+                _("Cannot open meta data pack '%s'") % filename, e)
+        self._pack = pack
+
+
+    def _recover_pack_move(self, pack):
+        """
+        Undo the last move of pack entries if their directory was not
+        renamed
+
+        _rename_node_dir() moves the entries before the directory, so a
+        crash in between leaves the entries under a path that does not
+        exist, while the directory has none.
+        """
+        move = pack.get_last_move()
+        if move is None:
+            return
+        old_key, new_key = move
+        old_path = self._get_pack_path(old_key)
+        if (not os.path.exists(self._get_pack_path(new_key)) and
+            os.path.isdir(old_path) and not pack.has(old_key)):
+            keepnote.log_message("undoing unfinished rename of '%s'\n" %
+                                 old_path)
+            pack.move(new_key, old_key)
+
+
+    def _recover_pack_dir(self, path):
+        """
+        Recover the pack entries of a node directory moved outside of
+        KeepNote
+
+        A directory in pack mode has no meta data of its own, so once it is
+        moved its entries are left under its old path.  If exactly one node
+        is indexed with the same basename, and its entries are under a path
+        that no longer exists, they are moved to 'path'.  Returns True if
+        'path' is a node again.
+        """
+        if (self._pack is None or self._index is None or
+            not os.path.isdir(path)):
+            return False
+
+        old_keys = []
+        for nodeid in self._index.get_nodeids_by_basename(
+                os.path.basename(path)):
+            path_list = self._index.get_node_filepath(nodeid)
+            if path_list is None:
+                continue
+            old_path = os.path.join(self._filename, *path_list)
+            old_key = self._get_pack_key(old_path)
+            if (old_path != path and self._pack.has(old_key) and 
+                not os.path.exists(old_path)):
+                old_keys.append(old_key)
+        if not old_keys:
+            return False
+        if len(old_keys) > 1:
+            keepnote.log_message(
+                "cannot recover meta data of '%s': %d nodes match\n" %
+                (path, len(old_keys)))
+            return False
+
+        keepnote.log_message("recovering meta data of moved directory "
+                             "'%s'\n" % path)
+        with self._migrate_lock:
+            return self._pack.move(old_keys[0], self._get_pack_key(path))
+
+
+    def _close_pack(self):
+        """Close the meta data pack, repacking it if it is mostly unused"""
+        pack = self._pack
+        if pack is None:
+            return
+        self._pack = None
+        try:
+            if len(pack) == 0 and self._meta_format != META_FORMAT_PACK:
+                # every node has been unpacked
+                pack.close()
+                pack.remove_files()
+            else:
+                if pack.needs_repack():
+                    pack.repack()
+                pack.close()
+        except Exception as e:
+            keepnote.log_error(e, sys.exc_info()[2])
+
+
+    def repack_meta(self):
+        """Reclaim the space of replaced entries in the meta data pack"""
+        if self._pack is not None:
+            self._pack.repack()
+
+
+    def _get_pack_key(self, path):
+        """Returns the key of a node path in the meta data pack"""
+        root = self._filename
+        if path == root:
+            return ""
+        if path.startswith(root) and path[len(root)] == os.path.sep:
+            return path_local2node(path[len(root)+1:])
+        return path_local2node(os.path.relpath(path, root))
+
+
+    def _get_pack_path(self, key):
+        """Returns the node path of a key in the meta data pack"""
+        if not key:
+            return self._filename
+        return os.path.join(self._filename, path_node2local(key))
+
+
+    def _start_watch(self):
+        """Start the change watcher if enabled and available"""
+        if not self._use_watch or not notebook_watch.is_available():
+            return
+        try:
+            self._watcher = notebook_watch.NodeWatcher(
+                self._filename, is_node=self._is_node_path)
+            self._watcher.start()
+        except Exception as e:
+            keepnote.log_error(e, sys.exc_info()[2])
+            self._watcher = None
+
+
+    def _stop_watch(self):
+        if self._watcher:
+            self._watcher.stop()
+            self._watcher = None
+
+
     def _get_node_mtime(self, nodeid):
         """mtime (modification time) for nodeid"""
         return os.stat(self._get_node_path(nodeid)).st_mtime
@@ -653,11 +1129,22 @@ class NoteBookConnectionFS (NoteBookConnection):
         """Make a new connection"""
         self._filename = url
         self.init_index()
+        self._open_pack()
+        self._open_path_cache()
+        self._start_watch()
+        self._start_migrate()
         
     def close(self):
         """Close connection"""
-        self._index.close()
-        self._filename = None
+        try:
+            self._stop_migrate()
+            self._wait_save()
+        finally:
+            self._stop_watch()
+            self._save_path_cache()
+            self._close_pack()
+            self._index.close()
+            self._filename = None
 
     def save(self):
         """Save any unsynced state"""
@@ -670,6 +1157,7 @@ class NoteBookConnectionFS (NoteBookConnection):
 
     def create_node(self, nodeid, attr, _path=None):
         """Create a node"""
+        self._wait_save()
 
         # check for creating root
         if self._rootid is None:
@@ -726,7 +1214,7 @@ class NoteBookConnectionFS (NoteBookConnection):
         # make directory and write attr
         try:
             os.makedirs(path)
-            self._write_attr(self._get_node_attr_file(nodeid, path), attr)
+            self._write_node_meta(path, attr)
             self._path_cache.add(nodeid, basename, parentid)
         except OSError as e:
             raise ConnectionError(_("Cannot create node"), e)
@@ -780,6 +1268,7 @@ class NoteBookConnectionFS (NoteBookConnection):
     
     def read_node(self, nodeid, _force_index=False):
         """Read a node attr"""
+        self._wait_save()
         
         path = self._get_node_path(nodeid)
         parentid = self._get_parentid(nodeid)
@@ -794,8 +1283,68 @@ class NoteBookConnectionFS (NoteBookConnection):
 
     def update_node(self, nodeid, attr):
         """Write node attr"""
+        self._wait_save()
         
         # TODO: support mutltiple parents
+        parentid, parentid2, rename = self._get_node_update(nodeid, attr)
+
+        # write attrs
+        path = self._get_node_path(nodeid)
+        self._write_node_meta(path, attr)
+        
+        if rename:
+            self._rename_node_dir(nodeid, attr, parentid, parentid2, path)
+        else:
+            # update index
+            basename = os.path.basename(path)
+            self._index.add_node(nodeid, parentid2, basename, attr, 
+                                 mtime=get_path_mtime(path))
+
+
+    def update_nodes(self, records, on_error=None):
+        """
+        Write the attr of many nodes given as (nodeid, attr) pairs
+
+        Nodes whose directory is renamed (new parent or title) are written
+        one at a time.  The node files of the others are written by a pool
+        of SAVE_WORKERS threads, moved into place together, and indexed in
+        one transaction.
+
+        With background saving, a failed write is logged and reported by
+        calling on_error(nodeids) with the nodes that were not written,
+        from the next call that waits for it.
+        """
+        self._wait_save()
+
+        batch = []
+        for nodeid, attr in records:
+            parentid, parentid2, rename = self._get_node_update(nodeid, attr)
+            if rename:
+                self.update_node(nodeid, attr)
+            else:
+                batch.append((nodeid, parentid2, self._get_node_path(nodeid),
+                              attr))
+        if not batch:
+            return
+
+        if self._use_background_save:
+            # the caller may change the attrs once we return
+            batch = [(nodeid, parentid, path, copy_attr(attr))
+                     for nodeid, parentid, path, attr in batch]
+            self._save_thread = threading.Thread(
+                target=self._write_nodes_background, args=(batch, on_error))
+            self._save_thread.start()
+        else:
+            failed, error = self._write_nodes(batch)
+            if error is not None:
+                raise ConnectionError(_("Cannot write meta data"), error)
+
+
+    def _get_node_update(self, nodeid, attr):
+        """
+        Returns the old parentid, the new parentid and whether the node
+        directory must be renamed for writing 'attr'
+        """
 
         # determine if parentid has changed
         parentid = self._get_parentid(nodeid) # old parent
@@ -809,23 +1358,102 @@ class NoteBookConnectionFS (NoteBookConnection):
         # determine if title has changed
         title_index = self._index.get_attr(nodeid, "title") # old title
 
-        # write attrs
-        path = self._get_node_path(nodeid)
-        self._write_attr(get_node_meta_file(path), attr)
-        
-        if parentid != parentid2:
-            # move to a new parent
-            self._rename_node_dir(nodeid, attr, parentid, parentid2, path)
-        elif (parentid and title_index and 
-              title_index != attr.get("title", "")):
-            # rename node directory, but
-            # do not rename root node dir (parentid is None)
-            self._rename_node_dir(nodeid, attr, parentid, parentid2, path)
+        # move to a new parent, or rename node directory to match title,
+        # but do not rename root node dir (parentid is None)
+        rename = (parentid != parentid2 or 
+                  bool(parentid and title_index and 
+                       title_index != attr.get("title", "")))
+        return parentid, parentid2, rename
+
+
+    def _write_nodes(self, batch):
+        """
+        Write node meta data for (nodeid, parentid, path, attr) records and
+        index them
+
+        Returns the nodeids that could not be written, and the error, or
+        ([], None).  The nodes that were written are still indexed.
+        """
+
+        if self._meta_format == META_FORMAT_PACK:
+            self._write_pack([(path, attr) for nodeid, parentid, path, attr
+                              in batch])
+            failed, error = [], None
         else:
-            # update index
-            basename = os.path.basename(path)
-            self._index.add_node(nodeid, parentid2, basename, attr, 
-                                 mtime=get_path_mtime(path))
+            failed, error = self._write_node_files(batch)
+
+        # update index
+        failed_set = set(failed)
+        self._index.add_nodes(
+            (nodeid, parentid, os.path.basename(path), attr, 
+             get_path_mtime(path))
+            for nodeid, parentid, path, attr in batch
+            if nodeid not in failed_set)
+        return failed, error
+
+
+    def _write_node_files(self, batch):
+        """
+        Write node files for (nodeid, parentid, path, attr) records
+
+        Returns the nodeids whose files could not be written, and the last
+        error, or ([], None).
+        """
+
+        # write all files to temp files first
+        filenames = [self._get_node_meta_file(path)
+                     for nodeid, parentid, path, attr in batch]
+        pool = futures.ThreadPoolExecutor(SAVE_WORKERS)
+        try:
+            tasks = [pool.submit(self._write_attr_temp, filename, record[3])
+                     for filename, record in zip(filenames, batch)]
+            futures.wait(tasks)
+        finally:
+            pool.shutdown()
+
+        # unchanged files are not written
+        written = []
+        failed = []
+        error = None
+        for task, filename, record in zip(tasks, filenames, batch):
+            if task.exception():
+                failed.append(record[0])
+                error = task.exception()
+            elif task.result() is not None:
+                tmpfile, digest = task.result()
+                written.append((record[0], tmpfile, filename, digest))
+        
+        # move them into place in one pass
+        for nodeid, tmpfile, filename, digest in written:
+            try:
+                os.replace(tmpfile, filename)
+            except Exception as e:
+                failed.append(nodeid)
+                error = e
+                if os.path.exists(tmpfile):
+                    os.remove(tmpfile)
+                continue
+            with self._write_stats_lock:
+                self._write_stats["written"] += 1
+            self._set_attr_fingerprint(filename, digest)
+            try:
+                self._remove_other_meta_files(filename)
+            except Exception as e:
+                keepnote.log_error(e, sys.exc_info()[2])
+
+        return failed, error
+
+
+    def _write_nodes_background(self, batch, on_error):
+        try:
+            failed, error = self._write_nodes(batch)
+            if error is not None:
+                keepnote.log_error(error)
+        except Exception as e:
+            keepnote.log_error(e, sys.exc_info()[2])
+            failed, error = [record[0] for record in batch], e
+        if error is not None:
+            self._save_failed = (on_error, failed)
         
 
     def _rename_node_dir(self, nodeid, attr, parentid, new_parentid, path):
@@ -842,11 +1470,24 @@ class NoteBookConnectionFS (NoteBookConnection):
             new_path = self._get_orphandir(nodeid)
             basename = new_path           
 
-        try:
-            os.rename(path, new_path)
-        except Exception as e:
-            raise ConnectionError(
-                _("Cannot rename '%s' to '%s'" % (path, new_path)), e)
+        with self._migrate_lock:
+            # pack entries move first, see _recover_pack_move()
+            moved = False
+            try:
+                if self._pack is not None:
+                    moved = self._pack.move(self._get_pack_key(path),
+                                            self._get_pack_key(new_path))
+                os.rename(path, new_path)
+            except Exception as e:
+                if moved:
+                    try:
+                        self._pack.move(self._get_pack_key(new_path),
+                                        self._get_pack_key(path))
+                    except Exception:
+                        # undone on the next open
+                        keepnote.log_error()
+                raise ConnectionError(
+                    _("Cannot rename '%s' to '%s'" % (path, new_path)), e)
         
         # update index
         self._path_cache.move(nodeid, basename, new_parentid)
@@ -865,11 +1506,20 @@ class NoteBookConnectionFS (NoteBookConnection):
     
     def delete_node(self, nodeid):
         """Delete node"""
+        self._wait_save()
 
         # TODO: will need code that orphans any children of nodeid
 
         try:
-            shutil.rmtree(self._get_node_path(nodeid))
+            path = self._get_node_path(nodeid)
+            with self._migrate_lock:
+                shutil.rmtree(path)
+                if self._pack is not None:
+                    try:
+                        self._pack.remove_tree(self._get_pack_key(path))
+                    except Exception:
+                        # entries of missing directories are only unused
+                        keepnote.log_error()
         except Exception as e:
             raise ConnectionError(
                 _("Do not have permission to delete"), e)
@@ -888,6 +1538,46 @@ class NoteBookConnectionFS (NoteBookConnection):
             return self._read_root()["nodeid"]
         
 
+    def read_node_skeletons(self, keys):
+        """
+        Read partial attrs for every node using only the index
+
+        Returns a dict (nodeid -> attr) where each attr has 'nodeid',
+        'parentids', 'childrenids' and any of the attributes 'keys' that
+        are indexed.  No node files are read, so the result is only as
+        current as the index.  The path cache is filled as a side effect.
+        """
+
+        rootid = self.get_rootid()
+        uniroot = keepnote.notebook.UNIVERSAL_ROOT
+        nodes = {}
+        children = {}
+
+        for nodeid, parentid, basename, attr in \
+                self._index.list_node_skeletons(keys):
+            if parentid == uniroot:
+                parentid = None
+            attr["nodeid"] = nodeid
+            attr["parentids"] = [parentid] if parentid else []
+            nodes[nodeid] = attr
+            children.setdefault(parentid, []).append((nodeid, basename))
+
+        # fill path cache from the root down, so that parents are cached
+        # before their children
+        for nodeid, attr in nodes.items():
+            attr["childrenids"] = [
+                childid for childid, basename in children.get(nodeid, ())]
+        stack = [rootid]
+        while stack:
+            nodeid = stack.pop()
+            for childid, basename in children.get(nodeid, ()):
+                self._path_cache.add(childid, basename, nodeid)
+                stack.append(childid)
+            self._path_cache.set_children_complete(nodeid, True)
+
+        return nodes
+
+
     def _get_parentid(self, nodeid):
         """Returns nodeid of parent of node"""
         parentid = self._path_cache.get_parentid(nodeid)
@@ -912,7 +1602,7 @@ class NoteBookConnectionFS (NoteBookConnection):
         
         for filename in files:
             path2 = os.path.join(path, filename)
-            if os.path.exists(get_node_meta_file(path2)):
+            if self._is_node_path(path2) or self._recover_pack_dir(path2):
                 try:
                     yield self._read_node(nodeid, path2, _full=_full)
                 except ConnectionError as e:
@@ -955,12 +1645,10 @@ class NoteBookConnectionFS (NoteBookConnection):
     def _read_node(self, parentid, path, _full=True, _force_index=False):
         """Reads a node from disk"""
         
-        metafile = get_node_meta_file(path)
-
-        attr = self._read_attr(metafile)
+        attr = self._read_node_meta(path)
         attr["parentids"] = ([parentid] if parentid else [])
         if not self._validate_attr(attr):
-            self._write_attr(metafile, attr)
+            self._write_node_meta(path, attr)
 
         # update path cache
         nodeid = attr["nodeid"]
@@ -973,7 +1661,7 @@ class NoteBookConnectionFS (NoteBookConnection):
             # reindex this node
             self._index.add_node(
                 nodeid, parentid, basename, attr, get_path_mtime(path))
-        else:
+        elif self._watcher is None or self._watcher.check_dirty(path):
             # if node has changed on disk (newer mtime), then re-index it
             current, mtime = self._node_index_current(nodeid, path)
             if not current:
@@ -1007,7 +1695,7 @@ class NoteBookConnectionFS (NoteBookConnection):
         # use 0 for mtime, so that they will still trigger an index for them
         # selves
         # reindex all children in case their parentid's changed
-        for path2 in iter_child_node_paths(path):
+        for path2 in self._iter_child_node_paths(path):
             attr2 = self._read_node(nodeid, path2, _full=False,
                                     _force_index=True)
             #self._index.add_node(
@@ -1023,34 +1711,262 @@ class NoteBookConnectionFS (NoteBookConnection):
     
     def _get_node_attr_file(self, nodeid, path=None):
         """Returns the meta file for the node"""
-        return self.get_file(nodeid, NODE_META_FILE, path)
+        return self.get_file(nodeid, NODE_META_FILES[self._meta_file_format],
+                             path)
+
+
+    def _get_node_meta_file(self, path):
+        """Returns the meta data file of the current format for a node path"""
+        return get_node_meta_file(path, self._meta_file_format)
+
+
+    def _get_node_meta_format(self, path):
+        """
+        Returns the format holding the meta data of the node at 'path', or
+        None if 'path' is not a node
+        """
+        if self._pack is not None and self._pack.has(self._get_pack_key(path)):
+            return META_FORMAT_PACK
+        filename = find_node_meta_file(path, self._meta_file_format)
+        return None if filename is None else get_meta_format(filename)
+
+
+    def _is_node_path(self, path):
+        """Returns True if 'path' is a node directory"""
+        return self._get_node_meta_format(path) is not None
+
+
+    def _iter_child_node_paths(self, path):
+        """Iterate through the paths of the child nodes of a node path"""
+        for filename in os.listdir(path):
+            path2 = os.path.join(path, filename)
+            if self._is_node_path(path2) or self._recover_pack_dir(path2):
+                yield path2
+
+
+    def _write_node_meta(self, path, attr):
+        """Write the meta data of the node at 'path' in the current format"""
+        if self._meta_format == META_FORMAT_PACK:
+            self._write_pack([(path, attr)])
+        else:
+            self._write_attr(self._get_node_meta_file(path), attr)
+
+
+    def _write_pack(self, records):
+        """
+        Write the meta data of (path, attr) records to the pack with one
+        fsync.  Safe to call from the background save thread.
+        """
+
+        paths = {}
+        items = []
+        for path, attr in records:
+            key = self._get_pack_key(path)
+            paths[key] = path
+            items.append((key, self._format_attr_json(
+                maskdict.MaskDict(attr, self._attr_suppress)).encode("utf-8")))
+
+        try:
+            written, added = self._pack.put(items)
+
+            # nodes new to the pack may still have meta data files
+            for key in added:
+                self._remove_meta_files(paths[key])
+        except Exception as e:
+            raise ConnectionError(_("Cannot write meta data"), e)
+
+        with self._write_stats_lock:
+            self._write_stats["written"] += written
+            self._write_stats["skipped"] += len(items) - written
 
 
     def _write_attr(self, filename, attr):
-        """Write a node meta data file"""
+        """
+        Write a node meta data file
+
+        The write is skipped if the file is unchanged since we last wrote
+        the same contents to it.
+        """
 
         self._attr_mask.set_dict(attr)
 
         try:
+            data = self._format_meta(filename, self._attr_mask)
+            digest = self._get_attr_digest(filename, data)
+            if digest is None:
+                return
             out = safefile.open(filename, "w", codec="utf-8")
-            out.write('<?xml version="1.0" encoding="UTF-8"?>\n'
-                      '<node>\n'
-                      '<version>%d</version>\n' % 
-                      attr.get("version", 
-                               keepnote.notebook.NOTEBOOK_FORMAT_VERSION))
-            plist.dump(self._attr_mask, out, indent=2, depth=0)
-            out.write('</node>\n')
+            out.write(data)
             out.close()
+            with self._write_stats_lock:
+                self._write_stats["written"] += 1
+            self._set_attr_fingerprint(filename, digest)
+            self._remove_other_meta_files(filename)
         except Exception as e:
             raise ConnectionError(
                 _("Cannot write meta data" + " " + filename + ":" + str(e)), e)
 
 
+    def _write_attr_temp(self, filename, attr):
+        """
+        Write a node meta data file to a temp file in the same directory
+
+        Returns (tmpfile, digest), or None if the file is unchanged (see
+        _write_attr()).  Safe to call from several threads.
+        """
+
+        data = self._format_meta(
+            filename, maskdict.MaskDict(attr, self._attr_suppress))
+        digest = self._get_attr_digest(filename, data)
+        if digest is None:
+            return None
+        return self._write_temp_file(filename, data), digest
+
+
+    def _write_temp_file(self, filename, data):
+        """
+        Write 'data' to a new temp file next to 'filename' and return the
+        name of the temp file
+        """
+        fd, tmpfile = tempfile.mkstemp(
+            ".tmp", os.path.basename(filename) + "_", 
+            dir=os.path.dirname(filename))
+        os.close(fd)
+        try:
+            out = codecs.open(tmpfile, "w", "utf-8")
+            try:
+                out.write(data)
+                out.flush()
+                os.fsync(out.fileno())
+            finally:
+                out.close()
+        except:
+            os.remove(tmpfile)
+            raise
+        return tmpfile
+
+
+    def _remove_other_meta_files(self, filename):
+        """
+        Remove the meta data of other formats for the node whose meta data
+        file 'filename' was just written
+        """
+        path = os.path.dirname(filename)
+        self._remove_meta_files(path, keep=get_meta_format(filename))
+        if self._pack is not None:
+            self._pack.remove(self._get_pack_key(path))
+
+
+    def _remove_meta_files(self, path, keep=None):
+        """
+        Remove the meta data files of the node at 'path', except for the
+        file of format 'keep'
+        """
+        for meta_format in META_FORMATS:
+            if meta_format != keep:
+                try:
+                    os.remove(get_node_meta_file(path, meta_format))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+
+    def _format_meta(self, filename, attr):
+        """Returns the contents of the node meta data file 'filename'"""
+        if get_meta_format(filename) == META_FORMAT_JSON:
+            return self._format_attr_json(attr)
+        return self._format_attr(attr)
+
+
+    def _format_attr_json(self, attr):
+        """Returns the contents of a node.json meta data file"""
+        return json.dumps(
+            {"version": attr.get("version", 
+                                 keepnote.notebook.NOTEBOOK_FORMAT_VERSION),
+             "attr": dict(attr.items())},
+            ensure_ascii=False, separators=(",", ":")) + "\n"
+
+
+    def _format_attr(self, attr):
+        """Returns the contents of a node meta data file"""
+        out = StringIO()
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                  '<node>\n'
+                  '<version>%d</version>\n' % 
+                  attr.get("version", 
+                           keepnote.notebook.NOTEBOOK_FORMAT_VERSION))
+        plist.dump(attr, out, indent=2, depth=0)
+        out.write('</node>\n')
+        return out.getvalue()
+
+
+    def _get_attr_digest(self, filename, data):
+        """
+        Returns the digest of meta data file contents 'data', or None if
+        the file already holds them and the write can be skipped
+        """
+
+        digest = hashlib.sha1(data.encode("utf-8")).digest()
+        fingerprint = self._attr_fingerprints.get(filename)
+        unchanged = False
+        if fingerprint is not None and fingerprint[0] == digest:
+            # the file must not have changed since we wrote it
+            try:
+                stat = os.stat(filename)
+                unchanged = (fingerprint[1:] == 
+                             (stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                pass
+
+        if unchanged:
+            with self._write_stats_lock:
+                self._write_stats["skipped"] += 1
+            return None
+        return digest
+
+
+    def _set_attr_fingerprint(self, filename, digest):
+        """Remember the digest of the contents just written to a file"""
+        stat = os.stat(filename)
+        self._attr_fingerprints[filename] = (
+            digest, stat.st_mtime_ns, stat.st_size)
+
+
+    def get_write_stats(self):
+        """
+        Returns counts of node meta data writes: 'written', and 'skipped'
+        because the file was unchanged
+        """
+        with self._write_stats_lock:
+            return dict(self._write_stats)
+
+
+    def reset_write_stats(self):
+        """Reset the counts of get_write_stats()"""
+        with self._write_stats_lock:
+            for key in self._write_stats:
+                self._write_stats[key] = 0
+
+
     def _read_attr(self, filename, recover=True):
         """Read a node meta data file"""
         
         try:
-            tree = ET.ElementTree(file=filename)
+            infile = open(filename, "rb")
+            try:
+                data = infile.read()
+            finally:
+                infile.close()
+
+            if get_meta_format(filename) == META_FORMAT_JSON:
+                return self._parse_attr_json(data)
+
+            # most files can skip building an ElementTree
+            attr = nodexml.parse_node_meta(data)
+            if attr is not None:
+                return attr
+
+            tree = ET.ElementTree(ET.fromstring(data))
         except Exception as e:
             #if recover:
             #    self._recover_attr(filename)
@@ -1079,6 +1995,141 @@ class NoteBookConnectionFS (NoteBookConnection):
         return attr
 
 
+    def _parse_attr_json(self, data):
+        """Parse the contents of a node.json meta data file"""
+        meta = json.loads(data.decode("utf-8"), 
+                          object_pairs_hook=load_json_dict)
+        attr = meta.get("attr", {})
+        version = meta.get("version")
+        if version:
+            attr["version"] = version
+        return attr
+
+
+    def _read_node_meta(self, path, recover=True):
+        """
+        Read the meta data of the node at 'path'
+
+        The pack is tried first, then the file of the current format, then
+        the files of the other formats.
+        """
+
+        key = None
+        if self._pack is not None:
+            key = self._get_pack_key(path)
+            attr = self._read_pack(key)
+            if attr is not None:
+                return attr
+
+        # a background conversion may replace the file while we look
+        meta_formats = (list(iter_meta_formats(self._meta_file_format)) + 
+                        [self._meta_file_format])
+        for meta_format in meta_formats:
+            try:
+                return self._read_attr(get_node_meta_file(path, meta_format),
+                                       recover)
+            except ConnectionError as e:
+                error = e
+                if not (isinstance(e.error, EnvironmentError) and 
+                        e.error.errno == errno.ENOENT):
+                    raise
+
+        # or move the node into the pack
+        if key is not None:
+            attr = self._read_pack(key)
+            if attr is not None:
+                return attr
+        raise error
+
+
+    def _read_pack(self, key):
+        """Read node meta data from the pack, or None if 'key' is missing"""
+        try:
+            data = self._pack.get(key)
+            return None if data is None else self._parse_attr_json(data)
+        except Exception as e:
+            raise ConnectionError(
+                _("Error reading meta data '%s' from pack") % key, e)
+
+
+    def migrate_meta_format(self):
+        """
+        Convert the meta data files of all nodes to the current format
+
+        Returns the number of files converted.  Safe to call from a
+        background thread while the notebook is in use: a node written in
+        the meantime keeps its newer file, and the index is updated so
+        that conversions are not taken for unmanaged changes.
+        """
+
+        count = 0
+        batch = []
+        paths = [self._filename]
+        while paths and not self._migrate_stop:
+            path = paths.pop()
+            try:
+                meta_format = self._get_node_meta_format(path)
+                if (meta_format is not None and 
+                    meta_format != self._meta_format):
+                    with self._migrate_lock:
+                        record = self._migrate_node_meta(path)
+                    if record is not None:
+                        batch.append(record)
+                paths.extend(self._iter_child_node_paths(path))
+            except Exception as e:
+                keepnote.log_error("error converting '%s'" % path)
+                continue
+
+            if len(batch) >= MIGRATE_BATCH_SIZE:
+                self._index.refresh_node_mtimes(batch)
+                count += len(batch)
+                batch = []
+
+        if batch:
+            self._index.refresh_node_mtimes(batch)
+            count += len(batch)
+        return count
+
+
+    def _migrate_node_meta(self, path):
+        """
+        Rewrite the meta data of the node at 'path' in the current format
+
+        Returns (nodeid, old mtime, new mtime) of the node directory, or
+        None if the node was written in the current format meanwhile.
+        """
+
+        mtime = get_path_mtime(path)
+        attr = maskdict.MaskDict(self._read_node_meta(path, recover=False),
+                                 self._attr_suppress)
+
+        if self._meta_format == META_FORMAT_PACK:
+            # a node written to the pack meanwhile keeps its entry
+            data = self._format_attr_json(attr).encode("utf-8")
+            if not self._pack.add(self._get_pack_key(path), data):
+                return None
+            self._remove_meta_files(path)
+            return attr.get("nodeid"), mtime, get_path_mtime(path)
+
+        filename2 = self._get_node_meta_file(path)
+        data = self._format_meta(filename2, attr)
+
+        # link the new file into place, so that it never replaces a file
+        # the connection has written
+        tmpfile = self._write_temp_file(filename2, data)
+        try:
+            os.link(tmpfile, filename2)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                return None
+            raise
+        finally:
+            os.remove(tmpfile)
+
+        self._remove_other_meta_files(filename2)
+        return attr.get("nodeid"), mtime, get_path_mtime(path)
+
+
     def _recover_attr(self, filename):
         
         if os.path.exists(filename):
@@ -1194,10 +2245,10 @@ class NoteBookConnectionFS (NoteBookConnection):
             raise UnknownFile("cannot file file '%s' '%s'" % (nodeid, filename))
 
         for filename in filenames:
-            if (filename != NODE_META_FILE and 
+            if (filename not in NODE_META_FILES.values() and 
                 not filename.startswith("__")):
                 fullname = os.path.join(path, filename)
-                if not os.path.exists(get_node_meta_file(fullname)):
+                if not self._is_node_path(fullname):
                     # ensure directory is not a node
                     
                     if os.path.isdir(fullname):
@@ -1282,6 +2333,8 @@ class NoteBookConnectionFS (NoteBookConnection):
         fn = self._get_index_file()
         if os.path.exists(os.path.dirname(fn)):
             self._index = notebook_index.NoteBookIndex(self, fn)
+            if self._use_background_fulltext:
+                self._index.enable_background_fulltext(True)
 
         
     def index_needed(self):
@@ -1290,7 +2343,7 @@ class NoteBookConnectionFS (NoteBookConnection):
     def clear_index(self):
         return self._index.clear()
 
-    def index_all(self):
+    def index_all(self, task=None):
         
         # clear memory cache too
         self._path_cache.clear()
@@ -1299,9 +2352,129 @@ class NoteBookConnectionFS (NoteBookConnection):
         # TODO: index orphans
         # may need private method to iterate orphans
 
-        for node in self._index.index_all():
+        for node in self._index.index_all(task=task):
             yield node
 
+    def _get_path_cache_file(self):
+        return os.path.join(self._filename, NOTEBOOK_META_DIR, 
+                            PATH_CACHE_FILE)
+
+
+    def _get_path_cache_header(self, rootid):
+        """Returns the state a path cache snapshot is valid for"""
+        return {"version": PATH_CACHE_VERSION,
+                "index_version": notebook_index.INDEX_VERSION,
+                "rootid": rootid,
+                "root_mtime": get_path_mtime(self._filename),
+                "index_mtime": self._index.get_node_mtime(rootid)}
+
+
+    def _open_path_cache(self):
+        """
+        Use the path cache snapshot saved by the last close()
+
+        The file is removed once read, so that a snapshot is only trusted
+        between a clean close() and the next connect().  The paths are
+        parsed on the first path cache miss, keeping only the nodes listed
+        in directories that are unchanged since.
+        """
+
+        filename = self._get_path_cache_file()
+        if not os.path.exists(filename):
+            return
+
+        try:
+            infile = codecs.open(filename, "r", "utf-8")
+            try:
+                header = json.loads(infile.readline())
+                data = infile.readline()
+            finally:
+                infile.close()
+                os.remove(filename)
+            valid = (self._index is not None and 
+                     not self._index.index_needed() and
+                     header == self._get_path_cache_header(header["rootid"]))
+        except Exception as e:
+            keepnote.log_error(e, sys.exc_info()[2])
+            valid = False
+
+        if not valid:
+            return
+
+        def load():
+            # a node is only restored if its parent directory is unchanged
+            # since the snapshot, so that it is still listed there.
+            # Directories store their mtime if their children were listed.
+            rows = []
+            paths = []
+            new_rows = []
+            for nodeid, parent_row, basename, mtime in json.loads(data):
+                if parent_row < 0:
+                    # the root is stored without its path
+                    path = basename = self._filename
+                    new_parent = -1
+                else:
+                    new_parent = new_rows[parent_row]
+                    if new_parent is None or not rows[new_parent][3]:
+                        paths.append(None)
+                        new_rows.append(None)
+                        continue
+                    path = os.path.join(paths[parent_row], basename)
+
+                try:
+                    complete = (mtime is not None and 
+                                get_path_mtime(path) == mtime)
+                except OSError:
+                    complete = False
+                paths.append(path)
+                new_rows.append(len(rows))
+                rows.append((nodeid, new_parent, basename, complete))
+            return rows
+
+        self._path_cache.set_snapshot(load)
+
+
+    def _save_path_cache(self):
+        """Save a snapshot of the path cache for the next connect()"""
+
+        if self._index is None or self._rootid is None:
+            return
+
+        filename = self._get_path_cache_file()
+        try:
+            rows = self._path_cache.get_snapshot(self._rootid)
+            if not rows:
+                return
+
+            # record the mtime of directories whose children were listed
+            paths = []
+            for i, (nodeid, parent_row, basename, complete) in \
+                    enumerate(rows):
+                if parent_row < 0:
+                    path = self._filename
+                    basename = ""
+                else:
+                    path = os.path.join(paths[parent_row], basename)
+                paths.append(path)
+                mtime = None
+                if complete:
+                    try:
+                        mtime = get_path_mtime(path)
+                    except OSError:
+                        pass
+                rows[i] = (nodeid, parent_row, basename, mtime)
+
+            out = safefile.open(filename, "w", codec="utf-8")
+            out.write(json.dumps(self._get_path_cache_header(self._rootid),
+                                 sort_keys=True))
+            out.write("\n")
+            out.write(json.dumps(rows, separators=(",", ":")))
+            out.write("\n")
+            out.close()
+        except Exception as e:
+            keepnote.log_error(e, sys.exc_info()[2])
+
+
     def _get_index_file(self):
 
         if self._index_file is not None:
@@ -1328,6 +2501,21 @@ class NoteBookConnectionFS (NoteBookConnection):
         elif query[0] == "compact":
             return self._index.compact()
 
+        elif query[0] == "fulltext_stats":
+            return self._index.get_fulltext_stats()
+
+        elif query[0] == "fulltext_pending":
+            return self._index.get_fulltext_pending()
+
+        elif query[0] == "wait_fulltext":
+            return self._index.wait_fulltext(*query[1:])
+
+        elif query[0] == "backfill_pending":
+            return self._index.get_backfill_pending()
+
+        elif query[0] == "wait_backfill":
+            return self._index.wait_backfill(*query[1:])
+
         else:
             return NoteBookConnection.index(self, query)
 
@@ -1350,14 +2538,33 @@ class NoteBookConnectionFS (NoteBookConnection):
                                                       index_value=index_value))
 
 
-    def search_node_titles(self, text):
+    def search_node_titles(self, text, limit=None):
         """Search nodes by title"""
-        return self._index.search_titles(text)
+        return self._index.search_titles(text, limit=limit)
 
     def search_node_contents(self, text):
         """Search nodes by content"""
         return self._index.search_contents(text)
 
+    def query_nodes(self, conditions, order_by=None, limit=None):
+        """Iterate over the nodeids of nodes matching an attribute query"""
+        return self._index.query(conditions, order_by=order_by, limit=limit)
+
+    def search_node_contents_ranked(self, text, limit=None, offset=0,
+                                    prefix=False):
+        """Search nodes by content, best matches first"""
+        results = self._index.search_contents_ranked(
+            text, limit=limit, offset=offset, prefix=prefix)
+        if results is None:
+            # no fulltext index, fall back to manual search
+            results = NoteBookConnection.search_node_contents_ranked(
+                self, text, limit=limit, offset=offset)
+        return results
+
+    def highlight_node_contents(self, nodeid, text, prefix=False):
+        """Returns the text of a node with search matches marked"""
+        return self._index.highlight_contents(nodeid, text, prefix=prefix)
+
 
     def has_fulltext_search(self):
         return self._index.has_fulltext_search()
@@ -1368,6 +2575,10 @@ class NoteBookConnectionFS (NoteBookConnection):
     def get_node_path_by_id(self, nodeid):
         """Lookup node by nodeid"""
         return self._index.get_node_path(nodeid)
+
+    def get_node_paths_by_id(self, nodeids):
+        """Lookup node paths for many nodeids"""
+        return self._index.get_node_paths(nodeids)
         
 
     def get_attr_by_id(self, nodeid, key):
@@ -26,9 +26,14 @@
 
 
 # python imports
+from concurrent import futures
+import contextlib
 from itertools import chain
+import codecs
 import os
+import queue
 import sys
+import threading
 import time
 import traceback
 
@@ -45,16 +50,246 @@ except Exception as e:
 # keepnote imports
 import keepnote
 import keepnote.notebook
-from keepnote.notebook.connection.index import AttrIndex, NodeIndex
+from keepnote.notebook.connection.index import \
+    AttrIndex, NodeIndex, MAX_QUERY_PARAMS
 
 
 # index filename
 INDEX_FILE = "index.sqlite"
-INDEX_VERSION = 3
+INDEX_VERSION = 6
+
+# parent key of the root node in NodeGraph (never assigned to a nodeid)
+UNIROOT_KEY = 0
+
+# recursive queries (WITH RECURSIVE) need sqlite 3.8.3
+_has_cte = (sqlite.sqlite_version_info >= (3, 8, 3))
+
+# maximum node depth followed by path queries (guards against parent loops)
+MAX_NODE_DEPTH = 1000
+
+# number of threads index_all() uses for reading node files
+INDEX_WORKERS = 4
+
+# number of nodes index_all() writes per index transaction
+INDEX_BATCH_SIZE = 1000
+
+# number of nodes index_all() writes per group of executemany() calls
+INDEX_WRITE_SIZE = 100
+
+# maximum number of nodes waiting for background fulltext indexing
+FULLTEXT_QUEUE_SIZE = 1000
+
+# maximum number of node texts written per background index transaction
+FULLTEXT_BATCH_SIZE = 100
+
+# seconds a search waits for background fulltext indexing to finish
+FULLTEXT_WAIT = 5.0
+
+# number of nodes written per attribute backfill transaction
+BACKFILL_BATCH_SIZE = 500
+
+# maximum number of idle read connections kept open for searches
+MAX_READ_CONNECTIONS = 4
 
 #=============================================================================
 
 
+def stat_page_file(filename):
+    """
+    Returns (mtime, size) of a page file, or (0.0, 0) if it does not exist
+    """
+    try:
+        stat = os.stat(filename)
+        return (stat.st_mtime, stat.st_size)
+    except OSError:
+        return (0.0, 0)
+
+
+def read_page_text(filename):
+    """Returns the plain text lines of a page file"""
+    try:
+        infile = codecs.open(filename, "r", "utf-8")
+        try:
+            return list(keepnote.notebook.read_data_as_plain_text(infile))
+        finally:
+            infile.close()
+    except Exception as e:
+        keepnote.log_error("error reading '%s'" % filename)
+        return []
+
+
+def read_node_record(conn, path):
+    """
+    Read everything needed for indexing the node stored at 'path'
+
+    Returns a tuple (attr, mtime, child_paths, text, stat) where 'text' is
+    a list of plain text lines of the node's page and 'stat' is the page's
+    (mtime, size).  Only the filesystem is accessed (never the index), so
+    it is safe to call from worker threads.
+    """
+    fs = keepnote.notebook.connection.fs
+
+    attr = conn._read_node_meta(path)
+    mtime = fs.get_path_mtime(path)
+    child_paths = list(conn._iter_child_node_paths(path))
+
+    filename = fs.get_node_filename(path, keepnote.notebook.PAGE_DATA_FILE)
+    stat = stat_page_file(filename)
+    text = read_page_text(filename) if stat[1] else []
+
+    return attr, mtime, child_paths, text, stat
+
+
+class FulltextIndexer (object):
+    """
+    Indexes node texts in a background thread
+
+    Nodes are queued with their title and page filename.  The indexer reads
+    and parses the pages, and writes their fulltext to the index in one
+    transaction per batch.
+    """
+
+    def __init__(self, index, maxsize=FULLTEXT_QUEUE_SIZE,
+                 batch_size=FULLTEXT_BATCH_SIZE):
+        self._index = index
+        self._batch_size = batch_size
+        self._queue = queue.Queue(maxsize)
+        self._thread = None
+
+
+    def start(self):
+        """Start the indexer thread"""
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def stop(self):
+        """Index all queued nodes and stop the indexer thread"""
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+
+    def is_running(self):
+        return self._thread is not None
+
+
+    def add(self, nodeid, title, filename):
+        """
+        Queue a node for indexing
+
+        Blocks while the queue is full.
+        """
+        self._queue.put((nodeid, title, filename))
+
+
+    def get_pending(self):
+        """Returns the number of nodes queued or being indexed"""
+        return self._queue.unfinished_tasks
+
+
+    def wait(self, timeout=None):
+        """
+        Wait until all queued nodes are indexed
+
+        Returns False if 'timeout' seconds passed first.
+        """
+        cond = self._queue.all_tasks_done
+        end = None if timeout is None else time.time() + timeout
+        with cond:
+            while self._queue.unfinished_tasks:
+                if end is None:
+                    cond.wait()
+                else:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        return False
+                    cond.wait(remaining)
+        return True
+
+
+    def _run(self):
+
+        running = True
+        while running:
+            # gather a batch, newest entry per node wins
+            batch = {}
+            count = 0
+            item = self._queue.get()
+            while True:
+                count += 1
+                if item is None:
+                    running = False
+                else:
+                    batch[item[0]] = item
+                if count >= self._batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            try:
+                self._index_batch(list(batch.values()))
+            except Exception as e:
+                keepnote.log_error(e, sys.exc_info()[2])
+            finally:
+                for i in range(count):
+                    self._queue.task_done()
+
+
+    def _index_batch(self, batch):
+        index = self._index
+        if not batch:
+            return
+
+        # stat pages before reading them, so that a later change is
+        # detected by its mtime
+        stats = dict((nodeid, stat_page_file(filename))
+                     for nodeid, title, filename in batch)
+
+        with index._write_lock:
+            con = index.con
+            if con is None:
+                # index was closed
+                return
+            cur = con.cursor()
+            keys = index.get_node_keys(
+                cur, [nodeid for nodeid, title, filename in batch])
+            states = dict((nodeid, index._get_text_state(cur, keys[nodeid])
+                           if nodeid in keys else None)
+                          for nodeid, title, filename in batch)
+
+        # read changed pages outside of the index lock
+        texts = {}
+        for nodeid, title, filename in batch:
+            stat = stats[nodeid]
+            if index._is_text_unchanged(states[nodeid], title, stat):
+                continue
+            texts[nodeid] = read_page_text(filename) if stat[1] else []
+
+        with index._write_lock:
+            if index.con is not con:
+                # index was closed or reset while reading
+                return
+            for nodeid, title, filename in batch:
+                if nodeid not in texts:
+                    index._fulltext_stats["skipped"] += 1
+                    continue
+
+                # skip nodes removed while their text was read
+                key = index._get_graph_key(cur, nodeid)
+                if key is None:
+                    continue
+                index._index_node_text(cur, key, {"title": title},
+                                       texts[nodeid], stat=stats[nodeid])
+            con.commit()
+            cur.close()
+
+
+
 # TODO: remove uniroot
 
 class NoteBookIndex (NodeIndex):
@@ -64,13 +299,29 @@ class NoteBookIndex (NodeIndex):
         NodeIndex.__init__(self, conn)
         self._index_file = index_file
         self._uniroot = keepnote.notebook.UNIVERSAL_ROOT
-        self.con = None     # sqlite connection
+        self.con = None     # sqlite connection (the only writer)
         self.cur = None     # sqlite cursor
 
+        # read connections for searches (with WAL journaling)
+        self._wal = False
+        self._read_cons = []      # all open read connections
+        self._read_idle = []      # read connections not in use
+        self._read_lock = threading.Lock()
+
+        # optional background fulltext indexing
+        self._use_indexer = False
+        self._indexer = None
+        self._write_lock = threading.RLock()
+
+        # filling of new attribute tables
+        self._backfill_thread = None
+        self._backfill_stop = False
+
 
         # index state/capabilities
         self._need_index = False
         self._corrupt = False
+        self.set_stat_fulltext_func(self._stat_node_page)
         
         # start index
         self.open()
@@ -91,15 +342,23 @@ class NoteBookIndex (NodeIndex):
                                       check_same_thread=False)
             self.cur = self.con.cursor()
             #self.con.execute(u"PRAGMA read_uncommitted = true;")
+            self._wal = self._init_journal()
 
             self.init_index(auto_clear=auto_clear)
         except sqlite.DatabaseError as e:
             self._on_corrupt(e, sys.exc_info()[2])
             raise
 
+        if self._use_indexer:
+            self._start_indexer()
+
 
     def close(self):
         """Close connection to index"""
+
+        self._stop_indexer()
+        self._stop_backfill()
+        self._close_readers()
         
         if self.con is not None:
             try:
@@ -117,14 +376,17 @@ class NoteBookIndex (NodeIndex):
 
         try:
             mtime = time.time()
-            self.con.execute("""UPDATE NodeGraph SET mtime = ? WHERE nodeid = ?;""",
-                             (mtime, self._nconn.get_rootid()))
-
-            if self.con is not None:
-                try:
-                    self.con.commit()
-                except:
-                    self.open()
+            with self._write_lock:
+                self.con.execute(
+                    """UPDATE NodeGraph SET mtime = ? WHERE id =
+                       (SELECT id FROM NodeIds WHERE nodeid = ?);""",
+                    (mtime, self._nconn.get_rootid()))
+
+                if self.con is not None:
+                    try:
+                        self.con.commit()
+                    except:
+                        self.open()
         except Exception as e:
             self._on_corrupt(e, sys.exc_info()[2])
 
@@ -134,11 +396,104 @@ class NoteBookIndex (NodeIndex):
 
         self.close()
         if self._index_file:
-            if os.path.exists(self._index_file):
-                os.remove(self._index_file)
+            for filename in (self._index_file, self._index_file + "-wal",
+                             self._index_file + "-shm"):
+                if os.path.exists(filename):
+                    os.remove(filename)
             self.open(auto_clear=False)
 
 
+    def _init_journal(self):
+        """
+        Switch the index to write-ahead logging
+
+        With WAL, searches read from their own connections (see _reader())
+        without waiting for, or blocking, commits of the writer connection.
+        Returns False if WAL is not available (e.g. on some network
+        filesystems), in which case searches share the writer connection.
+        """
+        try:
+            mode = self.con.execute("PRAGMA journal_mode = WAL;").fetchone()
+        except sqlite.DatabaseError as e:
+            mode = None
+        if mode is None or mode[0].lower() != "wal":
+            keepnote.log_message("index '%s' is not using WAL journaling\n" %
+                                 self._index_file)
+            return False
+
+        # WAL is durable across crashes with fewer syncs
+        self.con.execute("PRAGMA synchronous = NORMAL;")
+        return True
+
+
+    @contextlib.contextmanager
+    def _cursor(self):
+        """
+        Context for a cursor of the writer connection
+
+        Lookups that must see uncommitted changes use their own cursor,
+        since background threads write with self.cur under _write_lock.
+        """
+        with self._write_lock:
+            cur = self.con.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+
+
+    @contextlib.contextmanager
+    def _reader(self):
+        """
+        Context for a cursor that reads the index from any thread
+
+        Each concurrent reader gets a read-only connection of its own,
+        taken from a pool, and sees only committed changes.  Without WAL,
+        readers use a cursor of the writer connection.
+        """
+
+        if not self._wal:
+            cur = self.con.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+            return
+
+        with self._read_lock:
+            con = self._read_idle.pop() if self._read_idle else None
+        if con is None:
+            con = sqlite.connect(self._index_file, check_same_thread=False)
+            con.execute("PRAGMA query_only = ON;")
+            with self._read_lock:
+                self._read_cons.append(con)
+
+        cur = con.cursor()
+        try:
+            yield cur
+        finally:
+            cur.close()
+            with self._read_lock:
+                if con not in self._read_cons:
+                    # index was closed while reading
+                    con.close()
+                elif len(self._read_idle) < MAX_READ_CONNECTIONS:
+                    self._read_idle.append(con)
+                else:
+                    self._read_cons.remove(con)
+                    con.close()
+
+
+    def _close_readers(self):
+        """Close all read connections"""
+        with self._read_lock:
+            idle = self._read_idle
+            self._read_cons = []
+            self._read_idle = []
+        for con in idle:
+            con.close()
+
+
     #-----------------------------------------
     # index initialization and versioning
 
@@ -175,22 +530,28 @@ class NoteBookIndex (NodeIndex):
                 self._need_index = True
 
             
+            # a reindex of the whole notebook that did not finish leaves
+            # its marker behind, the rows it wrote are incomplete
+            con.execute("""CREATE TABLE IF NOT EXISTS Reindex
+                           (start_date DATE);""")
+            if con.execute("SELECT 1 FROM Reindex").fetchone():
+                self._need_index = True
+
+            # init attribute indexes and node keys
+            self.init_attrs(self.cur)
+
             # init NodeGraph table
+            # nodes and their parents are referred to by their keys in
+            # NodeIds, the index on parentid covers listing children
             con.execute("""CREATE TABLE IF NOT EXISTS NodeGraph 
-                           (nodeid TEXT,
-                            parentid TEXT,
+                           (id INTEGER PRIMARY KEY ON CONFLICT REPLACE,
+                            parentid INTEGER,
                             basename TEXT,
                             mtime FLOAT,
-                            symlink BOOLEAN,
-                            UNIQUE(nodeid) ON CONFLICT REPLACE);
+                            symlink BOOLEAN);
                         """)
-            con.execute("""CREATE INDEX IF NOT EXISTS IdxNodeGraphNodeid 
-                           ON NodeGraph (nodeid);""")
             con.execute("""CREATE INDEX IF NOT EXISTS IdxNodeGraphParentid 
-                           ON NodeGraph (parentid);""")
-            
-            # init attribute indexes
-            self.init_attrs(self.cur)
+                           ON NodeGraph (parentid, basename);""")
 
             con.commit()
 
@@ -242,6 +603,7 @@ class NoteBookIndex (NodeIndex):
         self.con.execute("DROP TABLE IF EXISTS NodeGraph")
         self.con.execute("DROP INDEX IF EXISTS IdxNodeGraphNodeid")
         self.con.execute("DROP INDEX IF EXISTS IdxNodeGraphParentid")
+        self.con.execute("DROP TABLE IF EXISTS Reindex")
         self.drop_attrs(self.cur)
         
 
@@ -258,41 +620,427 @@ class NoteBookIndex (NodeIndex):
 
 
     #-------------------------------------
-    # add/remove nodes from index
+    # background fulltext indexing
+
+    def enable_background_fulltext(self, enabled=True):
+        """
+        Index node texts in a background thread
+
+        Adding a node then only queues its text for indexing, so that
+        node reads and writes do not wait for pages to be parsed.  Searches
+        wait (up to FULLTEXT_WAIT seconds) for queued texts to be indexed.
+        """
+        self._use_indexer = enabled
+        if enabled and self.con is not None:
+            self._start_indexer()
+        elif not enabled:
+            self._stop_indexer()
+
+
+    def get_fulltext_pending(self):
+        """
+        Returns the number of nodes whose text is not indexed yet
+
+        While non-zero, fulltext search results may be stale.
+        """
+        if self._indexer is None:
+            return 0
+        return self._indexer.get_pending()
+
+
+    def wait_fulltext(self, timeout=None):
+        """
+        Wait for queued node texts to be indexed
+
+        Returns False if 'timeout' seconds passed first.
+        """
+        if self._indexer is None:
+            return True
+        return self._indexer.wait(timeout)
+
+
+    def _start_indexer(self):
+        if self._indexer is None:
+            self._indexer = FulltextIndexer(self)
+            self._indexer.start()
+
+
+    def _stop_indexer(self):
+        if self._indexer is not None:
+            self._indexer.stop()
+            self._indexer = None
+
+
+    def _queue_node_text(self, nodeid, attr):
+        """Queue the text of a node for background indexing"""
+
+        if not self._has_fulltext:
+            return
+        try:
+            filename = self._nconn.get_file(
+                nodeid, keepnote.notebook.PAGE_DATA_FILE)
+        except Exception:
+            return
+        self._indexer.add(nodeid, attr.get("title", ""), filename)
+
+
+    #-------------------------------------
+    # attribute indexing
+
+    def add_attr(self, attr):
+        """
+        Add indexing for a node attribute using AttrIndex
+
+        If the attribute's table is new, or its datatype changed, the values
+        of nodes already in the index are filled in by a background thread
+        (unless the whole index is rebuilt anyway).
+        """
+
+        with self._write_lock:
+            table_type = attr.get_table_type(self.cur)
+            if table_type is not None and table_type != attr.get_type():
+                attr.drop(self.cur)
+                table_type = None
+
+            NodeIndex.add_attr(self, attr)
+            if table_type is None and not self._need_index:
+                self.set_backfill_attr(self.cur, attr.get_name())
+            backfill = (not self._need_index and
+                        attr.get_name() in self.get_backfill_attrs(self.cur))
+            self.con.commit()
+
+        if backfill:
+            self._start_backfill()
+        return attr
 
-    # TODO: prevent "unmanaged change detected" warning when doing index_all()
-    # Also I think double indexing is occuring
 
-    def index_all(self, rootid=None):
+    def get_backfill_pending(self):
+        """
+        Returns the names of attributes whose tables are still being filled
+
+        Queries on these attributes may miss nodes.
+        """
+        with self._write_lock:
+            return self.get_backfill_attrs(self.cur)
+
+
+    def wait_backfill(self, timeout=None):
+        """
+        Wait for attribute tables to be filled
+
+        Returns False if 'timeout' seconds passed first.
+        """
+        thread = self._backfill_thread
+        if thread is not None:
+            thread.join(timeout)
+            return not thread.is_alive()
+        return True
+
+
+    def _start_backfill(self):
+        with self._write_lock:
+            if self._backfill_thread is None:
+                self._backfill_stop = False
+                root_path = self._nconn._get_node_path(
+                    self._nconn.get_rootid())
+                self._backfill_thread = threading.Thread(
+                    target=self._run_backfill, args=(root_path,))
+                self._backfill_thread.daemon = True
+                self._backfill_thread.start()
+
+
+    def _stop_backfill(self):
+        thread = self._backfill_thread
+        if thread is not None:
+            self._backfill_stop = True
+            thread.join()
+
+
+    def _run_backfill(self, root_path):
+
+        try:
+            while not self._backfill_stop:
+                with self._write_lock:
+                    names = [name for name in self.get_backfill_attrs(self.cur)
+                             if name in self._attrs]
+                if not names:
+                    break
+                self._backfill(root_path, names)
+        except Exception as e:
+            keepnote.log_error(e, sys.exc_info()[2])
+        finally:
+            with self._write_lock:
+                self._backfill_thread = None
+
+
+    def _backfill(self, root_path, names):
+        """Fill the tables of attributes 'names' from the node files"""
+
+        fs = keepnote.notebook.connection.fs
+        attrs = [self._attrs[name] for name in names]
+        start = time.time()
+        count = 0
+
+        # only the meta data files are read, not the pages
+        batch = []
+        paths = [root_path]
+        while paths and not self._backfill_stop:
+            path = paths.pop()
+            try:
+                attr = self._nconn._read_node_meta(path, recover=False)
+                paths.extend(self._nconn._iter_child_node_paths(path))
+            except Exception as e:
+                keepnote.log_error("error reading '%s'" % path)
+                continue
+
+            if "nodeid" in attr:
+                batch.append(attr)
+            if len(batch) >= BACKFILL_BATCH_SIZE:
+                self._write_backfill(attrs, batch)
+                count += len(batch)
+                batch = []
+
+        if self._backfill_stop:
+            return
+        self._write_backfill(attrs, batch)
+        count += len(batch)
+
+        with self._write_lock:
+            for name in names:
+                self.set_backfill_attr(self.cur, name, False)
+            self.con.commit()
+
+        keepnote.log_message("filled %d attribute tables for %d nodes "
+                             "in %f seconds\n" %
+                             (len(names), count, time.time() - start))
+
+
+    def _write_backfill(self, attrs, batch):
+        with self._write_lock:
+            cur = self.con.cursor()
+            for attr in batch:
+                nodeid = attr["nodeid"]
+                key = self._get_graph_key(cur, nodeid)
+                if key is None:
+                    continue
+                for attr_index in attrs:
+                    # values written since the backfill started are newer
+                    attr_index.backfill_node(cur, key, attr)
+            self.con.commit()
+
+
+    #-------------------------------------
+    # add/remove nodes from index
+
+    def index_all(self, rootid=None, task=None, nworkers=INDEX_WORKERS,
+                  batch_size=INDEX_BATCH_SIZE):
         """
         Reindex all nodes under 'rootid'
 
+        Node files are read and parsed by a pool of 'nworkers' threads,
+        while the calling thread writes their rows to the index in groups
+        of INDEX_WRITE_SIZE nodes, committing once every 'batch_size'
+        nodes.  If 'task' (tasklib.Task) is given,
+        progress and throughput are reported to it.
+
         This function returns an iterator which must be iterated to completion.
         """
-        
-        visit = set()
-        conn = self._nconn        
+
+        conn = self._nconn
         if rootid is None:
             rootid = conn.get_rootid()
-        
+        root_path = conn._get_node_path(rootid)
+        root_parentid = conn._get_parentid(rootid)
+
+        # a reindex of the whole notebook starts from an empty index so that
+        # stale rows are dropped and new rows need no replace checks
+        replace = (rootid != conn.get_rootid())
+        if not replace:
+            self._need_index = True
+            self._clear_rows()
+
+        if task:
+            task.set_message(("text", "Indexing notebook..."))
+
+        # limit the number of nodes held in memory between reading and writing
+        max_pending = max(nworkers, 1) * 16
+        waiting = [(root_parentid, root_path)]
+        pending = {}
+        pool = futures.ThreadPoolExecutor(max(nworkers, 1))
+        start = time.time()
+        count = 0
+        records = []
 
-        def preorder(conn, nodeid):
-            """Iterate through nodes in pre-order traversal"""
-            queue = [nodeid]
-            while len(queue) > 0:
-                nodeid = queue.pop()
-                yield nodeid
-                queue.extend(
-                    conn._list_children_nodeids(nodeid, _index=False))
+        try:
+            while waiting or pending:
+                # keep the workers busy
+                while waiting and len(pending) < max_pending:
+                    parentid, path = waiting.pop()
+                    future = pool.submit(read_node_record, conn, path)
+                    pending[future] = (parentid, path)
+
+                done, not_done = futures.wait(
+                    pending, return_when=futures.FIRST_COMPLETED)
+
+                for future in done:
+                    parentid, path = pending.pop(future)
+                    try:
+                        (attr, mtime, child_paths, text, 
+                         stat) = future.result()
+                    except Exception as e:
+                        keepnote.log_error("error reading '%s'" % path)
+                        continue
+
+                    record = self._make_node_record(
+                        parentid, path, attr, mtime, text, stat)
+                    nodeid = record[0]
+                    waiting.extend((nodeid, child_path)
+                                   for child_path in child_paths)
+
+                    records.append(record)
+                    if len(records) >= INDEX_WRITE_SIZE:
+                        self._add_node_records(records, replace)
+                        records = []
+
+                    count += 1
+                    if count % batch_size == 0:
+                        self._add_node_records(records, replace)
+                        records = []
+                        self.con.commit()
+                        if task:
+                            task.set_message(
+                                ("detail", "%d nodes (%.0f nodes/sec)" %
+                                 (count, count / (time.time() - start))))
+
+                    yield nodeid
 
+        finally:
+            for future in pending:
+                future.cancel()
+            pool.shutdown()
+            self._add_node_records(records, replace)
+            self.con.commit()
 
-        # perform indexing
-        # simply by walking through the tree, all nodes will index themselves
-        for nodeid in preorder(conn, rootid):
-            yield nodeid
+        keepnote.log_message("indexed %d nodes in %f seconds\n" %
+                             (count, time.time() - start))
+        if task:
+            task.set_message(("detail", "%d nodes indexed" % count))
 
         # record index complete
-        self._need_index = False
+        if not replace:
+            with self._write_lock:
+                self.con.execute("DELETE FROM Reindex")
+                self.con.commit()
+            self._need_index = False
+
+
+    def _make_node_record(self, parentid, path, attr, mtime, text,
+                          stat=None):
+        """
+        Prepare a node read by read_node_record() for writing to the index
+
+        Returns a tuple (nodeid, parentid, basename, attr, mtime, text, stat)
+        for _add_node_records().
+        """
+        conn = self._nconn
+        fs = keepnote.notebook.connection.fs
+
+        attr["parentids"] = ([parentid] if parentid else [])
+        if not conn._validate_attr(attr):
+            conn._write_node_meta(path, attr)
+
+        nodeid = attr["nodeid"]
+        basename = os.path.basename(path) if parentid else path
+        conn._path_cache.add(nodeid, basename, parentid)
+
+        if parentid is None:
+            parentid = self._uniroot
+            basename = ""
+        return (nodeid, parentid, basename, attr, mtime, text, stat)
+
+
+    def _add_node_records(self, records, replace=True):
+        """Write node records from _make_node_record() (no commit)"""
+
+        if not records:
+            return
+
+        with self._write_lock:
+            keys = self._add_graph_keys(
+                self.cur, chain((record[0] for record in records),
+                                (record[1] for record in records)))
+            self.cur.executemany(
+                """INSERT INTO NodeGraph VALUES (?, ?, ?, ?, ?)""",
+                [(keys[nodeid], keys[parentid], basename, mtime, False)
+                 for nodeid, parentid, basename, attr, mtime, text, stat
+                 in records])
+            self.add_nodes_attr(
+                self.cur, [(record[0], record[3]) for record in records],
+                fulltext=False, keys=keys)
+
+            if replace:
+                for nodeid, parentid, basename, attr, mtime, text, stat \
+                        in records:
+                    self._index_node_text(self.cur, keys[nodeid], attr, text,
+                                          replace=True, stat=stat)
+            else:
+                # a cleared index has no old texts to compare against
+                self._index_node_texts(
+                    self.cur, [(keys[nodeid], attr, text, stat)
+                               for nodeid, parentid, basename, attr, mtime,
+                                   text, stat in records])
+
+
+    def _add_graph_keys(self, cur, nodeids):
+        """
+        Returns a dict nodeid -> key for nodes and parents in NodeGraph,
+        assigning new keys where needed
+        """
+        keys = self.add_node_keys(
+            cur, (nodeid for nodeid in nodeids if nodeid != self._uniroot))
+        keys[self._uniroot] = UNIROOT_KEY
+        return keys
+
+
+    def _get_graph_key(self, cur, nodeid):
+        """Returns the key of a node in NodeGraph, or None"""
+        cur.execute("""SELECT g.id FROM NodeIds AS k
+                       JOIN NodeGraph AS g ON g.id = k.id
+                       WHERE k.nodeid = ?""", (nodeid,))
+        row = cur.fetchone()
+        return row[0] if row else None
+
+
+    def _get_parentid(self, parent_key, parentid):
+        """
+        Returns the nodeid of a parent from its key and its nodeid as
+        joined in from NodeIds
+        """
+        return self._uniroot if parent_key == UNIROOT_KEY else parentid
+
+
+    def _stat_node_page(self, nodeid):
+        """Returns (mtime, size) of the page file of a node"""
+        try:
+            filename = self._nconn.get_file(
+                nodeid, keepnote.notebook.PAGE_DATA_FILE)
+        except Exception:
+            return None
+        return stat_page_file(filename)
+
+
+    def _clear_rows(self):
+        """
+        Delete all nodes from the index, keeping its tables
+
+        The index is marked as needing a reindex, in the same transaction,
+        until index_all() completes.
+        """
+        with self._write_lock:
+            self.cur.execute("DELETE FROM Reindex")
+            self.cur.execute("INSERT INTO Reindex VALUES (datetime('now'))")
+            self.cur.execute("DELETE FROM NodeGraph")
+            self.clear_attrs(self.cur)
 
 
     def compact(self):
@@ -307,9 +1055,11 @@ class NoteBookIndex (NodeIndex):
     def get_node_mtime(self, nodeid):
         """Get the last indexed mtime for a node"""
         
-        self.cur.execute("""SELECT mtime FROM NodeGraph
-                             WHERE nodeid=?""", (nodeid,))
-        row = self.cur.fetchone()
+        with self._cursor() as cur:
+            cur.execute("""SELECT g.mtime FROM NodeIds AS k
+                           JOIN NodeGraph AS g ON g.id = k.id
+                           WHERE k.nodeid=?""", (nodeid,))
+            row = cur.fetchone()
         if row:
             return row[0]
         else:
@@ -321,10 +1071,35 @@ class NoteBookIndex (NodeIndex):
         if mtime is None:
             mtime = time.time()
 
-        self.cur.execute("""UPDATE NodeGraph SET mtime = ? WHERE nodeid = ?;""",
-                         (mtime, nodeid))
-        if commit:
+        with self._write_lock:
+            self.cur.execute(
+                """UPDATE NodeGraph SET mtime = ? WHERE id =
+                   (SELECT id FROM NodeIds WHERE nodeid = ?);""",
+                (mtime, nodeid))
+            if commit:
+                self.con.commit()
+
+
+    def refresh_node_mtimes(self, records):
+        """
+        Set the indexed mtime of nodes from (nodeid, old_mtime, mtime)
+        records, for nodes whose files changed without changing their attrs
+
+        A node is only updated if it was indexed at or after 'old_mtime',
+        so that any earlier change is still detected.  Safe to call from
+        other threads.
+        """
+        with self._write_lock:
+            if self.con is None:
+                return
+            cur = self.con.cursor()
+            cur.executemany(
+                """UPDATE NodeGraph SET mtime = ? WHERE mtime >= ? AND id =
+                   (SELECT id FROM NodeIds WHERE nodeid = ?);""",
+                ((mtime, old_mtime, nodeid) 
+                 for nodeid, old_mtime, mtime in records))
             self.con.commit()
+            cur.close()
 
 
     def get_mtime(self):
@@ -347,15 +1122,23 @@ class NoteBookIndex (NodeIndex):
                 basename = ""
             symlink = False
             
-            # update nodegraph
-            self.cur.execute(
-                """INSERT INTO NodeGraph VALUES (?, ?, ?, ?, ?)""", 
-                (nodeid, parentid, basename, mtime, symlink))
+            with self._write_lock:
+                # update nodegraph
+                keys = self._add_graph_keys(self.cur, [nodeid, parentid])
+                self.cur.execute(
+                    """INSERT INTO NodeGraph VALUES (?, ?, ?, ?, ?)""", 
+                    (keys[nodeid], keys[parentid], basename, mtime, symlink))
+
+                self.add_node_attr(self.cur, nodeid, attr,
+                                   fulltext=(self._indexer is None),
+                                   key=keys[nodeid])
+
+                if commit:
+                    self.con.commit()
 
-            self.add_node_attr(self.cur, nodeid, attr)
-            
-            if commit:
-                self.con.commit()
+            # queue outside of the lock, the indexer needs it to make room
+            if self._indexer is not None:
+                self._queue_node_text(nodeid, attr)
 
         except Exception as e:
             keepnote.log_error("error index node %s '%s'" % 
@@ -363,6 +1146,46 @@ class NoteBookIndex (NodeIndex):
             self._on_corrupt(e, sys.exc_info()[2])
 
 
+    def add_nodes(self, records, commit=True):
+        """
+        Add many nodes to the index in one transaction
+
+        'records' are (nodeid, parentid, basename, attr, mtime) tuples, as
+        the arguments of add_node().
+        """
+
+        if self.con is None:
+            return
+
+        records = [(nodeid, parentid, basename, attr, mtime) if parentid
+                   else (nodeid, self._uniroot, "", attr, mtime)
+                   for nodeid, parentid, basename, attr, mtime in records]
+        try:
+            with self._write_lock:
+                keys = self._add_graph_keys(
+                    self.cur, chain((record[0] for record in records),
+                                    (record[1] for record in records)))
+                self.cur.executemany(
+                    """INSERT INTO NodeGraph VALUES (?, ?, ?, ?, ?)""",
+                    [(keys[nodeid], keys[parentid], basename, mtime, False)
+                     for nodeid, parentid, basename, attr, mtime in records])
+                self.add_nodes_attr(
+                    self.cur, [(record[0], record[3]) for record in records],
+                    fulltext=(self._indexer is None), keys=keys)
+
+                if commit:
+                    self.con.commit()
+
+            # queue outside of the lock, the indexer needs it to make room
+            if self._indexer is not None:
+                for record in records:
+                    self._queue_node_text(record[0], record[3])
+
+        except Exception as e:
+            keepnote.log_error("error indexing %d nodes" % len(records))
+            self._on_corrupt(e, sys.exc_info()[2])
+
+
     def remove_node(self, nodeid, commit=True):
         """Remove node from index using nodeid"""
 
@@ -370,13 +1193,23 @@ class NoteBookIndex (NodeIndex):
             return
         
         try:
-            # delete node
-            self.cur.execute("DELETE FROM NodeGraph WHERE nodeid=?", (nodeid,))
-
-            self.remove_node_attr(self.cur, nodeid)
-
-            if commit:
-                self.con.commit()
+            with self._write_lock:
+                key = self.get_node_key(self.cur, nodeid)
+                if key is None:
+                    return
+
+                # delete node
+                self.cur.execute("DELETE FROM NodeGraph WHERE id=?", (key,))
+                self.remove_node_attr(self.cur, nodeid)
+
+                # keep the key while indexed children still refer to it
+                self.cur.execute("""DELETE FROM NodeIds WHERE id = ? AND
+                                    NOT EXISTS (SELECT 1 FROM NodeGraph
+                                                WHERE parentid = ?)""",
+                                 (key, key))
+
+                if commit:
+                    self.con.commit()
 
         except sqlite.DatabaseError as e:
             self._on_corrupt(e, sys.exc_info()[2])
@@ -391,130 +1224,297 @@ class NoteBookIndex (NodeIndex):
         
         # TODO: handle multiple parents
 
-        visit = set([nodeid])
-        path = []
-        parentid = None
+        rows = self._get_node_ancestors(nodeid)
+        if rows is None:
+            return None
+        return [row[0] for row in rows]
+
+
+    def get_node_filepath(self, nodeid):
+        """Get node path for a nodeid"""
+        
+        # TODO: handle multiple parents
+
+        rows = self._get_node_ancestors(nodeid)
+        if rows is None:
+            return None
+        return [row[2] for row in rows if row[2] != ""]
+
+
+    def get_node_paths(self, nodeids):
+        """
+        Get node paths for many nodeids at once
+
+        Returns a dict nodeid -> path.  The path is None for nodeids that
+        are not indexed.
+        """
+        
+        nodeids = list(nodeids)
+        paths = dict.fromkeys(nodeids)
+        if not _has_cte:
+            for nodeid in nodeids:
+                paths[nodeid] = self.get_node_path(nodeid)
+            return paths
 
         try:
-            while parentid != self._uniroot:
-                # continue to walk up parent
-                path.append(nodeid)
+            with self._cursor() as cur:
+                self._get_node_paths(cur, nodeids, paths)
+            return paths
+
+        except sqlite.DatabaseError as e:
+            self._on_corrupt(e, sys.exc_info()[2])
+            raise
 
-                self.cur.execute("""SELECT nodeid, parentid, basename
-                                FROM NodeGraph
-                                WHERE nodeid=?""", (nodeid,))
-                row = self.cur.fetchone()
 
-                # nodeid is not index
-                if row is None:
-                    return None
+    def _get_node_paths(self, cur, nodeids, paths):
+        """Fill 'paths' with the paths of 'nodeids' (see get_node_paths())"""
+        for i in range(0, len(nodeids), MAX_QUERY_PARAMS):
+            chunk = nodeids[i:i+MAX_QUERY_PARAMS]
+            cur.execute(
+                """WITH RECURSIVE Ancestors(start, id, parentid, depth)
+                   AS (SELECT k.nodeid, g.id, g.parentid, 0
+                       FROM NodeIds AS k
+                       JOIN NodeGraph AS g ON g.id = k.id
+                       WHERE k.nodeid IN (%s)
+                       UNION ALL
+                       SELECT a.start, g.id, g.parentid, a.depth + 1
+                       FROM NodeGraph AS g, Ancestors AS a
+                       WHERE g.id = a.parentid AND
+                             a.parentid != ? AND a.depth < ?)
+                   SELECT a.start, k.nodeid, a.parentid, a.depth
+                   FROM Ancestors AS a JOIN NodeIds AS k ON k.id = a.id
+                   ORDER BY a.start, a.depth DESC""" % 
+                ",".join("?" * len(chunk)),
+                chunk + [UNIROOT_KEY, MAX_NODE_DEPTH])
+
+            rows = []
+            for row in cur:
+                if rows and rows[-1][0] != row[0]:
+                    self._set_ancestor_path(paths, rows)
+                    rows = []
+                rows.append(row)
+            if rows:
+                self._set_ancestor_path(paths, rows)
+
+
+    def _set_ancestor_path(self, paths, rows):
+        """Record path of ancestor rows (start, nodeid, parent_key, depth)"""
+        if rows[0][2] == UNIROOT_KEY:
+            paths[rows[0][0]] = [row[1] for row in rows]
+        elif rows[0][3] >= MAX_NODE_DEPTH:
+            self._on_corrupt(Exception("unexpect parent path loop"))
+
+
+    def _get_node_ancestors(self, nodeid):
+        """
+        Returns rows (nodeid, parentid, basename) for a node and its 
+        ancestors, starting at the root.
 
-                nodeid, parentid, basename = row
+        Returns None if the path to the root is not fully indexed.
+        """
+
+        if not _has_cte:
+            return self._get_node_ancestors_walk(nodeid)
+
+        try:
+            with self._cursor() as cur:
+                rows = cur.execute(
+                    """WITH RECURSIVE Ancestors(id, parentid, basename, depth)
+                       AS (SELECT g.id, g.parentid, g.basename, 0
+                           FROM NodeIds AS k JOIN NodeGraph AS g ON g.id = k.id
+                           WHERE k.nodeid = ?
+                           UNION ALL
+                           SELECT g.id, g.parentid, g.basename, a.depth + 1
+                           FROM NodeGraph AS g, Ancestors AS a
+                           WHERE g.id = a.parentid AND
+                                 a.parentid != ? AND a.depth < ?)
+                       SELECT k.nodeid, a.parentid, a.basename, a.depth
+                       FROM Ancestors AS a JOIN NodeIds AS k ON k.id = a.id""",
+                    (nodeid, UNIROOT_KEY, MAX_NODE_DEPTH)).fetchall()
+            rows.sort(key=lambda row: -row[3])
                 
-                # parent has unexpected loop
-                if parentid in visit:
+            # nodeid is not index, or path does not reach root
+            if not rows or rows[0][1] != UNIROOT_KEY:
+                if rows and rows[0][3] >= MAX_NODE_DEPTH:
                     self._on_corrupt(Exception("unexpect parent path loop"))
-                    return None
-                
-                # walk up
-                nodeid = parentid
-
-            path.reverse()
-            return path
+                return None
+            
+            return self._make_ancestor_rows(rows)
 
         except sqlite.DatabaseError as e:
             self._on_corrupt(e, sys.exc_info()[2])
             raise
 
 
-    def get_node_filepath(self, nodeid):
-        """Get node path for a nodeid"""
-        
-        # TODO: handle multiple parents
+    def _get_node_ancestors_walk(self, nodeid):
+        """
+        Same as _get_node_ancestors(), but with one query per ancestor
+        (for sqlite versions without recursive queries)
+        """
 
-        visit = set([nodeid])
-        path = []
+        with self._cursor() as cur:
+            return self._walk_node_ancestors(cur, nodeid)
+
+
+    def _walk_node_ancestors(self, cur, nodeid):
+        """Walk up the ancestors of a node with the cursor 'cur'"""
+        visit = set()
+        rows = []
         parentid = None
+        key = self.get_node_key(cur, nodeid)
 
         try:
-            while parentid != self._uniroot:
+            while parentid != UNIROOT_KEY:
                 # continue to walk up parent
+                visit.add(key)
 
-                self.cur.execute("""SELECT nodeid, parentid, basename
-                                FROM NodeGraph
-                                WHERE nodeid=?""", (nodeid,))
-                row = self.cur.fetchone()
+                cur.execute("""SELECT k.nodeid, g.parentid, g.basename
+                               FROM NodeGraph AS g
+                               JOIN NodeIds AS k ON k.id = g.id
+                               WHERE g.id=?""", (key,))
+                row = cur.fetchone()
 
                 # nodeid is not index
                 if row is None:
                     return None
+                rows.append(row)
 
                 nodeid, parentid, basename = row
-                if basename != "":
-                    path.append(basename)
-
+                
                 # parent has unexpected loop
                 if parentid in visit:
                     self._on_corrupt(Exception("unexpect parent path loop"))
                     return None
                 
                 # walk up
-                nodeid = parentid
+                key = parentid
 
-            path.reverse()
-            return path
+            rows.reverse()
+            return self._make_ancestor_rows(rows)
 
         except sqlite.DatabaseError as e:
             self._on_corrupt(e, sys.exc_info()[2])
             raise
 
 
+    def _make_ancestor_rows(self, rows):
+        """
+        Returns rows (nodeid, parentid, basename) for rows
+        (nodeid, parent_key, basename, ...) ordered from the root down
+        """
+        parentid = self._uniroot
+        ancestors = []
+        for row in rows:
+            ancestors.append((row[0], parentid, row[2]))
+            parentid = row[0]
+        return ancestors
+
+
     def get_node(self, nodeid):
         """Get node data for a nodeid"""
         
         # TODO: handle multiple parents
 
         try:
-            self.cur.execute("""SELECT nodeid, parentid, basename, mtime
-                                FROM NodeGraph
-                                WHERE nodeid=?""", (nodeid,))
-            row = self.cur.fetchone()
+            with self._cursor() as cur:
+                cur.execute("""SELECT k.nodeid, g.parentid, p.nodeid,
+                                      g.basename, g.mtime
+                               FROM NodeIds AS k
+                               JOIN NodeGraph AS g ON g.id = k.id
+                               LEFT JOIN NodeIds AS p ON p.id = g.parentid
+                               WHERE k.nodeid=?""", (nodeid,))
+                row = cur.fetchone()
 
             # nodeid is not index
             if row is None:
                 return None
             
             return {"nodeid": row[0],
-                    "parentid": row[1],
-                    "basename": row[2],
-                    "mtime": row[3]}
+                    "parentid": self._get_parentid(row[1], row[2]),
+                    "basename": row[3],
+                    "mtime": row[4]}
+            
+        except sqlite.DatabaseError as e:
+            self._on_corrupt(e, sys.exc_info()[2])
+            raise
+
+
+    def get_nodeids_by_basename(self, basename):
+        """Returns the nodeids of the nodes indexed with 'basename'"""
+
+        try:
+            with self._cursor() as cur:
+                cur.execute("""SELECT k.nodeid
+                               FROM NodeGraph AS g
+                               JOIN NodeIds AS k ON k.id = g.id
+                               WHERE g.basename=?""", (basename,))
+                return [row[0] for row in cur.fetchall()]
             
         except sqlite.DatabaseError as e:
             self._on_corrupt(e, sys.exc_info()[2])
             raise
 
 
+    def list_node_skeletons(self, keys):
+        """
+        Iterate over all indexed nodes with a single query
+
+        Yields tuples (nodeid, parentid, basename, values), where 'values'
+        is a dict of the indexed values for attributes 'keys'.  Attributes
+        that are not indexed, or have no value for a node, are omitted.
+        """
+
+        keys = [key for key in keys if self.has_attr(key)]
+        columns = "".join(", a%d.value" % i for i in range(len(keys)))
+        joins = "".join(
+            " LEFT JOIN %s AS a%d ON a%d.id = g.id" %
+            (self.get_attr_index(key).get_table_name(), i, i)
+            for i, key in enumerate(keys))
+
+        # scanning in key order makes the joins sequential reads
+        try:
+            cur = self.con.cursor()
+            cur.execute("""SELECT k.nodeid, g.parentid, p.nodeid, g.basename%s
+                           FROM NodeGraph AS g
+                           JOIN NodeIds AS k ON k.id = g.id
+                           LEFT JOIN NodeIds AS p ON p.id = g.parentid%s
+                           ORDER BY g.id""" % (columns, joins))
+            for row in cur:
+                values = dict((key, value) for key, value in
+                              zip(keys, row[4:]) if value is not None)
+                yield (row[0], self._get_parentid(row[1], row[2]), row[3],
+                       values)
+            cur.close()
+
+        except sqlite.DatabaseError as e:
+            self._on_corrupt(e, sys.exc_info()[2])
+            raise
+
+
     def get_attr(self, nodeid, attr):
         """Return a nodes's attribute value"""
-        return self.get_node_attr(self.cur, nodeid, attr)
+        with self._cursor() as cur:
+            return self.get_node_attr(cur, nodeid, attr)
 
         
     def has_node(self, nodeid):
         """Returns True if index has node"""
-        self.cur.execute("""SELECT nodeid, parentid, basename, mtime
-                             FROM NodeGraph
-                             WHERE nodeid=?""", (nodeid,))
-        return self.cur.fetchone() is not None
+        with self._cursor() as cur:
+            return self._get_graph_key(cur, nodeid) is not None
 
 
     def list_children(self, nodeid):
         """List children indexed for node"""
 
         try:
-            self.cur.execute("""SELECT nodeid, basename
-                                FROM NodeGraph
-                                WHERE parentid=?""", (nodeid,))
-            return list(self.cur.fetchall())
+            with self._cursor() as cur:
+                cur.execute("""SELECT k.nodeid, g.basename
+                               FROM NodeGraph AS g
+                               JOIN NodeIds AS k ON k.id = g.id
+                               WHERE g.parentid =
+                                 (SELECT id FROM NodeIds WHERE nodeid = ?)""",
+                            (nodeid,))
+                return list(cur.fetchall())
             
         except sqlite.DatabaseError as e:
             self._on_corrupt(e, sys.exc_info()[2])
@@ -525,37 +1525,95 @@ class NoteBookIndex (NodeIndex):
         """Returns True if node has children"""
         
         try:
-            self.cur.execute("""SELECT nodeid
-                                FROM NodeGraph
-                                WHERE parentid=?""", (nodeid,))
-            return self.cur.fetchone() != None
+            with self._cursor() as cur:
+                cur.execute("""SELECT 1
+                               FROM NodeGraph
+                               WHERE parentid =
+                                 (SELECT id FROM NodeIds WHERE nodeid = ?)
+                               LIMIT 1""", (nodeid,))
+                return cur.fetchone() != None
             
         except sqlite.DatabaseError as e:
             self._on_corrupt(e, sys.exc_info()[2])
             raise
 
 
-    def search_titles(self, title):
-        """Search node titles"""
+    def search_titles(self, title, limit=None):
+        """Search node titles (may be called from any thread)"""
 
-        try:
-            return self.search_node_titles(self.cur, title)
-        except sqlite.DatabaseError as e:
-            self._on_corrupt(e, sys.exc_info()[2])
-            raise
+        with self._reader() as cur:
+            try:
+                return self.search_node_titles(cur, title, limit=limit)
+            except sqlite.DatabaseError as e:
+                self._on_corrupt(e, sys.exc_info()[2])
+                raise
 
 
-    def search_contents(self, text):
-        """Search node contents"""
+    def query(self, conditions, order_by=None, limit=None, offset=0):
+        """
+        Iterate over the nodeids of nodes matching an attribute query
+        (may be called from any thread)
+        """
 
-        cur = self.con.cursor()
-        try:
-            for res in self.search_node_contents(cur, text):
-                yield res            
-        except:
-            keepnote.log_error("SQLITE error while performing search")
-        finally:
-            cur.close()
+        with self._reader() as cur:
+            try:
+                for nodeid in self.query_nodes(
+                        cur, conditions, order_by=order_by, limit=limit,
+                        offset=offset):
+                    yield nodeid
+            except sqlite.DatabaseError as e:
+                self._on_corrupt(e, sys.exc_info()[2])
+                raise
+
+
+    def search_contents(self, text, wait=True):
+        """
+        Search node contents
+
+        If 'wait' is True, queued node texts are indexed first (waiting
+        at most FULLTEXT_WAIT seconds).
+        """
+
+        if wait:
+            self.wait_fulltext(FULLTEXT_WAIT)
+        with self._reader() as cur:
+            try:
+                for res in self.search_node_contents(cur, text):
+                    yield res            
+            except:
+                keepnote.log_error("SQLITE error while performing search")
+
+
+    def search_contents_ranked(self, text, limit=None, offset=0, 
+                               prefix=False, wait=True):
+        """
+        Search node contents, best matches first
+
+        Returns a list of (nodeid, score, snippet) tuples, or None if
+        fulltext search is not available.
+        """
+
+        if wait:
+            self.wait_fulltext(FULLTEXT_WAIT)
+        with self._reader() as cur:
+            try:
+                return self.search_node_contents_ranked(
+                    cur, text, limit=limit, offset=offset, prefix=prefix)
+            except sqlite.DatabaseError as e:
+                keepnote.log_error("SQLITE error while performing search")
+                return []
+
+
+    def highlight_contents(self, nodeid, text, prefix=False):
+        """Returns the text of a node with search matches highlighted"""
+
+        with self._reader() as cur:
+            try:
+                return self.highlight_node_contents(cur, nodeid, text, 
+                                                    prefix=prefix)
+            except sqlite.DatabaseError as e:
+                keepnote.log_error("SQLITE error while performing search")
+                return None
 
 
 
@@ -0,0 +1,144 @@
+"""
+
+    KeepNote
+    Fast reader for node meta data files (node.xml)
+
+"""
+
+#
+#  KeepNote
+#  Copyright (c) 2008-2011 Matt Rasmussen
+#  Author: Matt Rasmussen <rasmus@alum.mit.edu>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+"""
+Node meta data files are written by NoteBookConnectionFS._write_attr() in a
+fixed shape:
+
+  <?xml version="1.0" encoding="UTF-8"?>
+  <node>
+  <version>6</version>
+  <dict>
+    <key>nodeid</key><string>...</string>
+    <key>expanded</key><true/>
+    ...
+  </dict>
+  </node>
+
+Building an ElementTree of such a file and unmarshalling it with
+plist.load_etree() costs an Element per tag and a Python call per value.
+parse_node_meta() instead matches the whole file with a few regular
+expressions, when its <dict> holds only keys and scalar values.  Anything
+else (nested arrays or dicts, comments, CDATA, attributes, character
+references, other encodings, ...) returns None, and the caller parses the
+file with ElementTree as before.  Whatever the fast path accepts, it
+returns the same attrs as the ElementTree reader.
+"""
+
+
+# python imports
+import re
+import sys
+
+# keepnote imports
+from keepnote import plist
+
+
+# XML whitespace
+_S = "[ \t\r\n]*"
+
+_node_re = re.compile(
+    r'\A(?:<\?xml version="1\.0"(?: encoding="[Uu][Tt][Ff]-8")?\?>)?' + _S +
+    r'<node>' + _S +
+    r'<version>([0-9]+)</version>' + _S +
+    r'<dict>(.*)</dict>' + _S +
+    r'</node>' + _S + r'\Z', re.S)
+
+_PAIR = (r'<key>([^<]*)</key>' + _S +
+         r'(?:<(string|integer|real|true|false|null)>([^<]*)</\2>|'
+         r'<(string|true|false|null)/>)' + _S)
+_pair_re = re.compile(_PAIR)
+_dict_re = re.compile(_S + "(?:" + _PAIR + ")*")
+
+# text that an XML parser would reject or transform (newline normalization,
+# character and CDATA references)
+_unsafe_char_re = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\r\ufffe\uffff]")
+_unsafe_ref_re = re.compile("&(?!(?:amp|lt|gt|quot|apos);)")
+
+_entities = {"&amp;": "&", "&lt;": "<", "&gt;": ">",
+             "&quot;": '"', "&apos;": "'"}
+_entity_re = re.compile("&(?:amp|lt|gt|quot|apos);")
+
+
+def _unescape(text):
+    if "&" in text:
+        return _entity_re.sub(lambda m: _entities[m.group()], text)
+    return text
+
+
+def parse_node_meta(data):
+    """
+    Parse the contents (bytes) of a node meta data file
+
+    Returns the node attr dict, or None if the file is not in the plain
+    shape this reader handles.
+    """
+
+    try:
+        text = data.decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+
+    match = _node_re.match(text)
+    if match is None:
+        return None
+    body = match.group(2)
+    if (_dict_re.fullmatch(body) is None or
+        _unsafe_char_re.search(body) is not None or
+        "]]>" in body or
+        ("&" in body and _unsafe_ref_re.search(body) is not None)):
+        return None
+
+    intern = sys.intern
+    items = []
+    try:
+        for key, tag, value, empty_tag in _pair_re.findall(body):
+            key = intern(_unescape(key))
+            if empty_tag:
+                tag = empty_tag
+            if tag == "string":
+                value = _unescape(value)
+            elif tag == "integer":
+                value = int(value)
+            elif tag == "real":
+                value = float(value)
+            elif tag == "true":
+                value = True
+            elif tag == "false":
+                value = False
+            else:
+                value = None
+            items.append((key, value))
+    except ValueError:
+        # let the full parser report the error
+        return None
+
+    # same type and key order as plist.load_etree()
+    attr = plist.OrderDict(iter(items))
+    version = int(match.group(1))
+    if version:
+        attr["version"] = version
+    return attr
@@ -0,0 +1,454 @@
+"""
+
+    KeepNote
+    Pack file storage for node meta data
+
+"""
+
+#
+#  KeepNote
+#  Copyright (c) 2008-2011 Matt Rasmussen
+#  Author: Matt Rasmussen <rasmus@alum.mit.edu>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+"""
+A MetaPack keeps the meta data of many nodes in one append-only file,
+instead of one file per node directory.  Entries are keyed by the path of
+the node directory relative to the notebook ('' for the root, '/'
+separated).  The pack file is a header followed by records:
+
+  op (1 byte), key length, data length, crc32 (4 bytes each), key, data
+
+PUT stores data for a key, REMOVE drops a key, REMOVE_TREE drops a key and
+all keys beneath it, and MOVE renames a key and all keys beneath it to the
+key given as data.  Later records win, so writes only ever append.  The
+last MOVE is remembered (get_last_move()), so that a caller that renames
+directories after moving their keys can undo a move whose rename never
+happened.
+
+The offsets of the live entries are kept in memory and saved to an index
+file on close().  open() trusts the index for the part of the pack it
+covers and replays any records appended after it, so a crash only costs
+replaying the tail.  A torn record at the end of the pack is cut off.
+Space taken by replaced and removed entries is reclaimed by repack().
+"""
+
+
+# python imports
+import hashlib
+import json
+import os
+import struct
+import threading
+import uuid
+import zlib
+
+# keepnote imports
+import keepnote
+from keepnote import safefile
+
+
+PACK_VERSION = 1
+PACK_MAGIC = b"KNMPACK" + struct.pack(">B", PACK_VERSION)
+
+# record operations
+PUT = 1
+REMOVE = 2
+REMOVE_TREE = 3
+MOVE = 4
+
+_header = struct.Struct(">BIII")
+
+# repack() on close() once this fraction of the pack is unused...
+REPACK_RATIO = 0.5
+# ...and the pack is at least this large (bytes)
+REPACK_MIN_SIZE = 1 << 20
+
+
+class PackError (Exception):
+    pass
+
+
+def _in_tree(key, root):
+    """Returns True if 'key' is 'root' or beneath it"""
+    return (key == root or not root or
+            (key.startswith(root) and key[len(root)] == "/"))
+
+
+class MetaPack (object):
+    """Append-only store of node meta data keyed by node path"""
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._index_file = filename + ".idx"
+        self._file = None
+        self._packid = None
+        self._size = 0         # bytes of the pack file
+        self._garbage = 0      # bytes of records no longer needed
+        self._offsets = {}     # key -> (data offset, data length)
+        self._digests = {}     # key -> digest of data, for skipping writes
+        self._last_move = None # (old key, new key) of the last MOVE
+        self._lock = threading.RLock()
+
+
+    def open(self):
+        """Open the pack, creating it if needed"""
+        with self._lock:
+            if not os.path.exists(self._filename):
+                self._create(self._filename, uuid.uuid4().hex).close()
+            self._file = open(self._filename, "r+b")
+            try:
+                self._load()
+            except:
+                self._file.close()
+                self._file = None
+                raise
+
+
+    def close(self):
+        """Save the index and close the pack"""
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.close()
+            self._file = None
+            self._save_index()
+
+
+    def is_open(self):
+        return self._file is not None
+
+
+    def remove_files(self):
+        """Delete a closed pack and its index from disk"""
+        for filename in (self._filename, self._index_file):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+    #============================
+    # reading
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def has(self, key):
+        return key in self._offsets
+
+    def keys(self):
+        with self._lock:
+            return list(self._offsets)
+
+
+    def get(self, key):
+        """Returns the data stored for 'key', or None"""
+        with self._lock:
+            entry = self._offsets.get(key)
+            if entry is None:
+                return None
+            offset, length = entry
+            self._file.seek(offset)
+            data = self._file.read(length)
+            if len(data) != length:
+                raise PackError("pack entry '%s' is truncated" % key)
+            self._digests[key] = hashlib.sha1(data).digest()
+            return data
+
+
+    def get_last_move(self):
+        """Returns the (old key, new key) of the last MOVE, or None"""
+        return self._last_move
+
+
+    def get_stats(self):
+        """Returns a dict with the 'size' of the pack and the bytes of
+        'garbage' that repack() would reclaim"""
+        with self._lock:
+            return {"size": self._size, "garbage": self._garbage,
+                    "entries": len(self._offsets)}
+
+
+    def needs_repack(self):
+        with self._lock:
+            return (self._size >= REPACK_MIN_SIZE and
+                    self._garbage >= self._size * REPACK_RATIO)
+
+
+    #============================
+    # writing
+
+    def put(self, items):
+        """
+        Store (key, data) pairs with one write and fsync
+
+        Entries already holding the same data are skipped.  Returns the
+        number of entries written and the list of keys that were not in
+        the pack before.
+        """
+        with self._lock:
+            records = []
+            added = []
+            for key, data in items:
+                digest = hashlib.sha1(data).digest()
+                if key in self._offsets:
+                    if self._digests.get(key) == digest:
+                        continue
+                else:
+                    added.append(key)
+                records.append((PUT, key, data, digest))
+            self._append(records)
+            return len(records), added
+
+
+    def add(self, key, data):
+        """Store data for 'key' only if the key is not in the pack yet"""
+        with self._lock:
+            if key in self._offsets:
+                return False
+            self.put([(key, data)])
+            return True
+
+
+    def remove(self, key):
+        """Remove the entry of 'key', if any"""
+        with self._lock:
+            if key in self._offsets:
+                self._append([(REMOVE, key, b"", None)])
+
+
+    def remove_tree(self, key):
+        """Remove the entries of 'key' and of all keys beneath it"""
+        with self._lock:
+            if any(_in_tree(key2, key) for key2 in self._offsets):
+                self._append([(REMOVE_TREE, key, b"", None)])
+
+
+    def move(self, old_key, new_key):
+        """
+        Rename the entries of 'old_key' and of all keys beneath it
+
+        Returns True if any entries were moved.
+        """
+        with self._lock:
+            if any(_in_tree(key2, old_key) for key2 in self._offsets):
+                self._append([(MOVE, old_key, new_key.encode("utf-8"), None)])
+                return True
+            return False
+
+
+    def repack(self):
+        """Rewrite the pack with only its live entries"""
+        with self._lock:
+            tmpfile = self._filename + ".tmp"
+            packid = uuid.uuid4().hex
+            out = self._create(tmpfile, packid)
+            try:
+                offsets = {}
+                for key in sorted(self._offsets):
+                    data = self.get(key)
+                    offsets[key] = self._write_record(out, PUT, key, data)
+                out.flush()
+                os.fsync(out.fileno())
+                size = out.tell()
+            finally:
+                out.close()
+
+            self._file.close()
+            os.replace(tmpfile, self._filename)
+            self._file = open(self._filename, "r+b")
+            self._packid = packid
+            self._size = size
+            self._garbage = 0
+            self._offsets = offsets
+            self._save_index()
+
+
+    #============================
+    # pack file
+
+    def _create(self, filename, packid):
+        """Create an empty pack file, returns it open for writing"""
+        out = open(filename, "wb")
+        out.write(PACK_MAGIC + packid.encode("ascii"))
+        out.flush()
+        os.fsync(out.fileno())
+        return out
+
+
+    def _write_record(self, out, op, key, data):
+        """Write a record, returns the (offset, length) of its data"""
+        key = key.encode("utf-8")
+        crc = zlib.crc32(data, zlib.crc32(key)) & 0xffffffff
+        out.write(_header.pack(op, len(key), len(data), crc))
+        out.write(key)
+        offset = out.tell()
+        out.write(data)
+        return offset, len(data)
+
+
+    def _append(self, records):
+        """Append (op, key, data, digest) records and apply them"""
+        if not records:
+            return
+        out = self._file
+        out.seek(self._size)
+        start = self._size
+        try:
+            entries = [self._write_record(out, op, key, data)
+                       for op, key, data, digest in records]
+            out.flush()
+            os.fsync(out.fileno())
+        except:
+            # drop the partial records
+            out.truncate(start)
+            raise
+
+        self._size = out.tell()
+        for (op, key, data, digest), entry in zip(records, entries):
+            self._apply(op, key, data, entry, digest)
+
+
+    def _apply(self, op, key, data, entry, digest=None):
+        """Apply a record to the in-memory offsets"""
+
+        record_size = (_header.size + len(key.encode("utf-8")) +
+                       len(data))
+        if op == PUT:
+            old = self._offsets.get(key)
+            if old is not None:
+                self._garbage += self._get_record_size(key, old)
+            self._offsets[key] = entry
+            if digest is None:
+                self._digests.pop(key, None)
+            else:
+                self._digests[key] = digest
+            return
+
+        # all other records are garbage once applied
+        self._garbage += record_size
+        if op == REMOVE:
+            keys = [key] if key in self._offsets else []
+        else:
+            keys = [key2 for key2 in self._offsets if _in_tree(key2, key)]
+
+        if op == MOVE:
+            new_key = data.decode("utf-8")
+            self._last_move = (key, new_key)
+            moved = [(new_key + key2[len(key):], self._offsets.pop(key2),
+                      self._digests.pop(key2, None)) for key2 in keys]
+            for key2, entry2, digest2 in moved:
+                # the record of a moved entry still names its old key
+                self._offsets[key2] = entry2
+                if digest2 is not None:
+                    self._digests[key2] = digest2
+        else:
+            for key2 in keys:
+                self._garbage += self._get_record_size(
+                    key2, self._offsets.pop(key2))
+                self._digests.pop(key2, None)
+
+
+    def _get_record_size(self, key, entry):
+        # NOTE: moved entries are counted with their current key
+        return _header.size + len(key.encode("utf-8")) + entry[1]
+
+
+    def _load(self):
+        """Read the offsets from the index file and the pack"""
+
+        header = self._file.read(len(PACK_MAGIC) + 32)
+        if (len(header) != len(PACK_MAGIC) + 32 or
+            not header.startswith(PACK_MAGIC)):
+            raise PackError("'%s' is not a node meta data pack" %
+                            self._filename)
+        self._packid = header[len(PACK_MAGIC):].decode("ascii")
+        self._size = len(header)
+        self._garbage = 0
+        self._offsets = {}
+        self._digests = {}
+        self._last_move = None
+
+        self._load_index()
+        self._replay()
+
+
+    def _load_index(self):
+        """Use the saved index if it belongs to this pack"""
+        if not os.path.exists(self._index_file):
+            return
+        try:
+            infile = open(self._index_file, "rb")
+            try:
+                index = json.loads(infile.read().decode("utf-8"))
+            finally:
+                infile.close()
+            if (index["version"] != PACK_VERSION or
+                index["packid"] != self._packid or
+                index["size"] > os.path.getsize(self._filename)):
+                return
+            self._offsets = dict((key, tuple(entry)) for key, entry
+                                 in index["offsets"].items())
+            self._size = index["size"]
+            self._garbage = index["garbage"]
+            last_move = index.get("last_move")
+            self._last_move = tuple(last_move) if last_move else None
+        except Exception as e:
+            keepnote.log_message("ignoring pack index '%s': %s\n" %
+                                 (self._index_file, e))
+
+
+    def _replay(self):
+        """Apply the records after the indexed part of the pack"""
+
+        infile = self._file
+        infile.seek(self._size)
+        while True:
+            start = infile.tell()
+            header = infile.read(_header.size)
+            if not header:
+                break
+            if len(header) == _header.size:
+                op, keylen, datalen, crc = _header.unpack(header)
+                key = infile.read(keylen)
+                offset = infile.tell()
+                data = infile.read(datalen)
+            if (len(header) != _header.size or len(key) != keylen or
+                len(data) != datalen or op not in (PUT, REMOVE,
+                                                   REMOVE_TREE, MOVE) or
+                zlib.crc32(data, zlib.crc32(key)) & 0xffffffff != crc):
+                # a record torn by a crash, cut it off
+                keepnote.log_message(
+                    "truncating pack '%s' at %d bytes\n" %
+                    (self._filename, start))
+                infile.truncate(start)
+                break
+
+            self._apply(op, key.decode("utf-8"), data, (offset, datalen))
+            self._size = infile.tell()
+
+
+    def _save_index(self):
+        index = {"version": PACK_VERSION,
+                 "packid": self._packid,
+                 "size": self._size,
+                 "garbage": self._garbage,
+                 "last_move": self._last_move,
+                 "offsets": self._offsets}
+        out = safefile.open(self._index_file, "w", codec="utf-8")
+        try:
+            out.write(json.dumps(index, separators=(",", ":")))
+        finally:
+            out.close()
@@ -0,0 +1,332 @@
+"""
+
+    KeepNote
+    Watch a notebook directory for unmanaged changes (Linux inotify)
+
+"""
+
+#
+#  KeepNote
+#  Copyright (c) 2008-2011 Matt Rasmussen
+#  Author: Matt Rasmussen <rasmus@alum.mit.edu>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+"""
+Without a watcher, NoteBookConnectionFS stats a node's directory every time
+the node is read, in order to detect unmanaged changes (see the strategy
+notes in keepnote.notebook.connection.fs).
+
+A NodeWatcher keeps inotify watches on every node directory.  Once a
+directory has been checked against the index it is considered clean, and
+it stays clean (no more stats) until inotify reports a change within it.
+Paths that are not watched (e.g. while watches are still being installed,
+or while rescanning after the kernel event queue overflowed) are always
+reported dirty, so the connection safely falls back to the mtime check.
+"""
+
+
+# python imports
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+
+# keepnote imports
+import keepnote
+import keepnote.notebook
+
+
+# inotify constants (see <sys/inotify.h>)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF | IN_ONLYDIR)
+
+_EVENT_HEADER = struct.Struct("iIII")
+_READ_SIZE = 64 * 1024
+
+
+_libc = None
+
+def _get_libc():
+    """Returns libc with the inotify functions, or None if unavailable"""
+    global _libc
+
+    if _libc is None:
+        _libc = False
+        if sys.platform.startswith("linux"):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library("c") or
+                                   "libc.so.6", use_errno=True)
+                libc.inotify_init1
+                libc.inotify_add_watch
+                libc.inotify_rm_watch
+                _libc = libc
+            except (OSError, AttributeError):
+                pass
+    return _libc or None
+
+
+def is_available():
+    """Returns True if change watching is supported on this platform"""
+    return _get_libc() is not None
+
+
+def has_node_meta_file(path):
+    """
+    Returns True if 'path' has a node meta data file
+
+    Nodes in a meta data pack have none, so connections using a pack
+    pass their own 'is_node' to NodeWatcher.
+    """
+    return any(os.path.isfile(os.path.join(path, filename)) for filename in
+               keepnote.notebook.connection.fs.NODE_META_FILES.values())
+
+
+def iter_node_dirs(path, is_node=has_node_meta_file):
+    """Iterate through 'path' and all node directories beneath it"""
+    stack = [path]
+    while stack:
+        path = stack.pop()
+        yield path
+        try:
+            filenames = os.listdir(path)
+        except OSError:
+            continue
+        for filename in filenames:
+            if filename.startswith("__"):
+                continue
+            path2 = os.path.join(path, filename)
+            if is_node(path2):
+                stack.append(path2)
+
+
+class NodeWatcher (object):
+    """
+    Tracks which node directories have changed since they were last checked
+    """
+
+    def __init__(self, rootpath, is_node=has_node_meta_file):
+        self._rootpath = rootpath
+        self._is_node = is_node   # called from the watcher thread
+        self._fd = None
+        self._thread = None
+        self._running = False
+        self._lock = threading.Lock()
+
+        self._wd2path = {}   # watch descriptor -> path
+        self._path2wd = {}   # path -> watch descriptor
+        self._clean = set()  # watched paths unchanged since last check
+        self._overflow = False
+
+
+    def start(self):
+        """Start watching the notebook in a background thread"""
+
+        libc = _get_libc()
+        if libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+
+        fd = libc.inotify_init1(IN_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        self._fd = fd
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def stop(self):
+        """Stop watching the notebook"""
+        self._running = False
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+
+    def is_running(self):
+        return self._running
+
+
+    def check_dirty(self, path):
+        """
+        Returns True if 'path' may have changed since its last check
+
+        The path is then considered checked, until its next change.
+        """
+        path = os.path.normpath(path)
+        with self._lock:
+            if path in self._clean:
+                return False
+            if path in self._path2wd and not self._overflow:
+                self._clean.add(path)
+            return True
+
+
+    #=================================
+    # watcher thread
+
+    def _run(self):
+
+        try:
+            self._add_tree(self._rootpath)
+
+            while self._running:
+                readable = select.select([self._fd], [], [], 0.5)[0]
+                if readable:
+                    self._read_events()
+
+        except Exception as e:
+            keepnote.log_error(e, sys.exc_info()[2])
+
+        finally:
+            self._running = False
+            with self._lock:
+                self._clean.clear()
+                self._wd2path.clear()
+                self._path2wd.clear()
+            os.close(self._fd)
+            self._fd = None
+
+
+    def _add_watch(self, path):
+        path = os.path.normpath(path)
+        wd = _get_libc().inotify_add_watch(
+            self._fd, path.encode(sys.getfilesystemencoding()), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                # out of watches, behave as if nothing is watched
+                keepnote.log_message(
+                    "inotify watch limit reached, watching disabled\n")
+                self._running = False
+            return
+
+        with self._lock:
+            old = self._wd2path.get(wd)
+            if old is not None and old != path:
+                self._path2wd.pop(old, None)
+            self._wd2path[wd] = path
+            self._path2wd[path] = wd
+
+
+    def _add_tree(self, path):
+        for path2 in iter_node_dirs(path, self._is_node):
+            if not self._running:
+                break
+            self._add_watch(path2)
+
+
+    def _remove_tree(self, path):
+        """Forget watches for 'path' and all paths beneath it"""
+        prefix = path + os.path.sep
+        with self._lock:
+            for path2 in list(self._path2wd):
+                if path2 == path or path2.startswith(prefix):
+                    wd = self._path2wd.pop(path2)
+                    self._wd2path.pop(wd, None)
+                    self._clean.discard(path2)
+                    _get_libc().inotify_rm_watch(self._fd, wd)
+
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, _READ_SIZE)
+        except OSError as e:
+            if e.errno in (errno.EINTR, errno.EAGAIN):
+                return
+            raise
+
+        pos = 0
+        while pos + _EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, pos)
+            pos += _EVENT_HEADER.size
+            name = data[pos:pos+length].rstrip(b"\0")
+            pos += length
+            self._process_event(
+                wd, mask, name.decode(sys.getfilesystemencoding(), "replace"))
+
+
+    def _process_event(self, wd, mask, name):
+
+        if mask & IN_Q_OVERFLOW:
+            # events were lost, so every path must be checked again, and
+            # directories created meanwhile are not watched yet
+            keepnote.log_message("inotify queue overflow, rescanning\n")
+            with self._lock:
+                self._overflow = True
+                self._clean.clear()
+            self._add_tree(self._rootpath)
+            if self._running:
+                with self._lock:
+                    self._overflow = False
+            return
+
+        path = self._wd2path.get(wd)
+        if path is None:
+            return
+
+        if mask & IN_IGNORED:
+            with self._lock:
+                if self._path2wd.get(path) == wd:
+                    del self._path2wd[path]
+                self._wd2path.pop(wd, None)
+                self._clean.discard(path)
+            return
+
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            self._changed(path)
+            return
+
+        # a change within a node directory
+        self._changed(path)
+
+        if mask & IN_ISDIR and name and not name.startswith("__"):
+            path2 = os.path.join(path, name)
+            if mask & (IN_MOVED_FROM | IN_DELETE):
+                self._remove_tree(path2)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                # new directories may become nodes once their meta data
+                # file is written, so watch them right away
+                self._remove_tree(path2)
+                self._add_tree(path2)
+                self._changed(path2)
+
+
+    def _changed(self, path):
+        with self._lock:
+            self._clean.discard(path)
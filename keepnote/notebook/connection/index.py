@@ -26,7 +26,9 @@
 
 
 # python imports
+import hashlib
 from itertools import chain
+import time
 
 # import sqlite
 try:
@@ -41,11 +43,30 @@ except Exception as e:
 # keepnote imports
 import keepnote
 import keepnote.notebook
+from keepnote.notebook.connection import QueryError
 
 
 
 NULL = object()
 
+# markers placed around matched words in fulltext snippets
+SNIPPET_START = "<b>"
+SNIPPET_END = "</b>"
+SNIPPET_ELLIPSIS = "..."
+SNIPPET_WORDS = 16
+
+# pages modified this recently (seconds) are not trusted to be unchanged
+# when their mtime and size match, since a filesystem may record several
+# writes within the same mtime tick
+RACY_MTIME_WINDOW = 2.0
+
+# comparison operators of attribute queries
+QUERY_OPS = {"=": "=", "!=": "!=", "<": "<", "<=": "<=", ">": ">", ">=": ">=",
+             "like": "LIKE", "in": "IN"}
+
+# maximum number of nodeids passed to a single query
+MAX_QUERY_PARAMS = 500
+
 #=============================================================================
 
 
@@ -80,6 +101,11 @@ def read_data_as_plain_text(conn, nodeid):
         pass
 
 
+def hash_text(text):
+    """Returns a hash of the fulltext of a node"""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
 def test_fts3(cur, tmpname="fts3test"):
     """
     Returns True if fts3 extension is available
@@ -97,16 +123,77 @@ def test_fts3(cur, tmpname="fts3test"):
         return False
 
 
+def test_fts5(cur, tmpname="fts5test"):
+    """
+    Returns True if fts5 extension is available
+    """
+    try:
+        cur.execute("DROP TABLE IF EXISTS %s;" % tmpname)
+        cur.execute(
+            "CREATE VIRTUAL TABLE %s USING fts5(col);" % tmpname)
+        cur.execute("DROP TABLE %s;" % tmpname)
+        return True
+    except Exception as e:
+        return False
+
+
+def test_trigram(cur, tmpname="trigramtest"):
+    """
+    Returns True if the fts5 trigram tokenizer is available
+    """
+    try:
+        cur.execute("DROP TABLE IF EXISTS %s;" % tmpname)
+        cur.execute("CREATE VIRTUAL TABLE %s USING fts5(col, tokenize=trigram);"
+                    % tmpname)
+        cur.execute("DROP TABLE %s;" % tmpname)
+        return True
+    except Exception as e:
+        return False
+
+
+def escape_like(text, escape="\\"):
+    """Escape the wildcards of a LIKE pattern"""
+    return (text.replace(escape, escape + escape)
+                .replace("%", escape + "%")
+                .replace("_", escape + "_"))
+
+
+def make_fulltext_query(text, engine, prefix=False):
+    """
+    Convert search text into a MATCH expression for a fulltext engine
+
+    All words must match.  If 'prefix' is True, words also match as
+    prefixes (e.g. 'note' matches 'notebook').
+    """
+    # TODO: implement fully general fix
+    # crude cleaning
+    words = text.replace('"', "").split()
+
+    if engine == "fts5":
+        # quote words so that punctuation is not parsed as query syntax
+        suffix = "*" if prefix else ""
+        return " ".join('"%s"%s' % (word, suffix) for word in words)
+    else:
+        if prefix:
+            words = [word if word.endswith("*") else word + "*"
+                     for word in words]
+        return " ".join(words)
+
+
 #=============================================================================
 
 class AttrIndex (object):
-    """Indexing information for an attribute"""
+    """
+    Indexing information for an attribute
+
+    Nodes are identified by their integer keys in the NodeIds table
+    (see NodeIndex.get_node_key()).
+    """
 
     def __init__(self, name, type, index_value=False):
         self._name = name
         self._type = type
         self._table_name = "Attr_" + name
-        self._index_name = "IdxAttr_" + name + "_nodeid"
         self._index_value = index_value
         self._index_value_name = "IdxAttr_" + name + "_value"
 
@@ -114,20 +201,30 @@ class AttrIndex (object):
     def get_name(self):
         return self._name
 
+    def get_type(self):
+        return self._type
+
     def get_table_name(self):
         return self._table_name
 
+    def get_table_type(self, cur):
+        """
+        Returns the type of the value column of the attribute's table,
+        or None if the table does not exist
+        """
+        for row in cur.execute("PRAGMA table_info(%s);" % self._table_name):
+            if row[1] == "value":
+                return row[2]
+        return None
+
     def init(self, cur):
         """Initialize attribute index for database"""
 
+        # the node key is the rowid, so a value index also covers the key
         cur.execute("""CREATE TABLE IF NOT EXISTS %s
-                           (nodeid TEXT,
-                            value %s,
-                            UNIQUE(nodeid) ON CONFLICT REPLACE);
+                           (id INTEGER PRIMARY KEY ON CONFLICT REPLACE,
+                            value %s);
                         """ % (self._table_name, self._type))
-        cur.execute("""CREATE INDEX IF NOT EXISTS %s
-                           ON %s (nodeid);""" % (self._index_name,
-                                                 self._table_name))
 
         if self._index_value:
             cur.execute("""CREATE INDEX IF NOT EXISTS %s
@@ -138,22 +235,35 @@ class AttrIndex (object):
         cur.execute("DROP TABLE IF EXISTS %s" % self._table_name)
             
 
-    def add_node(self, cur, nodeid, attr):
+    def add_node(self, cur, key, attr):
         val = attr.get(self._name, NULL)
         if val is not NULL:
-            self.set(cur, nodeid, val)
+            self.set(cur, key, val)
+
+
+    def add_nodes(self, cur, records):
+        """Add many nodes given as (key, attr) pairs"""
+        name = self._name
+        self.set_many(cur, ((key, attr[name]) for key, attr in records
+                            if name in attr))
 
 
-    def remove_node(self, cur, nodeid):
+    def remove_node(self, cur, key):
         """Remove node from index"""
-        cur.execute("DELETE FROM %s WHERE nodeid=?" % self._table_name, 
-                    (nodeid,))
+        cur.execute("DELETE FROM %s WHERE id=?" % self._table_name, 
+                    (key,))
 
 
-    def get(self, cur, nodeid):
+    def remove_nodes(self, cur, keys):
+        """Remove many nodes from index"""
+        cur.executemany("DELETE FROM %s WHERE id=?" % self._table_name,
+                        ((key,) for key in keys))
+
+
+    def get(self, cur, key):
         """Get information for a node from the index"""
-        cur.execute("""SELECT value FROM %s WHERE nodeid = ?""" % 
-                    self._table_name, (nodeid,))
+        cur.execute("""SELECT value FROM %s WHERE id = ?""" % 
+                    self._table_name, (key,))
         values = [row[0] for row in cur.fetchall()]
 
         # return value
@@ -162,12 +272,34 @@ class AttrIndex (object):
         else:
             return values[0]
 
-    def set(self, cur, nodeid, value):
+    def get_node(self, cur, nodeid):
+        """Get information for a node from the index by its nodeid"""
+        cur.execute("""SELECT a.value FROM NodeIds AS k
+                       JOIN %s AS a ON a.id = k.id
+                       WHERE k.nodeid = ?""" % self._table_name, (nodeid,))
+        row = cur.fetchone()
+        return row[0] if row else None
+
+    def set(self, cur, key, value):
         """Set the information for a node in the index"""
 
         # insert new row
         cur.execute("""INSERT INTO %s VALUES (?, ?)""" % self._table_name,
-                        (nodeid, value))
+                        (key, value))
+
+    def set_many(self, cur, rows):
+        """Set the information for many (key, value) rows"""
+        cur.executemany("""INSERT INTO %s VALUES (?, ?)""" % self._table_name,
+                        rows)
+
+    def backfill_node(self, cur, key, attr):
+        """Add a node's value, unless the node already has a row"""
+        val = attr.get(self._name, NULL)
+        if val is not NULL:
+            cur.execute("""INSERT INTO %s SELECT ?, ? WHERE NOT EXISTS
+                           (SELECT 1 FROM %s WHERE id = ?)""" %
+                        (self._table_name, self._table_name),
+                        (key, val, key))
 
 
 class NodeIndex (object):
@@ -178,10 +310,15 @@ class NodeIndex (object):
     def __init__(self, conn):
         self._nconn = conn  # notebook connection
         self._attrs = {}    # attr indexes
+        self.cur = None     # sqlite cursor for updating attr tables
         self._has_fulltext = False
+        self._fulltext_engine = None  # "fts5", "fts3", or None
+        self._has_title_index = False
         self._use_fulltext = True
         self._open_node_fulltext = \
             lambda nodeid: read_data_as_plain_text(self._nconn, nodeid)
+        self._stat_node_fulltext = lambda nodeid: None
+        self._fulltext_stats = {"skipped": 0, "reindexed": 0}
 
 
     def set_conn(self, nconn):
@@ -190,7 +327,13 @@ class NodeIndex (object):
 
 
     def has_fulltext_search(self):
-        return self._has_fulltext
+        """Returns True if fulltext search is available and enabled"""
+        return self._has_fulltext and self._use_fulltext
+
+
+    def get_fulltext_engine(self):
+        """Returns the fulltext engine in use ('fts5', 'fts3', or None)"""
+        return self._fulltext_engine if self._has_fulltext else None
     
 
     def enable_fulltext_search(self, enabled):
@@ -199,6 +342,29 @@ class NodeIndex (object):
 
     def set_open_fulltext_func(self, func):
         self._open_node_fulltext = func
+
+
+    def set_stat_fulltext_func(self, func):
+        """
+        Set the function that returns (mtime, size) of the file a node's
+        fulltext is read from, or None if unknown
+
+        Nodes whose file and title are unchanged are not reindexed.
+        """
+        self._stat_node_fulltext = func
+
+
+    def get_fulltext_stats(self):
+        """
+        Returns counts of node texts that were skipped (unchanged) and
+        reindexed, since the last reset
+        """
+        return dict(self._fulltext_stats)
+
+
+    def reset_fulltext_stats(self):
+        for key in self._fulltext_stats:
+            self._fulltext_stats[key] = 0
     
 
     #===============================
@@ -210,6 +376,8 @@ class NodeIndex (object):
         self._attrs[attr.get_name()] = attr
         if self.cur:
             attr.init(self.cur)
+            if attr.get_name() == "title":
+                self._init_title_index(self.cur)
         return attr
 
     
@@ -227,41 +395,194 @@ class NodeIndex (object):
         return name in self._attrs
 
 
+    def get_backfill_attrs(self, cur):
+        """
+        Returns the names of attributes whose tables are still missing
+        values of existing nodes
+        """
+        return [name for (name,) in 
+                cur.execute("SELECT name FROM AttrBackfill;")]
+
+
+    def set_backfill_attr(self, cur, name, needed=True):
+        """Record whether an attribute's table needs backfilling"""
+        if needed:
+            cur.execute("INSERT INTO AttrBackfill VALUES (?);", (name,))
+        else:
+            cur.execute("DELETE FROM AttrBackfill WHERE name = ?;", (name,))
+
+
+    #===============================
+    # node keys
+
+    def get_node_key(self, cur, nodeid):
+        """
+        Returns the integer key of a node, or None if it has none
+
+        Index tables refer to nodes by these keys instead of their nodeids.
+        """
+        cur.execute("SELECT id FROM NodeIds WHERE nodeid = ?", (nodeid,))
+        row = cur.fetchone()
+        return row[0] if row else None
+
+
+    def add_node_key(self, cur, nodeid):
+        """Returns the integer key of a node, assigning a new one if needed"""
+        key = self.get_node_key(cur, nodeid)
+        if key is None:
+            cur.execute("INSERT INTO NodeIds (nodeid) VALUES (?)", (nodeid,))
+            key = cur.lastrowid
+        return key
+
+
+    def add_node_keys(self, cur, nodeids):
+        """
+        Returns a dict nodeid -> key for many nodes, assigning new keys
+        where needed
+        """
+        # new keys follow the order of 'nodeids', so that rows written in
+        # that order are appended to the tables
+        nodeids = list(dict.fromkeys(nodeids))
+        cur.executemany("INSERT OR IGNORE INTO NodeIds (nodeid) VALUES (?)",
+                        ((nodeid,) for nodeid in nodeids))
+        return self.get_node_keys(cur, nodeids)
+
+
+    def get_node_keys(self, cur, nodeids):
+        """Returns a dict nodeid -> key for the nodes that have keys"""
+        nodeids = list(nodeids)
+        keys = {}
+        for i in range(0, len(nodeids), MAX_QUERY_PARAMS):
+            chunk = nodeids[i:i+MAX_QUERY_PARAMS]
+            cur.execute("SELECT nodeid, id FROM NodeIds WHERE nodeid IN (%s)"
+                        % ",".join("?" * len(chunk)), chunk)
+            keys.update(cur.fetchall())
+        return keys
+
+
     #=============================
     # setup/drop attr tables
 
 
     def init_attrs(self, cur):
 
-        # full text table
-        if test_fts3(cur):
-            # create fulltext table if it does not already exist
-            if not list(cur.execute("""SELECT 1 FROM sqlite_master 
-                               WHERE name == 'fulltext';""")):
-                cur.execute("""CREATE VIRTUAL TABLE 
-                            fulltext USING 
-                            fts3(nodeid TEXT, content TEXT,
-                                 tokenize=porter);""")
+        # integer keys of nodeids
+        cur.execute("""CREATE TABLE IF NOT EXISTS NodeIds
+                       (id INTEGER PRIMARY KEY,
+                        nodeid TEXT NOT NULL UNIQUE);""")
+
+        # full text table, keyed by rowid
+        # use an existing table with the engine it was created with,
+        # otherwise prefer fts5 (ranking) and fall back to fts3
+        row = cur.execute("""SELECT sql FROM sqlite_master 
+                             WHERE name == 'fulltext';""").fetchone()
+        if row:
+            engine = "fts5" if "fts5" in row[0].lower() else "fts3"
+            self._has_fulltext = (test_fts5(cur) if engine == "fts5"
+                                  else test_fts3(cur))
+        elif test_fts5(cur):
+            engine = "fts5"
+            cur.execute("""CREATE VIRTUAL TABLE 
+                        fulltext USING 
+                        fts5(content, tokenize='porter unicode61');""")
+            self._has_fulltext = True
+        elif test_fts3(cur):
+            engine = "fts3"
+            cur.execute("""CREATE VIRTUAL TABLE 
+                        fulltext USING 
+                        fts3(content TEXT, tokenize=porter);""")
             self._has_fulltext = True
         else:
+            engine = None
             self._has_fulltext = False
+        self._fulltext_engine = engine
+
+        # source file state and text hash of each indexed node text
+        cur.execute("""CREATE TABLE IF NOT EXISTS FulltextState
+                       (id INTEGER PRIMARY KEY ON CONFLICT REPLACE,
+                        title TEXT,
+                        mtime FLOAT,
+                        size INTEGER,
+                        hash TEXT);""")
 
-        # TODO: make an Attr table
-        # this will let me query whether an attribute is currently being
-        # indexed and in what table it is in.
-        #con.execute(u"""CREATE TABLE IF NOT EXISTS AttrDefs
-        #               (attr TEXT,
-        #                type );
-        #            """)
+        # attributes whose tables are not yet filled for existing nodes
+        cur.execute("""CREATE TABLE IF NOT EXISTS AttrBackfill
+                       (name TEXT,
+                        UNIQUE(name) ON CONFLICT REPLACE);""")
 
         # initialize attribute tables
         for attr in self._attrs.values():
             attr.init(cur)
+        self._init_title_index(cur)
+
+
+    def _init_title_index(self, cur):
+        """
+        Index the substrings of titles
+
+        The fts5 table 'titles' indexes the trigrams of the values in the
+        title attr table, which triggers keep up to date.  Without trigram
+        support, titles are searched by scanning.
+        """
+
+        attr = self._attrs.get("title")
+        if attr is None or not test_trigram(cur):
+            self._has_title_index = False
+            return
+
+        table = attr.get_table_name()
+        exists = cur.execute("""SELECT 1 FROM sqlite_master 
+                                WHERE name == 'titles';""").fetchone()
+        cur.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS titles USING
+                       fts5(value, content='%s', content_rowid='rowid',
+                            tokenize=trigram);""" % table)
+
+        # titles are replaced (ON CONFLICT REPLACE) without delete triggers,
+        # so remove the old title before each insert
+        cur.execute("""CREATE TRIGGER IF NOT EXISTS %s_titles_bi
+                       BEFORE INSERT ON %s BEGIN
+                         INSERT INTO titles(titles, rowid, value)
+                           SELECT 'delete', rowid, value FROM %s
+                           WHERE id = new.id;
+                       END;""" % (table, table, table))
+        cur.execute("""CREATE TRIGGER IF NOT EXISTS %s_titles_ai
+                       AFTER INSERT ON %s BEGIN
+                         INSERT INTO titles(rowid, value)
+                           VALUES (new.rowid, new.value);
+                       END;""" % (table, table))
+        cur.execute("""CREATE TRIGGER IF NOT EXISTS %s_titles_ad
+                       AFTER DELETE ON %s BEGIN
+                         INSERT INTO titles(titles, rowid, value)
+                           VALUES ('delete', old.rowid, old.value);
+                       END;""" % (table, table))
+
+        # index titles already in the index
+        if not exists:
+            cur.execute("INSERT INTO titles(titles) VALUES ('rebuild');")
+
+        self._has_title_index = True
+
+
+    def clear_attrs(self, cur):
+        """Delete all rows from the attribute and fulltext tables"""
+
+        if self._has_fulltext:
+            cur.execute("DELETE FROM fulltext;")
+        cur.execute("DELETE FROM FulltextState;")
+        cur.execute("DELETE FROM AttrBackfill;")
+
+        for attr in self._attrs.values():
+            cur.execute("DELETE FROM %s;" % attr.get_table_name())
+        cur.execute("DELETE FROM NodeIds;")
 
 
     def drop_attrs(self, cur):
 
         cur.execute("DROP TABLE IF EXISTS fulltext;")
+        cur.execute("DROP TABLE IF EXISTS FulltextState;")
+        cur.execute("DROP TABLE IF EXISTS AttrBackfill;")
+        cur.execute("DROP TABLE IF EXISTS titles;")
+        cur.execute("DROP TABLE IF EXISTS NodeIds;")
         
         # drop attribute tables
         table_names = [x for (x,) in cur.execute(
@@ -274,31 +595,78 @@ class NodeIndex (object):
     #===============================
     # add/remove/get nodes from index
 
-    def add_node_attr(self, cur, nodeid, attr, fulltext=True):
+    def add_node_attr(self, cur, nodeid, attr, fulltext=True, key=None):
+        """
+        Index the attrs of a node
+
+        'key' is the node's key, if already known.
+        """
+
+        if key is None:
+            key = self.add_node_key(cur, nodeid)
 
         # update attrs
         for attrindex in self._attrs.values():
-            attrindex.add_node(cur, nodeid, attr)
+            attrindex.add_node(cur, key, attr)
 
         # update fulltext
-        if fulltext:
-            infile = self._open_node_fulltext(nodeid)
-            self._index_node_text(cur, nodeid, attr, infile)
+        if fulltext and self._has_fulltext:
+            self._update_node_text(cur, key, nodeid, attr)
+
+    def add_nodes_attr(self, cur, records, fulltext=True, keys=None):
+        """
+        Index the attrs of many nodes given as (nodeid, attr) pairs
+
+        Rows are written with one executemany() per attribute table.
+        'keys' is a dict nodeid -> key, if the keys are already known.  The
+        caller commits.
+        """
+
+        records = list(records)
+        if keys is None:
+            keys = self.add_node_keys(cur, [nodeid for nodeid, attr
+                                            in records])
+        keyed = [(keys[nodeid], attr) for nodeid, attr in records]
+        for attrindex in self._attrs.values():
+            attrindex.add_nodes(cur, keyed)
+
+        if fulltext and self._has_fulltext:
+            for nodeid, attr in records:
+                self._update_node_text(cur, keys[nodeid], nodeid, attr)
 
     def remove_node_attr(self, cur, nodeid):
+        """
+        Remove the attrs of a node from the index
+
+        The node keeps its key, since other rows may still refer to it.
+        """
+
+        key = self.get_node_key(cur, nodeid)
+        if key is None:
+            return
         
         # update attrs
         for attr in self._attrs.values():
-            attr.remove_node(cur, nodeid)
+            attr.remove_node(cur, key)
             
-        self._remove_text(cur, nodeid)
+        self._remove_text(cur, key)
 
+    def remove_nodes_attr(self, cur, nodeids):
+        """Remove the attrs of many nodes from the index"""
 
-    def get_node_attr(self, cur, nodeid, key):
+        keys = list(self.get_node_keys(cur, nodeids).values())
+        for attr in self._attrs.values():
+            attr.remove_nodes(cur, keys)
+
+        for key in keys:
+            self._remove_text(cur, key)
+
+
+    def get_node_attr(self, cur, nodeid, name):
         """Query indexed attribute for a node"""
-        attr = self._attrs.get(key, None)
+        attr = self._attrs.get(name, None)
         if attr:
-            return attr.get(cur, nodeid)
+            return attr.get_node(cur, nodeid)
         else:
             return None
 
@@ -309,21 +677,100 @@ class NodeIndex (object):
 
     def search_node_contents(self, cur, text):
 
-        # TODO: implement fully general fix
-        # crude cleaning
-        text = text.replace('"', "")
-
-        # fallback if fts3 is not available
+        # fallback if fulltext is not available
         if not self._has_fulltext or not self._use_fulltext:
-            words = [x.lower() for x in text.strip().split()]
+            words = [x.lower() for x in text.replace('"', "").strip().split()]
             return self.search_node_contents_manual(cur, words)
         
-        # search db with fts3
-        res = cur.execute("""SELECT nodeid FROM fulltext 
-                             WHERE content MATCH ?;""", (text,))
+        # search db with fts
+        query = make_fulltext_query(text, self._fulltext_engine)
+        if self._fulltext_engine == "fts5":
+            res = cur.execute("""SELECT k.nodeid FROM fulltext
+                                 JOIN NodeIds AS k ON k.id = fulltext.rowid
+                                 WHERE fulltext MATCH ?;""", (query,))
+        else:
+            res = cur.execute("""SELECT k.nodeid FROM fulltext
+                                 JOIN NodeIds AS k ON k.id = fulltext.rowid
+                                 WHERE content MATCH ?;""", (query,))
         return (row[0] for row in res)
 
 
+    def search_node_contents_ranked(self, cur, text, limit=None, offset=0,
+                                    prefix=False):
+        """
+        Search node contents, best matches first
+
+        Returns a list of (nodeid, score, snippet) tuples, where 'snippet'
+        is an excerpt of the matching text with matched words surrounded by
+        SNIPPET_START and SNIPPET_END.  Lower scores are better matches.
+        With fts3, results have no score (None) and are in index order.
+        Returns None if fulltext search is not available.
+        """
+
+        if not self._has_fulltext or not self._use_fulltext:
+            return None
+
+        query = make_fulltext_query(text, self._fulltext_engine, prefix)
+        if not query:
+            return []
+        if limit is None:
+            limit = -1
+
+        if self._fulltext_engine == "fts5":
+            cur.execute("""SELECT k.nodeid, bm25(fulltext),
+                                  snippet(fulltext, 0, ?, ?, ?, ?)
+                           FROM fulltext
+                           JOIN NodeIds AS k ON k.id = fulltext.rowid
+                           WHERE fulltext MATCH ?
+                           ORDER BY bm25(fulltext)
+                           LIMIT ? OFFSET ?;""",
+                        (SNIPPET_START, SNIPPET_END, SNIPPET_ELLIPSIS,
+                         SNIPPET_WORDS, query, limit, offset))
+        else:
+            cur.execute("""SELECT k.nodeid, NULL,
+                                  snippet(fulltext, ?, ?, ?, 0, ?)
+                           FROM fulltext
+                           JOIN NodeIds AS k ON k.id = fulltext.rowid
+                           WHERE content MATCH ?
+                           LIMIT ? OFFSET ?;""",
+                        (SNIPPET_START, SNIPPET_END, SNIPPET_ELLIPSIS,
+                         SNIPPET_WORDS, query, limit, offset))
+        return cur.fetchall()
+
+
+    def highlight_node_contents(self, cur, nodeid, text, prefix=False):
+        """
+        Returns the indexed text of a node with the words matching 'text'
+        surrounded by SNIPPET_START and SNIPPET_END
+
+        Returns None if the node does not match or fulltext search is
+        not available.
+        """
+
+        if not self._has_fulltext or not self._use_fulltext:
+            return None
+
+        query = make_fulltext_query(text, self._fulltext_engine, prefix)
+        if not query:
+            return None
+
+        if self._fulltext_engine == "fts5":
+            cur.execute("""SELECT highlight(fulltext, 0, ?, ?)
+                           FROM fulltext
+                           WHERE fulltext MATCH ? AND rowid = 
+                             (SELECT id FROM NodeIds WHERE nodeid = ?);""",
+                        (SNIPPET_START, SNIPPET_END, query, nodeid))
+        else:
+            # fts3 has no highlight(), use a snippet covering all words
+            cur.execute("""SELECT snippet(fulltext, ?, ?, '', 0, -64)
+                           FROM fulltext
+                           WHERE content MATCH ? AND rowid = 
+                             (SELECT id FROM NodeIds WHERE nodeid = ?);""",
+                        (SNIPPET_START, SNIPPET_END, query, nodeid))
+        row = cur.fetchone()
+        return row[0] if row else None
+
+
     def search_node_contents_manual(self, cur, words):
         """Recursively search nodes under node for occurrence of words"""
 
@@ -349,8 +796,14 @@ class NodeIndex (object):
             stack.extend(children)
 
 
-    def search_node_titles(self, cur, query):
-        """Return nodeids of nodes with matching titles"""
+    def search_node_titles(self, cur, query, limit=None):
+        """
+        Return (nodeid, title) of nodes whose titles contain 'query'
+
+        Matches are case-insensitive, and ordered by exact matches, prefix
+        matches, other matches, and then alphabetically.  At most 'limit'
+        results are returned.
+        """
 
         # TODO: can this be generalized?
         # similar to get_node_attr(nodeid, attr)
@@ -358,45 +811,264 @@ class NodeIndex (object):
         if not self.has_attr("title"):
             return []
 
-        # order titles by exact matches and then alphabetically
-        cur.execute(
-            """SELECT nodeid, value FROM %s WHERE value LIKE ?
-                           ORDER BY value != ?, value """ % 
-            self.get_attr_index("title").get_table_name(),
-            ("%" + query + "%", query))
+        table = self.get_attr_index("title").get_table_name()
+        order = """ORDER BY CASE WHEN a.value = ? COLLATE NOCASE THEN 0
+                                 WHEN a.value LIKE ? ESCAPE '\\' THEN 1
+                                 ELSE 2 END, a.value
+                   LIMIT ?"""
+        params = (query, escape_like(query) + "%",
+                  -1 if limit is None else limit)
+
+        if self._has_title_index and len(query) >= 3:
+            # trigram index lookup
+            cur.execute(
+                """SELECT k.nodeid, a.value FROM titles 
+                   JOIN %s AS a ON a.id = titles.rowid
+                   JOIN NodeIds AS k ON k.id = a.id
+                   WHERE titles MATCH ? """ % table + order,
+                ('"%s"' % query.replace('"', '""'),) + params)
+        else:
+            # queries shorter than a trigram need a scan
+            cur.execute(
+                """SELECT k.nodeid, a.value FROM %s AS a
+                   JOIN NodeIds AS k ON k.id = a.id
+                   WHERE a.value LIKE ? ESCAPE '\\' """ % table + order,
+                ("%" + escape_like(query) + "%",) + params)
 
         return list(cur.fetchall())
 
 
+    def compile_node_query(self, conditions, order_by=None, limit=None,
+                           offset=0):
+        """
+        Compile an attribute query into SQL
+
+        Each attribute in 'conditions' and 'order_by' is joined in from its
+        AttrIndex table on the node key, so only nodes that have all of these
+        attributes match.  Returns (sql, params).
+        """
+
+        tables = []
+        where = []
+        params = []
+        aliases = {}
+
+        def join(name):
+            attr = self._attrs.get(name)
+            if attr is None:
+                raise QueryError("attribute '%s' is not indexed" % name)
+            alias = aliases[name] = "a%d" % len(tables)
+            tables.append((attr.get_table_name(), alias))
+            return alias
+
+        for name, cond in sorted(conditions.items()):
+            alias = join(name)
+            if isinstance(cond, (list, tuple)):
+                if len(cond) != 2 or cond[0] not in QUERY_OPS:
+                    raise QueryError("bad condition for '%s': %s" % 
+                                     (name, repr(cond)))
+                op, value = cond
+            else:
+                op, value = "=", cond
+
+            if op == "in":
+                value = list(value)
+                where.append("%s.value IN (%s)" % 
+                             (alias, ",".join("?" * len(value))))
+                params.extend(value)
+            else:
+                where.append("%s.value %s ?" % (alias, QUERY_OPS[op]))
+                params.append(value)
+
+        order = outer_order = column = ""
+        if order_by:
+            desc = " DESC" if order_by.startswith("-") else ""
+            name = order_by.lstrip("-")
+            alias = aliases.get(name) or join(name)
+            column = ", %s.value AS value" % alias
+            order = " ORDER BY %s.value%s, %s.id" % (alias, desc, alias)
+            outer_order = " ORDER BY r.value%s, r.id" % desc
+
+        if not tables:
+            raise QueryError("query has no attributes")
+
+        # join all tables on the key of the first one
+        base = tables[0][1]
+        sql = "SELECT %s.id AS id%s FROM %s AS %s" % (
+            base, column, tables[0][0], base)
+        for table, alias in tables[1:]:
+            sql += " JOIN %s AS %s ON %s.id = %s.id" % (
+                table, alias, alias, base)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += order
+        if limit is not None or offset:
+            sql += " LIMIT ? OFFSET ?"
+            params.extend([-1 if limit is None else limit, offset])
+
+        # look up the nodeids of only the rows returned
+        sql = ("SELECT k.nodeid FROM (%s) AS r JOIN NodeIds AS k "
+               "ON k.id = r.id%s" % (sql, outer_order))
+
+        return sql, params
+
+
+    def query_nodes(self, cur, conditions, order_by=None, limit=None,
+                    offset=0):
+        """
+        Iterate over the nodeids matching an attribute query
+
+        See compile_node_query() and NoteBookConnection.query_nodes().
+        """
+        sql, params = self.compile_node_query(conditions, order_by=order_by,
+                                              limit=limit, offset=offset)
+        cur.execute(sql, params)
+        for row in cur:
+            yield row[0]
+
+
     #=================================
     # helper functions
 
 
-    def _index_node_text(self, cur, nodeid, attr, infile):
+    def _update_node_text(self, cur, key, nodeid, attr):
+        """Index the fulltext of a node, unless its source is unchanged"""
 
-        text = attr.get("title", "") + "\n" + "".join(infile)
-        self._insert_text(cur, nodeid, text)
+        title = attr.get("title", "")
+        stat = self._stat_node_fulltext(nodeid)
+        state = self._get_text_state(cur, key)
 
+        if self._is_text_unchanged(state, title, stat):
+            self._fulltext_stats["skipped"] += 1
+            return
+
+        infile = self._open_node_fulltext(nodeid)
+        self._index_node_text(cur, key, attr, infile, stat=stat,
+                              state=state)
+
+
+    def _is_text_unchanged(self, state, title, stat):
+        """
+        Returns True if a node's indexed text 'state' is known to be
+        current for its 'title' and page file 'stat'
+        """
+        return (state is not None and stat is not None and
+                state[0] == title and state[1] is not None and
+                (state[1], state[2]) == tuple(stat))
+
+
+    def _index_node_text(self, cur, key, attr, infile, replace=True,
+                         stat=None, state=NULL):
+        """
+        Index the fulltext of the node with key 'key' read from 'infile'
+
+        'stat' is the (mtime, size) of the file 'infile' was read from, as
+        taken before reading it.  'state' is the node's FulltextState row,
+        if already queried.  The fulltext is only rewritten if it changed.
+        """
 
-    def _insert_text(self, cur, nodeid, text):
-        
         if not self._has_fulltext:
             return
 
-        if list(cur.execute("SELECT 1 FROM fulltext WHERE nodeid = ?",
-                            (nodeid,))):
-            cur.execute("UPDATE fulltext SET content = ? WHERE nodeid = ?;",
-                        (text, nodeid))
+        title = attr.get("title", "")
+        text = title + "\n" + "".join(infile)
+        text_hash = hash_text(text)
+
+        if state is NULL:
+            state = self._get_text_state(cur, key) if replace else None
+
+        if state is not None and state[3] == text_hash:
+            self._fulltext_stats["skipped"] += 1
         else:
-            cur.execute("INSERT INTO fulltext VALUES (?, ?);",
-                        (nodeid, text))
+            self._insert_text(cur, key, text, replace=replace)
+            self._fulltext_stats["reindexed"] += 1
+
+        self._set_text_state(cur, key, title, stat, text_hash)
+
+
+    def _index_node_texts(self, cur, records):
+        """
+        Index the fulltext of many nodes that have no fulltext yet
+
+        'records' are (key, attr, infile, stat) tuples.  A node found in
+        several directories (e.g. a copied node directory) is indexed
+        once, with the text of its last record.
+        """
+
+        if not self._has_fulltext:
+            return
 
+        texts = {}
+        states = {}
+        for key, attr, infile, stat in records:
+            title = attr.get("title", "")
+            text = title + "\n" + "".join(infile)
+            texts[key] = text
+            states[key] = self._make_text_state(key, title, stat,
+                                                hash_text(text))
 
-    def _remove_text(self, cur, nodeid):
+        # an earlier batch may have indexed a copy of the same node
+        for key in texts:
+            if self._get_text_state(cur, key) is not None:
+                cur.execute("DELETE FROM fulltext WHERE rowid = ?;", (key,))
+
+        cur.executemany("INSERT INTO fulltext(rowid, content) VALUES (?, ?);",
+                        texts.items())
+        cur.executemany("INSERT INTO FulltextState VALUES (?, ?, ?, ?, ?);",
+                        states.values())
+        self._fulltext_stats["reindexed"] += len(texts)
+
+
+    def _get_text_state(self, cur, key):
+        """Returns (title, mtime, size, hash) of a node's indexed text"""
+        cur.execute("""SELECT title, mtime, size, hash FROM FulltextState
+                       WHERE id = ?""", (key,))
+        return cur.fetchone()
+
+
+    def _set_text_state(self, cur, key, title, stat, text_hash):
+        cur.execute("INSERT INTO FulltextState VALUES (?, ?, ?, ?, ?);",
+                    self._make_text_state(key, title, stat, text_hash))
+
+
+    def _make_text_state(self, key, title, stat, text_hash):
+        """Returns a FulltextState row"""
+
+        if stat is None:
+            mtime = size = None
+        else:
+            mtime, size = stat
+            if mtime and time.time() - mtime < RACY_MTIME_WINDOW:
+                # the file may still change within the same mtime,
+                # so compare hashes next time
+                mtime = None
+
+        return (key, title, mtime, size, text_hash)
+
+
+    def _insert_text(self, cur, key, text, replace=True):
+        """
+        Insert the fulltext for a node
+
+        If 'replace' is False, the node is assumed to have no fulltext yet.
+        """
         
         if not self._has_fulltext:
             return
 
-        cur.execute("DELETE FROM fulltext WHERE nodeid = ?", (nodeid,))
+        if replace and list(cur.execute(
+                "SELECT 1 FROM fulltext WHERE rowid = ?", (key,))):
+            cur.execute("UPDATE fulltext SET content = ? WHERE rowid = ?;",
+                        (text, key))
+        else:
+            cur.execute("INSERT INTO fulltext(rowid, content) VALUES (?, ?);",
+                        (key, text))
 
 
+    def _remove_text(self, cur, key):
+        
+        if not self._has_fulltext:
+            return
+
+        cur.execute("DELETE FROM fulltext WHERE rowid = ?", (key,))
+        cur.execute("DELETE FROM FulltextState WHERE id = ?", (key,))
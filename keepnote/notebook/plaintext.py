@@ -0,0 +1,251 @@
+"""
+
+    KeepNote
+    Plain text extraction from note pages
+
+"""
+
+#
+#  KeepNote
+#  Copyright (c) 2008-2011 Matt Rasmussen
+#  Author: Matt Rasmussen <rasmus@alum.mit.edu>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+"""
+Pages are converted in a single pass over large blocks of the file.  Only
+the few tags that matter (<body>, </body>, <script>, <style>) are located
+one by one; all other tags are stripped from the text between them with
+one regex split.  Text is yielded line by line, so memory use is
+bounded by the block size and MAX_CHUNK, not by the page size.
+"""
+
+
+# python imports
+import html
+import re
+
+
+# number of characters read from a page at a time
+BLOCK_SIZE = 64 * 1024
+
+# maximum length of a yielded chunk of text that has no newline
+MAX_CHUNK = 64 * 1024
+
+
+# tag patterns
+TAG_PATTERN = re.compile("<[^>]*>")
+BODY_START = re.compile(r"<body(?=[\s/>])[^>]*>", re.I)
+SPECIAL_TAG = re.compile(r"<(/body|script|style)(?=[\s/>])", re.I)
+SKIP_END = {"script": re.compile(r"</script\s*>", re.I),
+            "style": re.compile(r"</style\s*>", re.I)}
+
+# tags that end a line (pages are XHTML, so tag names are lower case).
+# They are replaced by BREAK, and then each run of breaks and whitespace
+# by one newline.
+BREAK_TAG = re.compile(
+    r"<(?:br|hr|/p|/div|/li|/h[1-6]|/tr|/td|/th|/pre|/blockquote)\b[^>]*>")
+BREAK = "\0"
+BREAK_RUN = re.compile(r"\0[\s\0]*")
+BREAK_TAIL = re.compile(r"\0[\s\0]*$")
+SPACE_RUN = re.compile(r"[\s\0]*")
+
+# entities written by the editor, decoded without html.unescape()
+COMMON_ENTITIES = (("&lt;", "<"), ("&gt;", ">"), ("&quot;", '"'),
+                   ("&nbsp;", "\xa0"), ("&amp;", "&"))
+
+
+# parser states
+BEFORE_BODY = 0
+IN_BODY = 1
+IN_SKIP = 2
+DONE = 3
+
+
+def unescape(text):
+    """Decode the entities in text"""
+    counts = [text.count(entity) for entity, char in COMMON_ENTITIES]
+    if sum(counts) < text.count("&"):
+        return html.unescape(text)
+
+    # only common entities, replace '&amp;' last
+    for (entity, char), count in zip(COMMON_ENTITIES, counts):
+        if count:
+            text = text.replace(entity, char)
+    return text
+
+
+class PlainTextParser (object):
+    """
+    Incremental converter of a note page (XHTML) to plain text
+
+    Only the text within <body> is kept.  Tags are removed, entities are
+    decoded, and the contents of <script> and <style> are dropped.
+    """
+
+    def __init__(self):
+        self._buf = ""        # unparsed input
+        self._pending = ""    # text of the current, incomplete line
+        self._state = BEFORE_BODY
+        self._skip_end = None
+        self._break = False   # text so far ends with a break tag
+
+
+    def is_done(self):
+        """Returns True once the end of the body has been parsed"""
+        return self._state == DONE
+
+
+    def feed(self, data):
+        """Parse more HTML and return a list of completed text chunks"""
+        if self._state == DONE:
+            return []
+        self._buf += data
+        return self._parse(False)
+
+
+    def close(self):
+        """Finish parsing and return the remaining text chunks"""
+        chunks = self._parse(True)
+        if self._state != DONE and self._pending:
+            chunks.append(self._pending)
+        self._pending = ""
+        self._state = DONE
+        return chunks
+
+
+    def _parse(self, final):
+        chunks = []
+        buf = self._buf
+        pos = 0
+
+        while pos < len(buf) and self._state != DONE:
+            if self._state == BEFORE_BODY:
+                m = BODY_START.search(buf, pos)
+                if m is None:
+                    pos = self._safe_end(buf, pos, final)
+                    break
+                pos = m.end()
+                self._state = IN_BODY
+
+            elif self._state == IN_BODY:
+                m = SPECIAL_TAG.search(buf, pos)
+                end = m.start() if m else self._safe_end(buf, pos, final)
+                self._add_text(buf[pos:end], chunks)
+                pos = end
+                if m is None:
+                    break
+
+                # wait for the rest of the tag
+                gt = buf.find(">", m.end())
+                if gt == -1:
+                    if final:
+                        pos = len(buf)
+                    break
+                pos = gt + 1
+
+                name = m.group(1).lower()
+                if name == "/body":
+                    chunks.append(self._pending)
+                    self._pending = ""
+                    self._state = DONE
+                elif not buf[gt-1] == "/":
+                    # skip contents of <script> and <style>
+                    self._skip_end = SKIP_END[name]
+                    self._state = IN_SKIP
+
+            elif self._state == IN_SKIP:
+                m = self._skip_end.search(buf, pos)
+                if m is None:
+                    # keep enough to match an end tag split between blocks
+                    pos = len(buf) if final else max(pos, len(buf) - 16)
+                    break
+                pos = m.end()
+                self._state = IN_BODY
+
+        self._buf = buf[pos:] if self._state != DONE else ""
+        return chunks
+
+
+    def _safe_end(self, buf, pos, final):
+        """
+        Returns the end of the text in buf[pos:] that can be parsed without
+        splitting a tag or an entity
+        """
+        end = len(buf)
+        if final:
+            return end
+
+        # incomplete tag
+        lt = buf.rfind("<", pos)
+        if lt != -1 and buf.find(">", lt) == -1:
+            end = lt
+
+        # incomplete entity
+        amp = buf.rfind("&", max(pos, end - 12), end)
+        if amp != -1 and buf.find(";", amp, end) == -1:
+            end = amp
+
+        # never hold back more than a chunk of text
+        if len(buf) - end > MAX_CHUNK:
+            end = len(buf)
+        return end
+
+
+    def _add_text(self, text, chunks):
+        """Convert text with tags into lines of plain text"""
+        if not text:
+            return
+
+        text = "".join(TAG_PATTERN.split(BREAK_TAG.sub(BREAK, text)))
+
+        # a run of breaks may continue from the last text
+        if self._break:
+            text = text[SPACE_RUN.match(text).end():]
+            if not text:
+                return
+        self._break = BREAK_TAIL.search(text) is not None
+        text = BREAK_RUN.sub("\n", text)
+
+        if "&" in text:
+            text = unescape(text)
+
+        lines = (self._pending + text).split("\n")
+        self._pending = lines.pop()
+        chunks.extend(line + "\n" for line in lines)
+
+        # split very long lines at a word boundary
+        while len(self._pending) > MAX_CHUNK:
+            i = self._pending.rfind(" ", 0, MAX_CHUNK) + 1 or MAX_CHUNK
+            chunks.append(self._pending[:i])
+            self._pending = self._pending[i:]
+
+
+def iter_plain_text(infile, block_size=BLOCK_SIZE):
+    """
+    Iterate over the plain text of the note page in file 'infile'
+
+    Text is yielded line by line, with line endings, in the order it
+    appears in the page.
+    """
+    parser = PlainTextParser()
+    while not parser.is_done():
+        data = infile.read(block_size)
+        if not data:
+            break
+        for chunk in parser.feed(data):
+            yield chunk
+    for chunk in parser.close():
+        yield chunk
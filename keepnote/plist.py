@@ -58,7 +58,7 @@ _unmarshallers = {
     "array": lambda x: [v.text for v in x],
     "dict": lambda x:
        OrderDict((x[i].text, x[i+1].text) for i in range(0, len(x), 2)),
-    "key": lambda x: x.text or "",
+    "key": lambda x: sys.intern(x.text or ""),
 
     # simple types
     "string": lambda x: x.text or "",
@@ -0,0 +1,103 @@
+"""
+
+    Benchmark for writing node attributes to the index.
+
+    Compares NodeIndex.add_nodes_attr(), which writes each attribute table
+    with one executemany(), against calling add_node_attr() for each node,
+    which executes one INSERT per attribute per node.  Both write all nodes
+    in one transaction.
+
+      KEEPNOTE_BENCH_NODES=100000 python test/attr_write_speed.py
+
+"""
+
+import os
+import sqlite3 as sqlite
+import time
+import unittest
+import uuid
+
+# keepnote imports
+from keepnote.notebook.connection.index import AttrIndex, NodeIndex
+
+from test.testing import *
+
+
+_index_dir = "test/tmp/attr_write_speed"
+NNODES = int(os.environ.get("KEEPNOTE_BENCH_NODES", 20000))
+
+
+def make_records(nnodes):
+    """Make (nodeid, attr) records with typical node attrs"""
+    return [(str(uuid.uuid4()),
+             {"title": "page %d" % i,
+              "content_type": "text/xhtml+xml",
+              "order": i % 20,
+              "icon": "note.png",
+              "created_time": 1300000000 + i,
+              "modified_time": 1300000000 + 2 * i})
+            for i in range(nnodes)]
+
+
+def make_index(filename):
+    """Make a NodeIndex with the default notebook attr tables"""
+    if os.path.exists(filename):
+        os.remove(filename)
+    con = sqlite.connect(filename)
+    cur = con.cursor()
+
+    index = NodeIndex(None)
+    index.enable_fulltext_search(False)
+    for name, datatype, index_value in [
+            ("title", "TEXT", True),
+            ("content_type", "TEXT", True),
+            ("order", "INTEGER", False),
+            ("icon", "TEXT", False),
+            ("created_time", "INTEGER", True),
+            ("modified_time", "INTEGER", True)]:
+        index.add_attr(AttrIndex(name, datatype, index_value=index_value))
+    index.init_attrs(cur)
+    con.commit()
+    return index, con, cur
+
+
+class AttrWriteSpeed (unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        clean_dir(_index_dir)
+        os.makedirs(_index_dir)
+        cls._records = make_records(NNODES)
+
+    def _time_write(self, name, write):
+        index, con, cur = make_index(os.path.join(_index_dir, name + ".sqlite"))
+        start = time.time()
+        write(index, cur, self._records)
+        con.commit()
+        t = time.time() - start
+
+        nrows = sum(con.execute("SELECT COUNT(*) FROM %s" %
+                                attr.get_table_name()).fetchone()[0]
+                    for attr in index._attrs.values())
+        con.close()
+
+        print("%-10s %8d rows  %8.3f seconds  %10.0f rows/sec" %
+              (name, nrows, t, nrows / t))
+        return t
+
+    def test_write(self):
+        def per_row(index, cur, records):
+            for nodeid, attr in records:
+                index.add_node_attr(cur, nodeid, attr, fulltext=False)
+
+        def bulk(index, cur, records):
+            index.add_nodes_attr(cur, records, fulltext=False)
+
+        print()
+        t1 = self._time_write("per-row", per_row)
+        t2 = self._time_write("bulk", bulk)
+        print("speedup: %.2fx" % (t1 / t2))
+
+
+if __name__ == "__main__":
+    test_main()
@@ -0,0 +1,219 @@
+"""
+
+    Benchmark for the size and lookup speed of the index schema.
+
+    Compares the current NoteBookIndex schema, where nodes are referred to
+    by integer keys, against the version 5 schema, where every table was
+    keyed by nodeid strings.  Both indexes hold the same tree of nodes with
+    typical attributes (no fulltext).
+
+      KEEPNOTE_BENCH_NODES=100000 python test/index_schema_speed.py
+
+"""
+
+import os
+import random
+import sqlite3 as sqlite
+import time
+import unittest
+import uuid
+
+# keepnote imports
+from keepnote.notebook import UNIVERSAL_ROOT
+from keepnote.notebook.connection.fs.index import NoteBookIndex
+from keepnote.notebook.connection.index import AttrIndex
+
+from test.testing import *
+
+
+_index_dir = "test/tmp/index_schema_speed"
+NNODES = int(os.environ.get("KEEPNOTE_BENCH_NODES", 20000))
+NLOOKUPS = 2000
+
+ATTRS = [("title", "TEXT", True),
+         ("content_type", "TEXT", True),
+         ("order", "INTEGER", False),
+         ("icon", "TEXT", False),
+         ("created_time", "INTEGER", True),
+         ("modified_time", "INTEGER", True)]
+
+
+def make_records(nnodes, fanout=20):
+    """Make (nodeid, parentid, basename, attr, mtime) records of a tree"""
+    records = []
+    for i in range(nnodes):
+        nodeid = str(uuid.uuid4())
+        if i == 0:
+            parentid = None
+        else:
+            parentid = records[(i - 1) // fanout][0]
+        attr = {"nodeid": nodeid,
+                "title": "page %d" % i,
+                "content_type": "text/xhtml+xml",
+                "order": i % fanout,
+                "icon": "note.png",
+                "created_time": 1300000000 + i,
+                "modified_time": 1300000000 + 2 * i}
+        records.append((nodeid, parentid, "page %d" % i, attr, 1300000000.0))
+    return records
+
+
+def make_index_v5(filename, records):
+    """Write records to an index with the version 5 schema"""
+    con = sqlite.connect(filename)
+    con.execute("""CREATE TABLE NodeGraph
+                   (nodeid TEXT, parentid TEXT, basename TEXT, mtime FLOAT,
+                    symlink BOOLEAN, UNIQUE(nodeid) ON CONFLICT REPLACE);""")
+    con.execute("CREATE INDEX IdxNodeGraphNodeid ON NodeGraph (nodeid);")
+    con.execute("CREATE INDEX IdxNodeGraphParentid ON NodeGraph (parentid);")
+    for name, datatype, index_value in ATTRS:
+        con.execute("""CREATE TABLE Attr_%s (nodeid TEXT, value %s,
+                       UNIQUE(nodeid) ON CONFLICT REPLACE);""" %
+                    (name, datatype))
+        con.execute("CREATE INDEX IdxAttr_%s_nodeid ON Attr_%s (nodeid);" %
+                    (name, name))
+        if index_value:
+            con.execute("CREATE INDEX IdxAttr_%s_value ON Attr_%s (value);" %
+                        (name, name))
+
+    con.executemany("INSERT INTO NodeGraph VALUES (?, ?, ?, ?, ?);",
+                    [(nodeid, parentid or UNIVERSAL_ROOT, basename, mtime,
+                      False)
+                     for nodeid, parentid, basename, attr, mtime in records])
+    for name, datatype, index_value in ATTRS:
+        con.executemany("INSERT INTO Attr_%s VALUES (?, ?);" % name,
+                        [(record[0], record[3][name]) for record in records])
+    con.commit()
+    return con
+
+
+def make_index(filename, records):
+    """Write records to an index with the current schema"""
+    index = NoteBookIndex(None, filename)
+    index.set_stat_fulltext_func(lambda nodeid: None)
+    index.set_open_fulltext_func(lambda nodeid: [])
+    for name, datatype, index_value in ATTRS:
+        index.add_attr(AttrIndex(name, datatype, index_value=index_value))
+    index.add_nodes(records)
+    return index
+
+
+def get_node_path_v5(con, nodeid):
+    rows = con.execute(
+        """WITH RECURSIVE Ancestors(nodeid, parentid, depth)
+           AS (SELECT nodeid, parentid, 0 FROM NodeGraph WHERE nodeid = ?
+               UNION ALL
+               SELECT g.nodeid, g.parentid, a.depth + 1
+               FROM NodeGraph AS g, Ancestors AS a
+               WHERE g.nodeid = a.parentid AND a.parentid != ?)
+           SELECT nodeid FROM Ancestors ORDER BY depth DESC""",
+        (nodeid, UNIVERSAL_ROOT)).fetchall()
+    return [row[0] for row in rows]
+
+
+def list_children_v5(con, nodeid):
+    return con.execute("SELECT nodeid, basename FROM NodeGraph "
+                       "WHERE parentid = ?", (nodeid,)).fetchall()
+
+
+def get_attr_v5(con, nodeid, name):
+    row = con.execute("SELECT value FROM Attr_%s WHERE nodeid = ?" % name,
+                      (nodeid,)).fetchone()
+    return row[0] if row else None
+
+
+def list_node_skeletons_v5(con, keys):
+    columns = "".join(", a%d.value" % i for i in range(len(keys)))
+    joins = "".join(" LEFT JOIN Attr_%s AS a%d ON a%d.nodeid = g.nodeid" %
+                    (key, i, i) for i, key in enumerate(keys))
+    for row in con.execute("SELECT g.nodeid, g.parentid, g.basename%s "
+                           "FROM NodeGraph AS g%s" % (columns, joins)):
+        values = dict((key, value) for key, value in zip(keys, row[3:])
+                      if value is not None)
+        yield row[0], row[1], row[2], values
+
+
+def query_v5(con, created_time, limit):
+    return [row[0] for row in con.execute(
+        """SELECT a0.nodeid FROM Attr_created_time AS a0
+           JOIN Attr_title AS a1 ON a1.nodeid = a0.nodeid
+           WHERE a0.value > ? ORDER BY a1.value, a1.nodeid LIMIT ?""",
+        (created_time, limit))]
+
+
+class IndexSchemaSpeed (unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        clean_dir(_index_dir)
+        os.makedirs(_index_dir)
+        cls._records = make_records(NNODES)
+        random.seed(0)
+        cls._lookups = [record[0] for record in
+                        random.sample(cls._records,
+                                      min(NLOOKUPS, len(cls._records)))]
+
+    def _time_lookups(self, name, get_node_path, list_children, get_attr):
+        start = time.time()
+        for nodeid in self._lookups:
+            path = get_node_path(nodeid)
+            list_children(nodeid)
+            get_attr(nodeid, "title")
+        t = time.time() - start
+        self.assertEqual(path[-1], nodeid)
+        print("%-10s %8d lookups  %8.3f seconds  %8.1f usec/lookup" %
+              (name, len(self._lookups), t, 1e6 * t / len(self._lookups)))
+        return t
+
+    def _time(self, name, func, repeat=3):
+        start = time.time()
+        for i in range(repeat):
+            result = func()
+        t = (time.time() - start) / repeat
+        print("%-10s %8d rows  %8.3f seconds" % (name, len(result), t))
+        return t
+
+    def test_schema(self):
+        filename_v5 = os.path.join(_index_dir, "index_v5.sqlite")
+        filename = os.path.join(_index_dir, "index.sqlite")
+
+        con = make_index_v5(filename_v5, self._records)
+        index = make_index(filename, self._records)
+        size_v5 = os.path.getsize(filename_v5)
+        size = os.path.getsize(filename)
+
+        print()
+        print("%-10s %8d nodes  %10d bytes" % ("v5", NNODES, size_v5))
+        print("%-10s %8d nodes  %10d bytes" % ("current", NNODES, size))
+        t1 = self._time_lookups(
+            "v5", lambda nodeid: get_node_path_v5(con, nodeid),
+            lambda nodeid: list_children_v5(con, nodeid),
+            lambda nodeid, name: get_attr_v5(con, nodeid, name))
+        t2 = self._time_lookups(
+            "current", index.get_node_path, index.list_children,
+            index.get_attr)
+        print("size: %.2fx smaller, lookups: %.2fx faster" %
+              (size_v5 / float(size), t1 / t2))
+
+        # scan all nodes with their attributes, as when loading a notebook
+        keys = [name for name, datatype, index_value in ATTRS]
+        t1 = self._time("v5 scan",
+                        lambda: list(list_node_skeletons_v5(con, keys)))
+        t2 = self._time("scan", lambda: list(index.list_node_skeletons(keys)))
+        print("scan: %.2fx faster" % (t1 / t2))
+
+        # attribute query joining two tables
+        created_time = 1300000000 + NNODES // 2
+        t1 = self._time("v5 query",
+                        lambda: query_v5(con, created_time, 50))
+        t2 = self._time("query", lambda: list(index.query(
+            {"created_time": (">", created_time)}, order_by="title",
+            limit=50)))
+        print("query: %.2fx faster" % (t1 / t2))
+
+        con.close()
+        index.close()
+
+
+if __name__ == "__main__":
+    test_main()
@@ -0,0 +1,102 @@
+"""
+
+    Benchmark for rebuilding the notebook index.
+
+    Compares the batched, multi-threaded NoteBookIndex.index_all() against
+    the previous serial walk, where every node indexed itself as it was read
+    and committed separately.
+
+      KEEPNOTE_BENCH_NODES=20000 python test/index_speed.py
+
+"""
+
+import os
+import sys
+import time
+import unittest
+
+# keepnote imports
+from keepnote import notebook
+from keepnote.notebook.connection.fs import index as notebook_index
+
+from test.testing import *
+
+
+_notebook_file = "test/tmp/index_speed"
+NNODES = int(os.environ.get("KEEPNOTE_BENCH_NODES", 2000))
+
+
+def make_notebook(filename, nnodes, fanout=20):
+    """Make a notebook with 'nnodes' pages of text"""
+    clean_dir(filename)
+    book = notebook.NoteBook()
+    book.create(filename)
+
+    text = "<p>the quick brown fox %d jumps over the lazy dog</p>\n" * 20
+    parents = [book]
+    n = 0
+    while n < nnodes:
+        parent = parents.pop(0)
+        for i in range(fanout):
+            page = notebook.new_page(parent, "page %d" % n)
+            out = page.open_file(notebook.PAGE_DATA_FILE, "w", "utf-8")
+            out.write(notebook.BLANK_NOTE.replace(
+                "<body></body>", "<body>%s</body>" % (text % ((n,) * 20))))
+            out.close()
+            parents.append(page)
+            n += 1
+            if n >= nnodes:
+                break
+    book.close()
+
+
+def serial_index_all(conn):
+    """The previous index_all(): walk the tree and let each node index itself"""
+    index = conn._index
+    queue = [conn.get_rootid()]
+    while len(queue) > 0:
+        nodeid = queue.pop()
+        yield nodeid
+        queue.extend(conn._list_children_nodeids(nodeid, _index=False))
+    index.set_index_needed(False)
+
+
+class IndexSpeed (unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        make_notebook(_notebook_file, NNODES)
+
+    def _time_reindex(self, name, reindex):
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        conn = book.get_connection()
+        conn.clear_index()
+        conn._path_cache.clear()
+        conn._path_cache.add(conn.get_rootid(), _notebook_file, None)
+
+        start = time.time()
+        n = 0
+        for nodeid in reindex(conn):
+            n += 1
+        t = time.time() - start
+
+        self.assertEqual(len(list(book.search_node_contents("fox"))), NNODES)
+        book.close()
+
+        print("%-10s %6d nodes  %8.3f seconds  %8.0f nodes/sec" %
+              (name, n, t, n / t))
+        return t
+
+    def test_reindex(self):
+        print()
+        t1 = self._time_reindex("serial", serial_index_all)
+        t2 = self._time_reindex(
+            "batched", lambda conn: conn._index.index_all())
+        t3 = self._time_reindex(
+            "batched-1", lambda conn: conn._index.index_all(nworkers=1))
+        print("speedup: %.2fx (1 thread: %.2fx)" % (t1 / t2, t1 / t3))
+
+
+if __name__ == "__main__":
+    test_main()
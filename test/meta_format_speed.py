@@ -0,0 +1,113 @@
+"""
+
+    Benchmark for the node meta data formats (node.xml and node.json).
+
+    Loads every node of a notebook, saves every node after a change, and
+    reports the bytes of meta data on disk, once with node.xml files and
+    once with node.json files.  Also times converting a notebook between
+    the formats with migrate_meta_format().
+
+      KEEPNOTE_BENCH_NODES=20000 python test/meta_format_speed.py
+
+"""
+
+import os
+import shutil
+import time
+import unittest
+
+# keepnote imports
+from keepnote import notebook
+from keepnote.notebook.connection import fs
+
+from test.testing import *
+from test.index_speed import make_notebook
+from test.save_speed import load_nodes
+
+
+_notebook_file = "test/tmp/meta_format_speed"
+NNODES = int(os.environ.get("KEEPNOTE_BENCH_NODES", 2000))
+
+
+def get_meta_size(path):
+    """Returns the number and total size of node meta data files"""
+    count = size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in fs.NODE_META_FILES.values():
+            if filename in filenames:
+                count += 1
+                size += os.stat(os.path.join(dirpath, filename)).st_size
+    return count, size
+
+
+def convert(filename, meta_format):
+    """
+    Convert a notebook to 'meta_format', returns the number of nodes
+    converted and the seconds taken
+    """
+    conn = fs.NoteBookConnectionFS()
+    conn.set_meta_format(meta_format)
+    conn.connect(filename)
+    start = time.time()
+    count = conn.migrate_meta_format()
+    t = time.time() - start
+    conn.close()
+    return count, t
+
+
+class MetaFormatSpeed (unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        make_notebook(_notebook_file + "_xml", NNODES)
+        if os.path.exists(_notebook_file + "_json"):
+            shutil.rmtree(_notebook_file + "_json")
+        shutil.copytree(_notebook_file + "_xml", _notebook_file + "_json")
+        cls.convert = convert(_notebook_file + "_json",
+                              fs.META_FORMAT_JSON)
+
+    def _open(self, meta_format):
+        conn = fs.NoteBookConnectionFS()
+        conn.set_meta_format(meta_format)
+        book = notebook.NoteBook()
+        book.load(_notebook_file + "_" + meta_format, conn)
+        return book
+
+    def _time_format(self, meta_format):
+        # first load indexes any nodes changed since they were indexed
+        book = self._open(meta_format)
+        load_nodes(book)
+        book.close()
+
+        # load
+        book = self._open(meta_format)
+        start = time.time()
+        nodes = load_nodes(book)
+        t1 = time.time() - start
+
+        # save
+        for node in nodes:
+            node.set_attr("icon", "icon.png")
+        start = time.time()
+        book.save()
+        t2 = time.time() - start
+        book.close()
+
+        count, size = get_meta_size(_notebook_file + "_" + meta_format)
+        self.assertEqual(count, len(nodes))
+        print("%-5s %6d nodes  load %7.3f s  save %7.3f s  %8.0f bytes/node"
+              % (meta_format, len(nodes), t1, t2, size / float(count)))
+        return t1, t2, size
+
+    def test_formats(self):
+        print()
+        load1, save1, size1 = self._time_format(fs.META_FORMAT_XML)
+        load2, save2, size2 = self._time_format(fs.META_FORMAT_JSON)
+        print("json: load %.2fx, save %.2fx, %.2fx smaller" %
+              (load1 / load2, save1 / save2, size1 / float(size2)))
+        print("converted %d nodes to json in %.3f seconds" %
+              self.convert)
+
+
+if __name__ == "__main__":
+    test_main()
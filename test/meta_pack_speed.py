@@ -0,0 +1,115 @@
+"""
+
+    Benchmark for keeping node meta data in a pack file.
+
+    Opens a notebook and loads every node, once with a node.xml file per
+    node and once with the meta data in __NOTEBOOK__/meta.pack.  Reports
+    the load time, the number of files opened while loading, and the
+    number of meta data files on disk.  Also times saving every node and
+    packing and unpacking the notebook.
+
+      KEEPNOTE_BENCH_NODES=20000 python test/meta_pack_speed.py
+
+"""
+
+import os
+import shutil
+import sys
+import time
+import unittest
+
+# keepnote imports
+from keepnote import notebook
+from keepnote.notebook.connection import fs
+
+from test.testing import *
+from test.index_speed import make_notebook
+from test.save_speed import load_nodes
+from test.meta_format_speed import convert, get_meta_size
+
+
+_notebook_file = "test/tmp/meta_pack_speed"
+NNODES = int(os.environ.get("KEEPNOTE_BENCH_NODES", 2000))
+
+
+# files opened while counting
+_opens = None
+
+
+def _audit(event, args):
+    if event == "open" and _opens is not None:
+        _opens.append(args[0])
+
+
+def count_opens(func):
+    """Returns the result of func() and the number of files it opened"""
+    global _opens
+    _opens = []
+    try:
+        result = func()
+        return result, len(_opens)
+    finally:
+        _opens = None
+
+
+class MetaPackSpeed (unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        sys.addaudithook(_audit)
+        make_notebook(_notebook_file + "_xml", NNODES)
+        if os.path.exists(_notebook_file + "_pack"):
+            shutil.rmtree(_notebook_file + "_pack")
+        shutil.copytree(_notebook_file + "_xml", _notebook_file + "_pack")
+        cls.pack = convert(_notebook_file + "_pack", fs.META_FORMAT_PACK)
+
+    def _open(self, meta_format):
+        conn = fs.NoteBookConnectionFS()
+        conn.set_meta_format(meta_format)
+        book = notebook.NoteBook()
+        book.load(_notebook_file + "_" + meta_format, conn)
+        return book
+
+    def _time_format(self, meta_format):
+        # first load indexes any nodes changed since they were indexed
+        book = self._open(meta_format)
+        load_nodes(book)
+        book.close()
+
+        # open and load
+        def load():
+            book = self._open(meta_format)
+            return book, load_nodes(book)
+        start = time.time()
+        (book, nodes), opens = count_opens(load)
+        t1 = time.time() - start
+
+        # save
+        for node in nodes:
+            node.set_attr("icon", "icon.png")
+        start = time.time()
+        book.save()
+        t2 = time.time() - start
+        book.close()
+
+        count, size = get_meta_size(_notebook_file + "_" + meta_format)
+        print("%-5s %6d nodes  load %7.3f s  %6d opens  save %7.3f s  "
+              "%6d meta files" % (meta_format, len(nodes), t1, opens, t2,
+                                  count))
+        return t1, t2, opens
+
+    def test_pack(self):
+        print()
+        load1, save1, opens1 = self._time_format(fs.META_FORMAT_XML)
+        load2, save2, opens2 = self._time_format(fs.META_FORMAT_PACK)
+        print("pack: load %.2fx, save %.2fx, %.1fx fewer opens" %
+              (load1 / load2, save1 / save2, opens1 / float(max(opens2, 1))))
+        print("packed %d nodes in %.3f seconds" % self.pack)
+        print("unpacked %d nodes in %.3f seconds" %
+              convert(_notebook_file + "_pack", fs.META_FORMAT_XML))
+        self.assertFalse(os.path.exists(os.path.join(
+            _notebook_file + "_pack", "__NOTEBOOK__", fs.META_PACK_FILE)))
+
+
+if __name__ == "__main__":
+    test_main()
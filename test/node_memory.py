@@ -0,0 +1,124 @@
+"""
+
+    Benchmark for the memory used per loaded node.
+
+    Reports the bytes allocated per node, as measured by tracemalloc, for
+    loading every node of a notebook and for the PathCache alone.  The
+    PathCache is also compared against the previous PathCacheNode, which
+    had a per-instance __dict__ and an empty children set for every node.
+    Record the numbers printed here to track memory across releases.
+
+      KEEPNOTE_BENCH_NODES=20000 python test/node_memory.py
+
+"""
+
+import gc
+import os
+import tracemalloc
+import unittest
+import uuid
+
+# keepnote imports
+from keepnote import notebook
+from keepnote.notebook.connection.fs import PathCache, PathCacheNode
+
+from test.testing import *
+from test.index_speed import make_notebook
+
+
+_notebook_file = "test/tmp/node_memory"
+NNODES = int(os.environ.get("KEEPNOTE_BENCH_NODES", 2000))
+NCACHE_NODES = 100000
+
+
+class DictPathCacheNode (object):
+    """The previous PathCacheNode"""
+
+    def __init__(self, nodeid, basename, parent):
+        self.nodeid = nodeid
+        self.basename = basename
+        self.parent = parent
+        self.children = set()
+        self.children_complete = False
+
+    def add_child(self, child):
+        self.children.add(child)
+
+
+def measure(func):
+    """Returns (result, bytes allocated) for calling func()"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        result = func()
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0] - start
+    finally:
+        tracemalloc.stop()
+    return result, size
+
+
+def fill_path_cache(records):
+    """Add a tree of (nodeid, basename, parentid) records to a PathCache"""
+    cache = PathCache()
+    for nodeid, basename, parentid in records:
+        cache.add(nodeid, basename, parentid)
+    return cache
+
+
+def walk(node, nodes):
+    """Load every node under 'node' along with its path"""
+    nodes.append(node)
+    node.get_path()
+    for child in node.get_children():
+        walk(child, nodes)
+    return nodes
+
+
+class NodeMemory (unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        make_notebook(_notebook_file, NNODES)
+
+    def _report(self, name, nnodes, size):
+        print("%-12s %8d nodes  %12d bytes  %8.0f bytes/node" %
+              (name, nnodes, size, size / float(nnodes)))
+        return size / float(nnodes)
+
+    def test_notebook(self):
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+
+        nodes, size = measure(lambda: walk(book, []))
+        print()
+        self._report("notebook", len(nodes), size)
+        book.close()
+
+    def test_path_cache(self):
+        records = [(str(uuid.uuid4()), "page %d" % i, None)
+                   for i in range(NCACHE_NODES)]
+        for i in range(1, len(records)):
+            records[i] = records[i][:2] + (records[(i - 1) // 20][0],)
+
+        # substitute the previous node class
+        import keepnote.notebook.connection.fs as connection_fs
+        connection_fs.PathCacheNode = DictPathCacheNode
+        try:
+            cache, size1 = measure(lambda: fill_path_cache(records))
+        finally:
+            connection_fs.PathCacheNode = PathCacheNode
+        del cache
+
+        cache, size2 = measure(lambda: fill_path_cache(records))
+        self.assertEqual(cache.get_path(records[-1][0]).count("/"), 4)
+
+        print()
+        s1 = self._report("previous", len(records), size1)
+        s2 = self._report("path cache", len(records), size2)
+        print("path cache: %.2fx smaller" % (s1 / s2))
+
+
+if __name__ == "__main__":
+    test_main()
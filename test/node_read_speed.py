@@ -0,0 +1,81 @@
+"""
+
+    Benchmark for reading node meta data files (node.xml).
+
+    Compares parsing every node.xml of a notebook with ElementTree and
+    plist.load_etree(), as the connection did before, against
+    nodexml.parse_node_meta().  The files are read into memory first, so
+    only the parsing is timed.
+
+      KEEPNOTE_BENCH_NODES=20000 python test/node_read_speed.py
+
+"""
+
+import os
+import time
+import unittest
+
+# keepnote imports
+from keepnote import plist
+from keepnote.notebook.connection import fs
+from keepnote.notebook.connection.fs import nodexml
+
+from test.testing import *
+from test.index_speed import make_notebook
+
+
+_notebook_file = "test/tmp/node_read_speed"
+NNODES = int(os.environ.get("KEEPNOTE_BENCH_NODES", 2000))
+
+
+def read_etree(data):
+    """The previous node.xml reader"""
+    attr = {}
+    version = None
+    for child in fs.ET.fromstring(data):
+        if child.tag == "dict":
+            attr = plist.load_etree(child)
+        if child.tag == "version":
+            version = int(child.text)
+    if version:
+        attr["version"] = version
+    return attr
+
+
+def load_files(path):
+    """Returns the contents of every node.xml under 'path'"""
+    files = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        if fs.NODE_META_FILE in filenames:
+            with open(os.path.join(dirpath, fs.NODE_META_FILE), "rb") as infile:
+                files.append(infile.read())
+    return files
+
+
+class NodeReadSpeed (unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        make_notebook(_notebook_file, NNODES)
+
+    def _time_read(self, name, read, files):
+        start = time.time()
+        attrs = [read(data) for data in files]
+        t = time.time() - start
+        print("%-10s %6d files  %8.3f seconds  %8.0f files/sec" %
+              (name, len(files), t, len(files) / t))
+        return attrs, t
+
+    def test_read(self):
+        files = load_files(_notebook_file)
+
+        print()
+        attrs1, t1 = self._time_read("etree", read_etree, files)
+        attrs2, t2 = self._time_read("nodexml", nodexml.parse_node_meta,
+                                     files)
+        self.assertEqual(attrs1, attrs2)
+        print("speedup: %.2fx" % (t1 / t2))
+
+
+if __name__ == "__main__":
+    test_main()
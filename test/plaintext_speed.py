@@ -0,0 +1,95 @@
+"""
+
+    Benchmark for extracting plain text from note pages.
+
+    Compares keepnote.notebook.plaintext against the previous line by line
+    extractor, on a corpus of large pages read from disk.
+
+      KEEPNOTE_BENCH_PAGES=200 python test/plaintext_speed.py
+
+"""
+
+import codecs
+import os
+import re
+import sys
+import time
+import unittest
+
+# keepnote imports
+from keepnote import notebook
+from keepnote.notebook import plaintext
+
+from test.testing import *
+
+
+_corpus_dir = "test/tmp/plaintext_speed"
+NPAGES = int(os.environ.get("KEEPNOTE_BENCH_PAGES", 50))
+
+
+TAG_PATTERN = re.compile("<[^>]*>")
+def strip_tags(line):
+    return re.sub(TAG_PATTERN, "", line)
+
+def legacy_read_data_as_plain_text(infile):
+    """The previous extractor: scan and strip tags line by line"""
+    for line in infile:
+        if "<body>" in line:
+            pos = line.find("<body>")
+            if pos != -1:
+                yield strip_tags(line[pos+6:])
+                break
+    for line in infile:
+        pos = line.find("</body>")
+        if pos != -1:
+            yield strip_tags(line[:pos])
+            break
+        yield strip_tags(line)
+
+
+def make_corpus(dirname, npages, nlines=5000):
+    """Write 'npages' pages of rich text of 'nlines' lines each"""
+    clean_dir(dirname)
+    os.makedirs(dirname)
+    line = ('<span style="font-weight: bold">the quick</span> brown '
+            '<a href="http://example.com/%d">fox</a> jumps over the '
+            '<i>lazy</i> dog &amp; cat<br/>\n')
+    filenames = []
+    for i in range(npages):
+        filename = os.path.join(dirname, "page%d.html" % i)
+        out = codecs.open(filename, "w", "utf-8")
+        out.write(notebook.BLANK_NOTE.replace("<body></body>",
+            "<body>%s</body>" % "".join(line % j for j in range(nlines))))
+        out.close()
+        filenames.append(filename)
+    return filenames
+
+
+class PlainTextSpeed (unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls._filenames = make_corpus(_corpus_dir, NPAGES)
+
+    def _time_extract(self, name, extract):
+        start = time.time()
+        nchars = 0
+        for filename in self._filenames:
+            infile = codecs.open(filename, "r", "utf-8")
+            nchars += len("".join(extract(infile)))
+            infile.close()
+        t = time.time() - start
+
+        print("%-10s %6d pages  %8.3f seconds  %8.1f MB/sec" %
+              (name, len(self._filenames), t, nchars / t / 1e6))
+        return t
+
+    def test_extract(self):
+        print()
+        t1 = self._time_extract("legacy", legacy_read_data_as_plain_text)
+        t2 = self._time_extract("streaming", plaintext.iter_plain_text)
+        print("speedup: %.2fx" % (t1 / t2))
+
+
+if __name__ == "__main__":
+    test_main()
@@ -0,0 +1,108 @@
+"""
+
+    Benchmark for saving many modified nodes.
+
+    Compares NoteBook.save(), which writes the node files of all dirty
+    nodes with a pool of threads and indexes them in one transaction,
+    against saving each node on its own, as after a bulk reorder or import.
+    Also reports how long save() blocks when the files are written in the
+    background, and how long saving unchanged nodes takes once their
+    files were written.
+
+      KEEPNOTE_BENCH_NODES=20000 python test/save_speed.py
+
+"""
+
+import os
+import time
+import unittest
+
+# keepnote imports
+from keepnote import notebook
+
+from test.testing import *
+from test.index_speed import make_notebook
+
+
+_notebook_file = "test/tmp/save_speed"
+NNODES = int(os.environ.get("KEEPNOTE_BENCH_NODES", 2000))
+
+
+def load_nodes(book):
+    """Returns all nodes of a notebook"""
+    nodes = []
+    queue = [book]
+    while queue:
+        node = queue.pop()
+        nodes.append(node)
+        queue.extend(node.get_children())
+    return nodes
+
+
+class SaveSpeed (unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        make_notebook(_notebook_file, NNODES)
+
+    def _time_save(self, name, save, background=False):
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        conn = book.get_connection()
+        conn.enable_background_save(background)
+        nodes = load_nodes(book)
+        for node in nodes:
+            node.set_attr("icon", name)
+
+        start = time.time()
+        save(book, nodes)
+        t = time.time() - start
+        conn._wait_save()
+        t2 = time.time() - start
+
+        book.close()
+        print("%-10s %6d nodes  %8.3f seconds  %8.0f nodes/sec  "
+              "(%.3f seconds until written)" %
+              (name, len(nodes), t, len(nodes) / t, t2))
+        return t
+
+    def test_save(self):
+        def per_node(book, nodes):
+            for node in nodes:
+                node.save()
+            book.save()
+
+        def batch(book, nodes):
+            book.save()
+
+        print()
+        t1 = self._time_save("per-node", per_node)
+        t2 = self._time_save("batch", batch)
+        t3 = self._time_save("background", batch, background=True)
+        print("speedup: %.2fx (blocking: %.2fx)" % (t1 / t2, t1 / t3))
+
+    def test_save_unchanged(self):
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        conn = book.get_connection()
+        nodes = load_nodes(book)
+
+        # nodes marked dirty without changes, as by reordering
+        times = []
+        for i in range(2):
+            conn.reset_write_stats()
+            for node in nodes:
+                node.mark_modified()
+            start = time.time()
+            book.save()
+            times.append(time.time() - start)
+            stats = conn.get_write_stats()
+            print("%-10s %6d nodes  %8.3f seconds  %6d written  %6d skipped"
+                  % ("unchanged", len(nodes), times[-1], stats["written"],
+                     stats["skipped"]))
+        book.close()
+        print("speedup: %.2fx" % (times[0] / times[1]))
+
+
+if __name__ == "__main__":
+    test_main()
@@ -1,11 +1,18 @@
 
 # python imports
 import os
+import random
+import time
+import unittest
 
 # keepnote imports
 from keepnote.notebook import NOTEBOOK_FORMAT_VERSION
 import keepnote.notebook.connection as connlib
 from keepnote.notebook.connection import fs
+from keepnote.notebook.connection.fs import nodexml
+from keepnote.notebook.connection.fs import pack as meta_pack
+from keepnote.notebook.connection.fs import watch
+from keepnote import plist
 
 from .test_notebook_conn import TestConnBase
 from . import clean_dir
@@ -197,3 +204,457 @@ class TestConnFS (TestConnBase):
 
         # Clean up.
         conn.close()
+
+    def test_meta_format(self):
+        """Read and convert node meta data files of either format."""
+        notebook_file = _tmpdir + '/notebook_meta_format'
+        clean_dir(notebook_file)
+
+        def meta_files(path):
+            return sorted(name for name in os.listdir(path)
+                          if name in fs.NODE_META_FILES.values())
+
+        # Write a few nodes as node.xml.
+        conn = fs.NoteBookConnectionFS()
+        conn.connect(notebook_file)
+        conn.create_node('root', {'nodeid': 'root', 'parentids': [],
+                                  'version': NOTEBOOK_FORMAT_VERSION})
+        attrs = {}
+        for i in range(5):
+            nodeid = 'n%d' % i
+            attrs[nodeid] = {
+                'nodeid': nodeid, 'parentids': ['root'],
+                'version': NOTEBOOK_FORMAT_VERSION,
+                'title': u'page \u00e9 & <%d>' % i,
+                'key1': i, 'key2': 2.5, 'key3': True, 'key4': None}
+            conn.create_node(nodeid, attrs[nodeid])
+        conn.close()
+
+        # Nodes are read in either format, and written in the new one.
+        conn = fs.NoteBookConnectionFS()
+        conn.set_meta_format(fs.META_FORMAT_JSON)
+        conn.connect(notebook_file)
+        for nodeid, attr in attrs.items():
+            self.assertEqual(conn.read_node(nodeid), attr)
+        conn.update_node('n0', attrs['n0'])
+        path = conn.get_node_path('n0')
+        self.assertEqual(meta_files(path), ['node.json'])
+        self.assertEqual(conn.read_node('n0'), attrs['n0'])
+        self.assertEqual(sorted(conn.read_node('root')['childrenids']),
+                         sorted(attrs))
+
+        # Convert the other nodes.
+        self.assertEqual(conn.migrate_meta_format(), 5)
+        self.assertEqual(conn.migrate_meta_format(), 0)
+        for nodeid, attr in attrs.items():
+            path = conn.get_node_path(nodeid)
+            self.assertEqual(meta_files(path), ['node.json'])
+            self.assertEqual(conn.read_node(nodeid), attr)
+        self.assertEqual(list(conn.list_dir('n1')), [])
+        self.assertRaises(connlib.ConnectionError,
+                          lambda: conn.set_meta_format('yaml'))
+        conn.close()
+
+        # Convert back in the background.
+        conn = fs.NoteBookConnectionFS()
+        conn.enable_background_migrate(True)
+        conn.connect(notebook_file)
+        conn._wait_migrate()
+        for nodeid, attr in attrs.items():
+            path = conn.get_node_path(nodeid)
+            self.assertEqual(meta_files(path), ['node.xml'])
+            self.assertEqual(conn._index.get_node_mtime(nodeid),
+                             os.stat(path).st_mtime)
+            self.assertEqual(conn.read_node(nodeid), attr)
+        conn.close()
+
+    def test_meta_pack(self):
+        """Store node meta data in a pack file and unpack it again."""
+        notebook_file = _tmpdir + '/notebook_meta_pack'
+        clean_dir(notebook_file)
+
+        def meta_files(path):
+            return sorted(os.path.relpath(os.path.join(dirpath, name), path)
+                          for dirpath, dirnames, filenames in os.walk(path)
+                          for name in filenames
+                          if name in fs.NODE_META_FILES.values())
+
+        def check(conn):
+            for nodeid, attr in attrs.items():
+                attr2 = conn.read_node(nodeid)
+                del attr2['childrenids']
+                self.assertEqual(attr2, attr)
+
+        # Write a tree of nodes as node.xml.
+        conn = fs.NoteBookConnectionFS()
+        conn.connect(notebook_file)
+        conn.create_node('root', {'nodeid': 'root', 'parentids': [],
+                                  'version': NOTEBOOK_FORMAT_VERSION})
+        attrs = {}
+        for i in range(6):
+            nodeid = 'n%d' % i
+            attrs[nodeid] = {
+                'nodeid': nodeid, 'parentids': ['n%d' % (i // 2)] if i
+                else ['root'],
+                'version': NOTEBOOK_FORMAT_VERSION,
+                'title': u'page \u00e9 %d' % i, 'key1': i}
+            conn.create_node(nodeid, attrs[nodeid])
+            del attrs[nodeid]['childrenids']
+        conn.close()
+
+        # Pack them.
+        conn = fs.NoteBookConnectionFS()
+        conn.set_meta_format(fs.META_FORMAT_PACK)
+        conn.connect(notebook_file)
+        self.assertEqual(conn.migrate_meta_format(), 7)
+        self.assertEqual(meta_files(notebook_file), [])
+        check(conn)
+
+        # Move a node with children, then delete one.
+        attrs['n2']['parentids'] = ['root']
+        conn.update_node('n2', attrs['n2'])
+        self.assertEqual(os.path.dirname(conn.get_node_path('n5')),
+                         conn.get_node_path('n2'))
+        conn.delete_node('n4')
+        del attrs['n4']
+
+        # A failed rename leaves the node and its pack entries in place.
+        path = conn.get_node_path('n1')
+        move = conn._pack.move
+        def move2(old_key, new_key):
+            conn._pack.move = move
+            raise IOError('disk full')
+        conn._pack.move = move2
+        attrs['n1']['title'] = u'renamed'
+        attrs['n1']['parentids'] = ['n2']
+        self.assertRaises(fs.ConnectionError,
+                          lambda: conn.update_node('n1', attrs['n1']))
+        attrs['n1']['title'] = u'page \u00e9 1'
+        attrs['n1']['parentids'] = ['n0']
+        self.assertEqual(conn.get_node_path('n1'), path)
+        self.assertTrue(os.path.isdir(path))
+
+        rename = os.rename
+        def rename2(src, dst):
+            raise OSError('permission denied')
+        os.rename = rename2
+        try:
+            attrs['n1']['parentids'] = ['n2']
+            self.assertRaises(fs.ConnectionError,
+                              lambda: conn.update_node('n1', attrs['n1']))
+            attrs['n1']['parentids'] = ['n0']
+        finally:
+            os.rename = rename
+        self.assertEqual(conn.get_node_path('n1'), path)
+        check(conn)
+
+        # A crash between moving the entries and renaming the directory
+        # is undone on the next open.
+        conn._pack.move(conn._get_pack_key(path),
+                        conn._get_pack_key(path + ' moved'))
+        conn.close()
+        conn = fs.NoteBookConnectionFS()
+        conn.set_meta_format(fs.META_FORMAT_PACK)
+        conn.connect(notebook_file)
+        check(conn)
+        conn.close()
+
+        # A directory moved outside of KeepNote is matched to its entries
+        # through the index.
+        moved_path = os.path.join(notebook_file, os.path.basename(path))
+        os.rename(path, moved_path)
+        conn = fs.NoteBookConnectionFS()
+        conn.set_meta_format(fs.META_FORMAT_PACK)
+        conn.connect(notebook_file)
+        self.assertTrue('n1' in conn.read_node('root')['childrenids'])
+        self.assertEqual(conn.get_node_path('n1'), moved_path)
+        self.assertEqual(conn.read_node('n1')['key1'], 1)
+        conn.close()
+        os.rename(moved_path, path)
+        conn = fs.NoteBookConnectionFS()
+        conn.set_meta_format(fs.META_FORMAT_PACK)
+        conn.connect(notebook_file)
+        self.assertTrue('n1' in conn.read_node('n0')['childrenids'])
+        check(conn)
+        conn.close()
+
+        # Read them back, with and without the pack index.
+        for i in range(2):
+            conn = fs.NoteBookConnectionFS()
+            conn.set_meta_format(fs.META_FORMAT_PACK)
+            conn.connect(notebook_file)
+            self.assertEqual(sorted(conn.read_node('n2')['childrenids']),
+                             ['n5'])
+            check(conn)
+            conn.close()
+            os.remove(os.path.join(notebook_file, '__NOTEBOOK__',
+                                   'meta.pack.idx'))
+
+        # Unpack them, the pack is removed once empty.
+        conn = fs.NoteBookConnectionFS()
+        conn.enable_background_migrate(True)
+        conn.connect(notebook_file)
+        conn._wait_migrate()
+        conn.close()
+        self.assertEqual(len(meta_files(notebook_file)), 6)
+        self.assertFalse(os.path.exists(
+            os.path.join(notebook_file, '__NOTEBOOK__', 'meta.pack')))
+        conn.connect(notebook_file)
+        check(conn)
+        conn.close()
+
+    @unittest.skipUnless(watch.is_available(), "inotify not available")
+    def test_fs_watch(self):
+        """Only check nodes for unmanaged changes after they change."""
+        notebook_file = _tmpdir + '/notebook_watch'
+        clean_dir(notebook_file)
+
+        conn = fs.NoteBookConnectionFS()
+        conn.enable_watch(True)
+        conn.connect(notebook_file)
+        conn.create_node('root', {'nodeid': 'root', 'parentids': []})
+        conn.create_node('child', {'nodeid': 'child', 'parentids': ['root'],
+                                   'title': 'Child'})
+        conn.close()
+
+        # Reopen with watching enabled.
+        conn.connect(notebook_file)
+        watcher = conn._watcher
+        self.assertTrue(watcher is not None)
+        path = conn.get_node_path('child')
+
+        def is_dirty():
+            return os.path.normpath(path) not in watcher._clean
+
+        # Wait for watches to be installed.
+        for i in range(50):
+            if not watcher.check_dirty(path):
+                break
+            time.sleep(.01)
+        self.assertFalse(is_dirty())
+
+        # Reads of an unchanged node do not stat it.
+        conn.read_node('child')
+        self.assertFalse(is_dirty())
+
+        # An unmanaged edit marks the node dirty.
+        os.utime(fs.get_node_meta_file(path), None)
+        for i in range(50):
+            if is_dirty():
+                break
+            time.sleep(.01)
+        self.assertTrue(is_dirty())
+        conn.read_node('child')
+        self.assertFalse(is_dirty())
+
+        # After a queue overflow, every node is checked once more.
+        watcher._process_event(-1, watch.IN_Q_OVERFLOW, '')
+        self.assertFalse(watcher._overflow)
+        self.assertTrue(watcher.check_dirty(path))
+        self.assertFalse(watcher.check_dirty(path))
+
+        conn.close()
+        self.assertTrue(conn._watcher is None)
+
+
+def read_node_meta_etree(data):
+    """Reference reader: ElementTree and plist.load_etree()"""
+    attr = {}
+    version = None
+    for child in fs.ET.fromstring(data):
+        if child.tag == "dict":
+            attr = plist.load_etree(child)
+        if child.tag == "version":
+            version = int(child.text)
+    if version:
+        attr["version"] = version
+    return attr
+
+
+class TestNodeXML (unittest.TestCase):
+
+    _text = [u"", u" ", u"a", u"page", u"&", u"<", u">", u'"', u"'",
+             u"&amp;", u"&#38;", u"]]>", u"\t", u"\n", u"\r\n", u" x ",
+             u"\u00e9", u"\u4e2d\u6587", u"\U0001f600"]
+
+    _mutations = [
+        ("<dict>", "<dict>\r\n"),
+        ("<dict>", "<dict><!-- comment -->"),
+        ("<string>", "<string><![CDATA[<&>]]>"),
+        ("<string>", "<string>&#65;"),
+        ("<string>", "<string> \r "),
+        ("<key>", "<key>&lt;"),
+        ("<key>", "<key>&#x41;"),
+        ("<dict>", "<dict><key>a</key><array><integer>1</integer></array>"),
+        ("<dict>", "<dict><key>d</key><dict><key>x</key><true/></dict>"),
+        ("<dict>", "<dict><key>i</key><integer></integer>"),
+        ("<dict>", "<dict><key>i</key><integer> 7 </integer>"),
+        ("<dict>", "<dict><key>r</key><real>-inf</real>"),
+        ("<dict>", "<dict><key>s</key><string/>"),
+        ("<dict>", "<dict><key>s</key><true>x</true>"),
+        ("<dict>", "<dict><key></key><null/>"),
+        ("<dict>", "<dict><key>k</key><null/><key>k</key><false/>"),
+        ("<version>6", "<version> 6 "),
+        ("<version>6", "<version>0"),
+        ("<node>", '<node id="1">'),
+        ("</node>", "</node><!-- end -->"),
+        ('encoding="UTF-8"', 'encoding="utf-8"'),
+        ('<?xml version="1.0" encoding="UTF-8"?>\n', ""),
+        ("</dict>", "</dict"),
+        ("</string>", "</strin>"),
+    ]
+
+    def _random_text(self, rand):
+        return u"".join(rand.choice(self._text)
+                        for i in range(rand.randint(0, 4)))
+
+    def _random_value(self, rand):
+        kind = rand.randint(0, 5)
+        if kind == 0:
+            return self._random_text(rand)
+        elif kind == 1:
+            return rand.randint(-2**40, 2**40)
+        elif kind == 2:
+            return rand.uniform(-1e6, 1e6)
+        elif kind == 3:
+            return True
+        elif kind == 4:
+            return False
+        else:
+            return None
+
+    def _assert_same(self, data):
+        try:
+            expected = read_node_meta_etree(data)
+        except Exception:
+            expected = None
+        try:
+            attr = nodexml.parse_node_meta(data)
+        except Exception:
+            self.fail("fast reader raised on %r" % data)
+
+        if attr is not None:
+            self.assertEqual(attr, expected, data)
+            self.assertEqual(list(attr.keys()), list(expected.keys()))
+            self.assertEqual(type(attr), type(expected))
+
+    def test_fuzz(self):
+        """The fast node.xml reader agrees with ElementTree"""
+        conn = fs.NoteBookConnectionFS()
+        rand = random.Random(0)
+        nfast = 0
+
+        for i in range(2000):
+            attr = {"nodeid": "n%d" % i,
+                    "version": rand.choice([NOTEBOOK_FORMAT_VERSION, 1])}
+            for j in range(rand.randint(0, 8)):
+                key = "key%d" % rand.randint(0, 10)
+                if rand.random() < .3:
+                    key += self._random_text(rand)
+                attr[key] = self._random_value(rand)
+            data = conn._format_attr(attr).encode("utf-8")
+
+            self._assert_same(data)
+            if nodexml.parse_node_meta(data) is not None:
+                nfast += 1
+
+            for old, new in rand.sample(self._mutations, 3):
+                self._assert_same(data.replace(old.encode("utf-8"),
+                                               new.encode("utf-8"), 1))
+
+        # the files written by keepnote itself take the fast path
+        self.assertTrue(nfast > 1000)
+
+    def test_read(self):
+        """Read files in the shape written by NoteBookConnectionFS"""
+        data = (
+            b'<?xml version="1.0" encoding="UTF-8"?>\n'
+            b'<node>\n'
+            b'<version>6</version>\n'
+            b'<dict>\n'
+            b'  <key>nodeid</key><string>a &amp; b</string>\n'
+            b'  <key>order</key><integer>1024</integer>\n'
+            b'  <key>expanded</key><true/>\n'
+            b'  <key>icon</key><null/>\n'
+            b'</dict>\n'
+            b'</node>\n')
+        attr = nodexml.parse_node_meta(data)
+        self.assertEqual(list(attr.items()),
+                         [("nodeid", "a & b"), ("order", 1024),
+                          ("expanded", True), ("icon", None),
+                          ("version", 6)])
+
+        # nested values use the full parser
+        data = data.replace(b"<null/>", b"<array></array>")
+        self.assertTrue(nodexml.parse_node_meta(data) is None)
+        self.assertEqual(read_node_meta_etree(data)["icon"], [])
+
+
+class TestMetaPack (unittest.TestCase):
+
+    def setUp(self):
+        clean_dir(_tmpdir + '/meta_pack')
+        os.makedirs(_tmpdir + '/meta_pack')
+        self.filename = _tmpdir + '/meta_pack/meta.pack'
+
+    def _reopen(self, pack):
+        pack.close()
+        pack = meta_pack.MetaPack(self.filename)
+        pack.open()
+        return pack
+
+    def test_pack(self):
+        """Entries survive reopening, with or without the index."""
+        pack = meta_pack.MetaPack(self.filename)
+        pack.open()
+        written, added = pack.put([('', b'root'), ('a', b'1'),
+                                   ('a/b', b'2'), ('a/b/c', b'3'),
+                                   ('ab', b'4')])
+        self.assertEqual((written, added), (5, ['', 'a', 'a/b', 'a/b/c',
+                                                'ab']))
+
+        # Unchanged entries are not written again.
+        self.assertEqual(pack.put([('a', b'1'), ('ab', b'5')]), (1, []))
+        self.assertFalse(pack.add('a', b'x'))
+
+        self.assertTrue(pack.move('a/b', 'x'))
+        self.assertFalse(pack.move('a/b', 'z'))
+        pack.remove('ab')
+        pack.remove_tree('x/c')
+        expected = {'': b'root', 'a': b'1', 'x': b'2'}
+
+        for use_index in (True, False):
+            pack = self._reopen(pack)
+            if not use_index:
+                os.remove(self.filename + '.idx')
+                pack = self._reopen(pack)
+            self.assertEqual(sorted(pack.keys()), sorted(expected))
+            self.assertEqual(pack.get_last_move(), ('a/b', 'x'))
+            for key, data in expected.items():
+                self.assertEqual(pack.get(key), data)
+
+        # Records appended after the index was saved are replayed, and a
+        # torn record at the end is cut off.
+        pack.close()
+        pack.open()
+        pack.put([('y', b'6')])
+        size = os.path.getsize(self.filename)
+        pack._file.write(b'\x01\x00\x00')
+        pack._file.close()
+        pack._file = None
+        pack = meta_pack.MetaPack(self.filename)
+        pack.open()
+        self.assertEqual(pack.get('y'), b'6')
+        self.assertEqual(os.path.getsize(self.filename), size)
+
+        # Repacking keeps only the live entries.
+        expected['y'] = b'6'
+        stats = pack.get_stats()
+        self.assertTrue(stats['garbage'] > 0)
+        pack.repack()
+        self.assertEqual(pack.get_stats()['garbage'], 0)
+        self.assertTrue(pack.get_stats()['size'] < stats['size'])
+        pack = self._reopen(pack)
+        for key, data in expected.items():
+            self.assertEqual(pack.get(key), data)
+        pack.close()
@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import os
+import shutil
 import unittest
-from StringIO import StringIO
+from io import StringIO
 import sqlite3 as sqlite
 import sys
 import threading
@@ -11,6 +12,9 @@ import traceback
 
 # keepnote imports
 from keepnote import notebook
+from keepnote.notebook.connection import ConnectionError
+from keepnote.notebook.connection.index import NodeIndex
+from keepnote.notebook.connection.fs import index as index_module
 
 from . import clean_dir, TMP_DIR
 
@@ -95,6 +99,44 @@ class Index (unittest.TestCase):
         self.assertEqual(list(notebook.read_data_as_plain_text(infile)),
                          expected)
 
+        # entities, scripts and styles, text after </body>
+        infile = StringIO(
+            '<html><head><title>x</title></head>'
+            '<body class="a">fish &amp; chips&nbsp;&lt;b&gt;\n'
+            '<script type="text/javascript">var x = "<b>";</script>'
+            '<style>b {}</style>one<br/>two</body>after</html>')
+        expected = [u'fish & chips\xa0<b>\n', 'one\n', 'two']
+        self.assertEqual(list(notebook.read_data_as_plain_text(infile)),
+                         expected)
+
+    def test_plain_text_blocks(self):
+        """Tags and entities may be split between blocks."""
+        from keepnote.notebook.plaintext import iter_plain_text
+
+        text = ('<html><body>\n' +
+                'some <b>bold</b> &amp; <i>italic</i> text<br/>\n' * 50 +
+                '<script>if (a < b) {}</script>end</body></html>')
+        expected = list(iter_plain_text(StringIO(text)))
+        self.assertEqual(expected[1], 'some bold & italic text\n')
+        self.assertEqual(expected[-1], 'end')
+        for block_size in (1, 2, 3, 7, 64):
+            self.assertEqual(
+                list(iter_plain_text(StringIO(text), block_size)), expected)
+
+        # break tags end a line, even when followed by whitespace, and
+        # runs of them give one newline
+        text = ('<html><body>one<br/> two</p>\n<p>three<br/><br/>\n'
+                '  four</td> <td>five</body></html>')
+        expected = ['one\n', 'two\n', 'three\n', 'four\n', 'five']
+        for block_size in (1, 2, 3, 7, 64):
+            self.assertEqual(
+                list(iter_plain_text(StringIO(text), block_size)), expected)
+
+        # blank page
+        self.assertEqual(
+            list(notebook.read_data_as_plain_text(
+                StringIO(notebook.BLANK_NOTE))), [''])
+
     def test_node_url(self):
         """Node URL API."""
         self.assertTrue(notebook.is_node_url(
@@ -121,6 +163,279 @@ class Index (unittest.TestCase):
 
         node = book.get_node_by_id(self._pagex_nodeid)
         self.assertEqual(node.get_title(), 'Page X')
+
+        # Only the nodes along the path are read.
+        pageb = node.get_parent()
+        page1 = pageb.get_parent()
+        self.assertEqual(pageb.get_title(), 'Page B')
+        self.assertTrue(page1._children is None)
+        self.assertTrue(book.get_node_by_id(self._pagex_nodeid) is node)
+
+        # Reading the siblings later reuses the same nodes.
+        self.assertTrue(page1.get_children()[1] is pageb)
+        self.assertTrue(pageb.get_children()[0] is node)
+        self.assertEqual(book.get_node_by_id('unknown'), None)
+        book.close()
+
+    def test_get_node_paths(self):
+        """Resolve many node paths in one query."""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+
+        path = book.get_node_path_by_id(self._pagex_nodeid)
+        self.assertEqual(path[0], book.get_attr('nodeid'))
+        self.assertEqual(path[-1], self._pagex_nodeid)
+        self.assertEqual(len(path), 4)
+
+        paths = book.get_node_paths_by_id(path + ['unknown'])
+        self.assertEqual(paths['unknown'], None)
+        for i, nodeid in enumerate(path):
+            self.assertEqual(paths[nodeid], path[:i+1])
+
+        book.close()
+
+    def test_get_nodes_by_ids(self):
+        """Get many Nodes by their nodeids."""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+
+        path = book.get_node_path_by_id(self._pagex_nodeid)
+        nodes = book.get_nodes_by_ids(
+            [self._pagex_nodeid, 'unknown', path[1], self._pagex_nodeid])
+        self.assertEqual(nodes[0].get_title(), 'Page X')
+        self.assertEqual(nodes[1], None)
+        self.assertTrue(nodes[2] is nodes[0].get_parent().get_parent())
+        self.assertTrue(nodes[3] is nodes[0])
+        self.assertTrue(nodes[2]._children is None)
+
+        self.assertTrue(book.get_node_by_id(self._pagex_nodeid) is nodes[0])
+        self.assertEqual(book.get_nodes_by_ids([]), [])
+        book.close()
+
+    def test_query_nodes(self):
+        """Query nodes by indexed attributes."""
+        from keepnote.notebook.connection import QueryError
+
+        notebook_file = os.path.join(TMP_DIR, "notebook_query")
+        clean_dir(notebook_file)
+        book = notebook.NoteBook()
+        book.create(notebook_file)
+        for title in ['Page 1', 'Page 2', 'Page 3']:
+            page = notebook.new_page(book, title)
+        for title in ['Page A', 'Page B', 'Page C']:
+            notebook.new_page(page, title)
+        book.new_child(notebook.CONTENT_TYPE_DIR, 'Folder')
+
+        def titles(*args, **kwargs):
+            return [book._conn.get_attr_by_id(nodeid, 'title') for nodeid in
+                    book.query_nodes(*args, **kwargs)]
+
+        pages = {'content_type': notebook.CONTENT_TYPE_PAGE}
+        self.assertEqual(titles(pages, order_by='title', limit=3),
+                         ['Page 1', 'Page 2', 'Page 3'])
+        self.assertEqual(titles(pages, order_by='-title', limit=2),
+                         ['Page C', 'Page B'])
+        self.assertEqual(
+            titles({'content_type': notebook.CONTENT_TYPE_PAGE,
+                    'title': ['in', ['Page A', 'Page B', 'Folder']]},
+                   order_by='title'),
+            ['Page A', 'Page B'])
+        self.assertEqual(
+            titles({'title': ['like', 'page _'],
+                    'order': ['>', notebook.ORDER_GAP]},
+                   order_by='title'),
+            ['Page 2', 'Page 3', 'Page B', 'Page C'])
+
+        # The same query through the connection's index() interface.
+        self.assertEqual(
+            len(list(book._conn.index(['query', pages, 'title', 4]))), 4)
+
+        self.assertRaises(QueryError, list, book.query_nodes({'unknown': 1}))
+        self.assertRaises(QueryError, list,
+                          book.query_nodes({'title': ['~', 'x']}))
+        book.close()
+
+    def test_index_attr_defs(self):
+        """Index attrs defined as indexable, filling new tables."""
+        notebook_file = os.path.join(TMP_DIR, "notebook_attr_defs")
+        clean_dir(notebook_file)
+        book = notebook.NoteBook()
+        book.create(notebook_file)
+        for i in range(5):
+            page = notebook.new_page(book, 'Page %d' % i)
+            page.set_attr('priority', i)
+            page.set_attr('icon', 'note.png')
+        book.close()
+
+        # Drop an index table, as if the index predates the attr's indexing.
+        con = sqlite.connect(os.path.join(
+            notebook_file, notebook.NOTEBOOK_META_DIR, 'index.sqlite'))
+        con.execute('DROP TABLE Attr_icon')
+        con.commit()
+        con.close()
+
+        def titles(*args, **kwargs):
+            return [book._conn.get_attr_by_id(nodeid, 'title') for nodeid in
+                    book.query_nodes(*args, **kwargs)]
+
+        book = notebook.NoteBook()
+        book.load(notebook_file)
+        book.add_attr_def(notebook.AttrDef(
+            'priority', 'integer', 'Priority', index_value=True))
+        self.assertTrue(book.index(['wait_backfill', 10]))
+        self.assertEqual(book.index(['backfill_pending']), [])
+
+        self.assertEqual(titles({'priority': ['>=', 3]}, order_by='-priority'),
+                         ['Page 4', 'Page 3'])
+        self.assertEqual(len(titles({'icon': 'note.png'})), 5)
+        book.close()
+
+        # The attr def is saved, and stays indexed.
+        book = notebook.NoteBook()
+        book.load(notebook_file)
+        self.assertTrue(book.attr_defs.get('priority').index_value)
+        self.assertEqual(book.index(['backfill_pending']), [])
+        self.assertEqual(titles({'priority': 2}), ['Page 2'])
+        book.close()
+
+    def test_load_from_index(self):
+        """Load the notebook tree from the index."""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        book.pref.set("load_from_index", True)
+        book.set_preferences_dirty()
+        book.close()
+
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        self.assertTrue(book._skeletons)
+
+        page1 = [child for child in book.get_children()
+                 if child.get_title() == 'Page 1'][0]
+        pageb = page1.get_children()[1]
+        self.assertEqual(pageb.get_title(), 'Page B')
+        self.assertTrue(pageb._skeleton is not None)
+
+        # Indexed attrs come from the index, others are read from disk
+        # when needed.
+        self.assertEqual(pageb.get_attr('icon'), None)
+        self.assertTrue(pageb._skeleton is not None)
+        self.assertTrue(pageb.get_attr('created_time') is not None)
+        self.assertTrue(pageb._skeleton is None)
+
+        # Changes to skeleton nodes are saved with their full attrs.
+        pagea, pagec = page1.get_children()[0], page1.get_children()[2]
+        created_time = pagec.get_attr('created_time')
+        pagec.move(page1, 0)
+        book.save()
+        pagec.move(page1, 3)
+        book.pref.set("load_from_index", False)
+        book.set_preferences_dirty()
+        book.close()
+
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        self.assertFalse(book._skeletons)
+        page1 = [child for child in book.get_children()
+                 if child.get_title() == 'Page 1'][0]
+        self.assertEqual([child.get_title() for child in page1.get_children()],
+                         ['Page A', 'Page B', 'Page C'])
+        self.assertEqual(page1.get_children()[2].get_attr('created_time'),
+                         created_time)
+        book.close()
+
+    def test_move_skeletons(self):
+        """Move nodes loaded from the index to another notebook."""
+        src_file = os.path.join(TMP_DIR, "notebook_move_src")
+        dst_file = os.path.join(TMP_DIR, "notebook_move_dst")
+        clean_dir(src_file)
+        clean_dir(dst_file)
+
+        book = notebook.NoteBook()
+        book.create(src_file)
+        folder = notebook.new_page(book, 'Folder')
+        page = notebook.new_page(folder, 'Page')
+        page.set_attr('info_sort', 'title')
+        attrs = dict((node.get_attr('nodeid'), dict(node.iter_attr()))
+                     for node in (folder, page))
+        book.pref.set("load_from_index", True)
+        book.set_preferences_dirty()
+        book.close()
+
+        book2 = notebook.NoteBook()
+        book2.create(dst_file)
+        book = notebook.NoteBook()
+        book.load(src_file)
+        folder = book.get_children()[0]
+        self.assertTrue(folder._skeleton is not None)
+        folder.move(book2)
+        book.close()
+        book2.close()
+
+        book2 = notebook.NoteBook()
+        book2.load(dst_file)
+        conn = book2.get_connection()
+        for nodeid, attr in attrs.items():
+            attr2 = conn.read_node(nodeid)
+            for key in ('title', 'created_time', 'modified_time',
+                        'info_sort', 'content_type'):
+                self.assertEqual(attr2.get(key), attr.get(key))
+        book2.close()
+
+    def test_meta_format_pref(self):
+        """An unknown meta_format preference is ignored."""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        book.pref.set("meta_format", "jsn")
+        book.set_preferences_dirty()
+        book.close()
+
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        conn = book.get_connection()
+        self.assertEqual(conn.get_meta_format(), 'xml')
+        self.assertFalse(conn._use_background_migrate)
+        book.pref.set("meta_format", "")
+        book.set_preferences_dirty()
+        book.close()
+
+    def test_skeleton_tree(self):
+        """Walk the notebook tree from skeleton nodes without reading them."""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        book.pref.set("load_from_index", True)
+        book.set_preferences_dirty()
+        book.close()
+
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        conn = book.get_connection()
+        read_node = conn.read_node
+        reads = []
+        def read_node2(nodeid):
+            reads.append(nodeid)
+            return read_node(nodeid)
+        conn.read_node = read_node2
+
+        # Expand the whole tree, reading the skeleton attrs.
+        def walk(node):
+            for key in ('title', 'content_type', 'order', 'icon'):
+                node.get_attr(key)
+            for child in node.get_children():
+                walk(child)
+        walk(book)
+        self.assertEqual(reads, [])
+
+        # Other attrs are read from disk.
+        page1 = [child for child in book.get_children()
+                 if child.get_title() == 'Page 1'][0]
+        self.assertTrue(page1._skeleton is not None)
+        page1.get_attr('expanded')
+        self.assertTrue(page1._skeleton is None)
+        self.assertEqual(reads, [page1.get_attr('nodeid')])
+
+        book.pref.set("load_from_index", False)
+        book.set_preferences_dirty()
         book.close()
 
     def test_notebook_search_titles(self):
@@ -137,13 +452,114 @@ class Index (unittest.TestCase):
 
         book.close()
 
+    def test_search_titles_ranked(self):
+        """Title matches are ranked exact, prefix, then substring."""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        pages = [notebook.new_page(book, title) for title in
+                 (u'Zoo animals', u'zoo', u'The zoo', u'Zoology 100%')]
+
+        results = book.search_node_titles('ZOO')
+        self.assertEqual([title for nodeid, title in results],
+                         [u'zoo', u'Zoo animals', u'Zoology 100%',
+                          u'The zoo'])
+        self.assertEqual(len(book.search_node_titles('zoo', limit=2)), 2)
+        self.assertEqual(len(book.search_node_titles('zo')), 4)
+        self.assertEqual([title for nodeid, title in
+                          book.search_node_titles('0%')],
+                         [u'Zoology 100%'])
+
+        # Renamed and deleted nodes.
+        pages[0].rename(u'Zebra')
+        self.assertEqual(len(book.search_node_titles('zoo')), 3)
+        for page in pages:
+            page.delete()
+        self.assertEqual(book.search_node_titles('zoo'), [])
+        book.close()
+
     def test_index_all(self):
         """Reindex all nodes in notebook."""
         book = notebook.NoteBook()
         book.load(_notebook_file)
 
         for node in book.index_all():
-            print node
+            print(node)
+
+        book.close()
+
+    def test_index_all_copied_node(self):
+        """Reindex a notebook holding a copied node directory."""
+        notebook_file = os.path.join(TMP_DIR, "notebook_copied")
+        clean_dir(notebook_file)
+        book = notebook.NoteBook()
+        book.create(notebook_file)
+        page = notebook.new_page(book, 'Page A')
+        write_content(page, 'hello copied world')
+        path = page.get_path()
+        book.close()
+        shutil.copytree(path, path + ' copy')
+
+        book = notebook.NoteBook()
+        book.load(notebook_file)
+        conn = book.get_connection()
+        for batch_size in (1000, 1):
+            nodeids = list(conn._index.index_all(batch_size=batch_size))
+            self.assertEqual(nodeids.count(page.get_attr('nodeid')), 2)
+            self.assertEqual(len(list(book.search_node_contents('copied'))),
+                             1)
+        book.close()
+
+    def test_index_all_aborted(self):
+        """An unfinished reindex is redone when the notebook is reopened."""
+        notebook_file = os.path.join(TMP_DIR, "notebook_aborted")
+        clean_dir(notebook_file)
+        book = notebook.NoteBook()
+        book.create(notebook_file)
+        for i in range(10):
+            notebook.new_page(book, 'Page %d' % i)
+        book.close()
+
+        book = notebook.NoteBook()
+        book.load(notebook_file)
+        nodes = book.get_connection()._index.index_all(batch_size=2)
+        for i in range(5):
+            next(nodes)
+        nodes.close()
+        self.assertTrue(book.index_needed())
+        book.close()
+
+        book = notebook.NoteBook()
+        book.load(notebook_file)
+        self.assertTrue(book.index_needed())
+        list(book.get_connection()._index.index_all())
+        self.assertFalse(book.index_needed())
+        book.close()
+
+        book = notebook.NoteBook()
+        book.load(notebook_file)
+        self.assertFalse(book.index_needed())
+        titles = [node.get_title() for node in book.get_children()]
+        self.assertEqual(titles[:10], ['Page %d' % i for i in range(10)])
+        book.close()
+
+    def test_index_all_batched(self):
+        """Reindex in small batches with several reader threads."""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        conn = book.get_connection()
+
+        nodeids = list(conn._index.index_all(nworkers=3, batch_size=2))
+        self.assertEqual(len(nodeids), len(set(nodeids)))
+        self.assertTrue(self._pagex_nodeid in nodeids)
+        self.assertFalse(book.index_needed())
+
+        # Index is fully usable after reindexing.
+        self.assertEqual(len(list(book.search_node_contents('world'))), 2)
+        results = book.search_node_titles("Page X")
+        self.assertTrue(self._pagex_nodeid in
+                        (nodeid for nodeid, title in results))
+        node = book.get_node_by_id(self._pagex_nodeid)
+        self.assertEqual(node.get_title(), 'Page X')
 
         book.close()
 
@@ -171,6 +587,313 @@ class Index (unittest.TestCase):
 
         book.close()
 
+    def test_fulltext_ranked(self):
+        """Ranked full-text search with snippets and paging."""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+
+        results = book.search_node_contents_ranked('world')
+        self.assertEqual(len(results), 2)
+        nodeid, score, snippet = results[0]
+        self.assertTrue('<b>world</b>' in snippet)
+
+        # Paging.
+        page1 = book.search_node_contents_ranked('world', limit=1)
+        page2 = book.search_node_contents_ranked('world', limit=1, offset=1)
+        self.assertEqual(page1 + page2, results)
+
+        # Prefix search.
+        self.assertEqual(book.search_node_contents_ranked('wor'), [])
+        self.assertEqual(
+            len(book.search_node_contents_ranked('wor', prefix=True)), 2)
+
+        text = book.highlight_node_contents(nodeid, 'world')
+        self.assertTrue('<b>world</b>' in text)
+
+        # Disabled fulltext search is reported as unavailable, so that
+        # searches page through the unranked results instead.
+        self.assertTrue(book.has_fulltext_search())
+        book.enable_fulltext_search(False)
+        self.assertFalse(book.has_fulltext_search())
+        self.assertEqual(len([nodeid for nodeid in
+                              book.search_node_contents('world')
+                              if nodeid]), 2)
+        book.enable_fulltext_search(True)
+        self.assertTrue(book.has_fulltext_search())
+
+        book.close()
+
+    def test_fulltext_unchanged(self):
+        """Skip reindexing text of unchanged pages."""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        index = book.get_connection()._index
+        page1 = [child for child in book.get_children()
+                 if child.get_title() == 'Page 1'][0]
+        pagec = page1.get_children()[2]
+
+        # Reordering does not reindex the page text.
+        index.reset_fulltext_stats()
+        pagec.move(page1, 0)
+        pagec.move(page1, 3)
+        book.save()
+        stats = book.index(["fulltext_stats"])
+        self.assertEqual(stats['reindexed'], 0)
+        self.assertTrue(stats['skipped'] > 0)
+
+        # Changed text and titles are reindexed.
+        write_content(pagec, 'brand new world, again')
+        self.assertEqual(index.get_fulltext_stats()['reindexed'], 1)
+        pagec.rename('Page C2')
+        pagec.save(True)
+        self.assertEqual(index.get_fulltext_stats()['reindexed'], 2)
+        self.assertEqual(
+            len(book.search_node_contents_ranked('again')), 1)
+        self.assertEqual(
+            len(book.search_node_contents_ranked('C2')), 1)
+
+        write_content(pagec, 'brand new world')
+        pagec.rename('Page C')
+        book.close()
+
+    def test_background_fulltext(self):
+        """Index page texts in a background thread."""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        book.get_connection().enable_background_fulltext(True)
+
+        page = notebook.new_page(book, 'Background')
+        write_content(page, 'queued zebra text')
+        self.assertEqual(len(book.search_node_contents_ranked('zebra')), 1)
+        self.assertTrue(book.is_fulltext_current())
+
+        # Removed nodes are not indexed.
+        write_content(page, 'queued zebra text again')
+        page.delete()
+        self.assertEqual(list(book.search_node_contents('zebra')), [])
+
+        # Queued texts are indexed before closing.
+        page = notebook.new_page(book, 'Background 2')
+        write_content(page, 'queued giraffe text')
+        nodeid = page.get_attr('nodeid')
+        book.close()
+
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        self.assertEqual(list(book.search_node_contents('giraffe')), [nodeid])
+        page = book.get_node_by_id(nodeid)
+        filename = page.get_file(notebook.PAGE_DATA_FILE)
+        index = book.get_connection()._index
+        book.close()
+
+        # Batches for a closed or reset index are dropped.
+        from keepnote.notebook.connection.fs.index import FulltextIndexer
+        FulltextIndexer(index)._index_batch([(nodeid, 'Background 2',
+                                              filename)])
+        index.open()
+        read_page_text = index_module.read_page_text
+        def read_page_text2(filename):
+            index.close()
+            index.open()
+            return read_page_text(filename)
+        index_module.read_page_text = read_page_text2
+        try:
+            index.reset_fulltext_stats()
+            FulltextIndexer(index)._index_batch([(nodeid, 'Background 3',
+                                                  filename)])
+        finally:
+            index_module.read_page_text = read_page_text
+        self.assertEqual(index.get_fulltext_stats()['reindexed'], 0)
+        index.close()
+
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        book.get_node_by_id(nodeid).delete()
+        book.close()
+
+    def test_save_nodes(self):
+        """Save dirty nodes in one batch."""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        conn = book.get_connection()
+        page1 = [child for child in book.get_children()
+                 if child.get_title() == 'Page 1'][0]
+        pages = page1.get_children()
+
+        for page in pages:
+            page.set_attr('icon', 'star.png')
+        book.save()
+        self.assertEqual(book._dirty, set())
+        for page in pages:
+            path = page.get_path()
+            self.assertEqual(sorted(name for name in os.listdir(path)
+                                    if name.startswith('node.xml')),
+                             ['node.xml'])
+            self.assertTrue(conn._node_index_current(
+                page.get_attr('nodeid'), path)[0])
+            self.assertEqual(conn._index.get_attr(
+                page.get_attr('nodeid'), 'icon'), 'star.png')
+
+        # Background saves write a copy of the attrs.
+        conn.enable_background_save(True)
+        pages[0].set_attr('icon', 'note.png')
+        book.save()
+        pages[0].set_attr('icon', 'star.png')
+        self.assertEqual(
+            conn.read_node(pages[0].get_attr('nodeid'))['icon'], 'note.png')
+        self.assertTrue(conn._save_thread is None)
+
+        # A failed background save marks its nodes dirty again, without
+        # failing the next call that waits for it.
+        write_nodes = conn._write_nodes
+        def write_nodes2(batch):
+            conn._write_nodes = write_nodes
+            raise ConnectionError('disk full')
+        conn._write_nodes = write_nodes2
+        book.save()
+        self.assertFalse(pages[0] in book._dirty)
+        self.assertEqual(
+            conn.read_node(pages[0].get_attr('nodeid'))['icon'], 'note.png')
+        self.assertTrue(pages[0] in book._dirty)
+        book.save()
+        self.assertFalse(pages[0] in book._dirty)
+        self.assertEqual(
+            conn.read_node(pages[0].get_attr('nodeid'))['icon'], 'star.png')
+        conn.enable_background_save(False)
+        book.close()
+
+    def test_save_nodes_partial(self):
+        """Index the nodes of a batch written before a failure."""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        conn = book.get_connection()
+        page1 = [child for child in book.get_children()
+                 if child.get_title() == 'Page 1'][0]
+        pages = page1.get_children()[:2]
+        nodeids = [page.get_attr('nodeid') for page in pages]
+        failed_file = os.path.join(pages[1].get_path(), 'node.xml')
+
+        replace = os.replace
+        def replace2(src, dst):
+            if dst == failed_file:
+                raise OSError('disk full')
+            return replace(src, dst)
+        os.replace = replace2
+        failed = []
+        try:
+            for page in pages:
+                page.set_attr('icon', 'partial.png')
+            conn.reset_write_stats()
+            self.assertRaises(ConnectionError, conn.update_nodes,
+                              [(nodeid, page._attr) 
+                               for nodeid, page in zip(nodeids, pages)])
+            self.assertEqual(conn.get_write_stats(),
+                             {'written': 1, 'skipped': 0})
+            self.assertEqual(conn._index.get_attr(nodeids[0], 'icon'),
+                             'partial.png')
+            self.assertNotEqual(conn._index.get_attr(nodeids[1], 'icon'),
+                                'partial.png')
+
+            # Background saves report the failed nodes only.
+            conn.enable_background_save(True)
+            for page in pages:
+                page.set_attr('icon', 'partial2.png')
+            conn.update_nodes([(nodeid, page._attr) 
+                               for nodeid, page in zip(nodeids, pages)],
+                              on_error=failed.extend)
+            conn.read_node(nodeids[0])
+        finally:
+            os.replace = replace
+            conn.enable_background_save(False)
+        self.assertEqual(failed, nodeids[1:])
+        self.assertEqual(conn._index.get_attr(nodeids[0], 'icon'),
+                         'partial2.png')
+        self.assertEqual(conn.read_node(nodeids[0])['icon'], 'partial2.png')
+        book.close()
+
+    def test_write_unchanged(self):
+        """Skip writing node files that would not change."""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        conn = book.get_connection()
+        page1 = [child for child in book.get_children()
+                 if child.get_title() == 'Page 1'][0]
+        pages = page1.get_children()
+        conn.reset_write_stats()
+
+        pages[0].save(True)
+        pages[0].save(True)
+        self.assertEqual(conn.get_write_stats(),
+                         {'written': 1, 'skipped': 1})
+
+        # Batches skip unchanged nodes too.
+        for page in pages:
+            page.mark_modified()
+        book.save()
+        for page in pages:
+            page.mark_modified()
+        book.save()
+        self.assertEqual(conn.get_write_stats(),
+                         {'written': len(pages), 
+                          'skipped': len(pages) + 2})
+
+        # Changed attrs and files changed by others are written.
+        pages[0].set_attr('icon', 'note.png')
+        pages[0].save()
+        filename = os.path.join(pages[1].get_path(), 'node.xml')
+        mtime = os.stat(filename).st_mtime
+        os.utime(filename, (mtime + 1, mtime + 1))
+        pages[1].save(True)
+        self.assertEqual(conn.get_write_stats()['written'], len(pages) + 2)
+        book.close()
+
+    def test_fulltext_fts3(self):
+        """Keep using an existing fts3 fulltext table."""
+        con = sqlite.connect(":memory:")
+        cur = con.cursor()
+        cur.execute("""CREATE VIRTUAL TABLE fulltext USING
+                       fts3(content TEXT, tokenize=porter);""")
+        index = NodeIndex(None)
+        index.init_attrs(cur)
+        self.assertEqual(index.get_fulltext_engine(), 'fts3')
+
+        index._insert_text(cur, index.add_node_key(cur, 'a'), 'hello world')
+        index._insert_text(cur, index.add_node_key(cur, 'b'),
+                           'brand new world')
+        self.assertEqual(sorted(index.search_node_contents(cur, 'world')),
+                         ['a', 'b'])
+        results = index.search_node_contents_ranked(
+            cur, 'worl', limit=1, prefix=True)
+        self.assertEqual(len(results), 1)
+        self.assertTrue('<b>world</b>' in results[0][2])
+
+    def test_add_nodes_attr(self):
+        """Index the attrs of many nodes at once."""
+        from keepnote.notebook.connection.index import AttrIndex
+
+        con = sqlite.connect(":memory:")
+        cur = con.cursor()
+        index = NodeIndex(None)
+        index.add_attr(AttrIndex('title', 'TEXT', index_value=True))
+        index.add_attr(AttrIndex('order', 'INTEGER'))
+        index.init_attrs(cur)
+
+        index.add_nodes_attr(cur, [('a', {'title': 'Page A', 'order': 2}),
+                                   ('b', {'title': 'Page B'}),
+                                   ('c', {'order': 0})], fulltext=False)
+        self.assertEqual(index.get_node_attr(cur, 'a', 'order'), 2)
+        self.assertEqual(index.get_node_attr(cur, 'b', 'order'), None)
+        self.assertEqual(index.search_node_titles(cur, 'page'),
+                         [('a', 'Page A'), ('b', 'Page B')])
+
+        # Rows are replaced, and removed in bulk.
+        index.add_nodes_attr(cur, [('a', {'title': 'Page Z'})],
+                             fulltext=False)
+        index.remove_nodes_attr(cur, ['b', 'c'])
+        self.assertEqual(index.search_node_titles(cur, 'page'),
+                         [('a', 'Page Z')])
+        self.assertEqual(index.get_node_attr(cur, 'c', 'order'), None)
+
     def test_notebook_threads(self):
         """Access a notebook in another thread"""
         test = self
@@ -198,13 +921,13 @@ class Index (unittest.TestCase):
         test = self
         error = [False]
 
-        print
+        print()
         book = notebook.NoteBook()
         book.load(_notebook_file)
 
         def process(book, name):
             for i in range(100):
-                print i, name
+                print(i, name)
                 results = list(book.search_node_contents('world'))
                 test.assertTrue(len(results) == 2)
                 time.sleep(.001)
@@ -213,7 +936,7 @@ class Index (unittest.TestCase):
             def run(self):
                 try:
                     process(book, 'B')
-                except Exception, e:
+                except Exception as e:
                     error[0] = True
                     traceback.print_exception(type(e), e, sys.exc_info()[2])
                     raise e
@@ -227,6 +950,121 @@ class Index (unittest.TestCase):
 
         self.assertFalse(error[0])
 
+    def test_notebook_threads_write(self):
+        """Search in another thread while the index is written"""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        index = book.get_connection()._index
+        self.assertEqual(
+            index.con.execute('PRAGMA journal_mode;').fetchone()[0], 'wal')
+
+        # Searches do not wait for, or see, an uncommitted write.
+        results = []
+        with index._write_lock:
+            index.add_node_attr(index.cur, 'uncommitted',
+                                {'title': 'Page Uncommitted'},
+                                fulltext=False)
+            task = threading.Thread(target=lambda: results.append(
+                (book.search_node_titles('Uncommitted'),
+                 len(list(book.search_node_contents('world'))))))
+            task.start()
+            task.join(5)
+            self.assertEqual(results, [([], 2)])
+
+            index.con.commit()
+            self.assertEqual(book.search_node_titles('Uncommitted'),
+                             [('uncommitted', 'Page Uncommitted')])
+            index.remove_node_attr(index.cur, 'uncommitted')
+            index.con.commit()
+
+        # Node lookups from another thread wait for the writer rather than
+        # share its cursor.
+        results = []
+        nodeid = self._pagex_nodeid
+        with index._write_lock:
+            task = threading.Thread(target=lambda: results.append(
+                (index.has_node(nodeid),
+                 index.get_node_paths([nodeid])[nodeid][-1],
+                 len(index.list_children(nodeid)))))
+            task.start()
+            task.join(0.2)
+            self.assertEqual(results, [])
+        task.join(5)
+        self.assertEqual(results, [(True, nodeid, 0)])
+
+        # Idle read connections are reused.
+        self.assertTrue(len(index._read_cons) <= 2)
+        book.close()
+        self.assertEqual(index._read_cons, [])
+
+    def test_path_cache_snapshot(self):
+        """Reuse the path cache of the last session."""
+        from keepnote.notebook.connection.fs import \
+            NOTEBOOK_META_DIR, PATH_CACHE_FILE
+
+        snapshot_file = os.path.join(_notebook_file, NOTEBOOK_META_DIR,
+                                     PATH_CACHE_FILE)
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        path = book.get_node_by_id(self._pagex_nodeid).get_path()
+        book.close()
+        self.assertTrue(os.path.exists(snapshot_file))
+
+        # The snapshot is read on the first path cache miss.
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        self.assertFalse(os.path.exists(snapshot_file))
+        conn = book.get_connection()
+        self.assertTrue(conn._path_cache._snapshot is not None)
+        self.assertFalse(self._pagex_nodeid in conn._path_cache._nodes)
+        self.assertEqual(conn._path_cache.get_path(self._pagex_nodeid), path)
+        self.assertTrue(conn._path_cache._snapshot is None)
+        self.assertEqual(book.get_node_by_id(self._pagex_nodeid).get_path(),
+                         path)
+        book.close()
+
+        # The snapshot is ignored if the notebook changed since.
+        mtime = os.stat(_notebook_file).st_mtime
+        os.utime(_notebook_file, (mtime + 1, mtime + 1))
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        self.assertFalse(os.path.exists(snapshot_file))
+        conn = book.get_connection()
+        self.assertTrue(conn._path_cache._snapshot is None)
+        self.assertEqual(book.get_node_by_id(self._pagex_nodeid).get_path(),
+                         path)
+        book.close()
+
+    def test_path_cache_snapshot_changed_dir(self):
+        """Do not reuse the cached children of a changed directory."""
+        notebook_file = os.path.join(TMP_DIR, "notebook_path_cache")
+        clean_dir(notebook_file)
+        book = notebook.NoteBook()
+        book.create(notebook_file)
+        folder = notebook.new_page(book, 'Folder')
+        folderid = folder.get_attr('nodeid')
+        page1 = notebook.new_page(folder, 'Page 1')
+        page2 = notebook.new_page(folder, 'Page 2')
+        pageid = page2.get_attr('nodeid')
+        path = page2.get_path()
+        book.close()
+
+        book = notebook.NoteBook()
+        book.load(notebook_file)
+        conn = book.get_connection()
+        self.assertEqual(len(list(conn._list_children_nodeids(folderid))),
+                         2)
+        book.close()
+        shutil.rmtree(path)
+
+        book = notebook.NoteBook()
+        book.load(notebook_file)
+        conn = book.get_connection()
+        self.assertEqual(list(conn._list_children_nodeids(folderid)),
+                         [page1.get_attr('nodeid')])
+        self.assertFalse(conn._path_cache.has_node(pageid))
+        book.close()
+
     def _test_concurrent(self):
         """Open a notebook twice."""
         book1 = notebook.NoteBook()
@@ -235,8 +1073,8 @@ class Index (unittest.TestCase):
         book2 = notebook.NoteBook()
         book2.load(_notebook_file)
 
-        print list(book1.iter_attr())
-        print list(book2.iter_attr())
+        print(list(book1.iter_attr()))
+        print(list(book2.iter_attr()))
 
         book1.close()
         book2.close()
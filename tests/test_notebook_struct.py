@@ -16,8 +16,8 @@ _datapath = os.path.join(TMP_DIR, 'notebook_struct')
 
 
 def display_notebook(node, depth=0):
-    print "  " * depth,
-    print node.get_title()
+    print("  " * depth, end=' ')
+    print(node.get_title())
 
     for child in node.get_children():
         display_notebook(child, depth+1)
@@ -41,7 +41,7 @@ class Test (unittest.TestCase):
         # initialize a notebook
         make_clean_dir(_datapath)
 
-        print "creating notebook"
+        print("creating notebook")
         book = notebook.NoteBook()
         book.create(_datapath + "/n1")
         make_notebook(book, struct)
@@ -51,7 +51,7 @@ class Test (unittest.TestCase):
 
         book.close()
 
-        print "load"
+        print("load")
         book = notebook.NoteBook()
         book.load(_datapath + "/n1")
 
@@ -62,6 +62,106 @@ class Test (unittest.TestCase):
         display_notebook(book)
         book.close()
 
+    def test_order(self):
+
+        # initialize a notebook
+        make_clean_dir(_datapath)
+        book = notebook.NoteBook()
+        book.create(_datapath + "/n1")
+        folder = notebook.new_page(book, "folder")
+        for i in range(10):
+            notebook.new_page(folder, str(i))
+        book.close()
+
+        def titles(node):
+            return [child.get_title() for child in node.get_children()]
+
+        # Moving a page only changes the moved page.
+        book = notebook.NoteBook()
+        book.load(_datapath + "/n1")
+        folder = book.get_children()[0]
+        children = folder.get_children()
+        orders = [child.get_attr("order") for child in children]
+        self.assertEqual(orders, sorted(set(orders)))
+
+        children[8].move(folder, 2)
+        notebook.new_page(folder, "new", 3)
+        self.assertEqual(book._dirty, set())
+        self.assertEqual(titles(folder),
+                         ["0", "1", "8", "new", "2", "3", "4", "5", "6",
+                          "7", "9"])
+        self.assertEqual([child.get_position()
+                          for child in folder.get_children()], list(range(11)))
+        for i, child in enumerate(folder.get_children()):
+            if child.get_title() not in ("8", "new"):
+                self.assertEqual(child.get_attr("order"),
+                                 orders[int(child.get_title())])
+
+        # Inserting until the gap runs out renumbers the siblings.
+        for i in range(notebook.ORDER_GAP.bit_length() + 1):
+            notebook.new_page(folder, "x%d" % i, 1)
+        self.assertTrue(len(book._dirty) > 0)
+        orders = [child.get_attr("order") for child in folder.get_children()]
+        self.assertEqual(orders, sorted(set(orders)))
+        expected = titles(folder)
+        book.close()
+
+        book = notebook.NoteBook()
+        book.load(_datapath + "/n1")
+        folder = book.get_children()[0]
+        self.assertEqual(titles(folder), expected)
+
+        # Integer orders from earlier versions are kept until an insert
+        # finds no gap.
+        for i, child in enumerate(folder.get_children()):
+            child.set_attr("order", i)
+        book.close()
+
+        book = notebook.NoteBook()
+        book.load(_datapath + "/n1")
+        folder = book.get_children()[0]
+        before = titles(folder)
+        self.assertEqual(book._dirty, set())
+        notebook.new_page(folder, "end")
+        self.assertEqual(book._dirty, set())
+        notebook.new_page(folder, "middle", 1)
+        self.assertEqual(titles(folder), before[:1] + ["middle"] +
+                         before[1:] + ["end"])
+        book.close()
+
+    def test_move_by_id(self):
+        """Move and delete nodes whose siblings are not loaded yet."""
+
+        make_clean_dir(_datapath)
+        book = notebook.NoteBook()
+        book.create(_datapath + "/n1")
+        folder = notebook.new_page(book, "folder")
+        nodeids = [notebook.new_page(folder, str(i)).get_attr("nodeid")
+                   for i in range(5)]
+        book.close()
+
+        def titles(node):
+            return [child.get_title() for child in node.get_children()]
+
+        book = notebook.NoteBook()
+        book.load(_datapath + "/n1")
+        node = book.get_node_by_id(nodeids[3])
+        node.move(node.get_parent(), 2)
+        self.assertEqual(titles(node.get_parent()),
+                         ["0", "1", "3", "2", "4"])
+        book.close()
+
+        book = notebook.NoteBook()
+        book.load(_datapath + "/n1")
+        node = book.get_node_by_id(nodeids[4])
+        folder = node.get_parent()
+        events = []
+        book.node_changed.add(lambda actions: events.extend(actions))
+        node.delete()
+        self.assertEqual(events, [("removed", folder, 4)])
+        self.assertEqual(titles(folder), ["0", "1", "3", "2"])
+        book.close()
+
     def test_rename(self):
 
         struct = [["a", ["a1"], ["a2"], ["a3"]],
@@ -71,7 +171,7 @@ class Test (unittest.TestCase):
         # initialize a notebook
         make_clean_dir(_datapath)
 
-        print "creating notebook"
+        print("creating notebook")
         book = notebook.NoteBook()
         book.create(_datapath + "/n1")
         make_notebook(book, struct)
@@ -81,7 +181,7 @@ class Test (unittest.TestCase):
 
         book.close()
 
-        print "load"
+        print("load")
         book = notebook.NoteBook()
         book.load(_datapath + "/n1")
         display_notebook(book)
@@ -96,7 +196,7 @@ class Test (unittest.TestCase):
         # initialize a notebook
         make_clean_dir(_datapath)
 
-        print "creating notebook"
+        print("creating notebook")
         book = notebook.NoteBook()
         book.create(_datapath + "/n1")
         make_notebook(book, struct)
@@ -106,12 +206,12 @@ class Test (unittest.TestCase):
 
         book.close()
 
-        print "load"
+        print("load")
         book = notebook.NoteBook()
         book.load(_datapath + "/n1")
 
         c1 = book.get_node_by_id(c1id)
-        print "found", c1.get_title()
+        print("found", c1.get_title())
 
         book.close()
 
@@ -136,7 +236,7 @@ class Test (unittest.TestCase):
         conn.create_node(nodeid, {"nodeid": nodeid,
                                   "aaa": 3.4})
         attr = conn.read_node(nodeid)
-        print attr
+        print(attr)
 
         # check orphan node dir
         assert os.path.exists(
@@ -147,16 +247,16 @@ class Test (unittest.TestCase):
         attr["aaa"] = 0
         conn.update_node(nodeid, attr)
         attr = conn.read_node(nodeid)
-        print attr
+        print(attr)
 
         # check orphan node dir
-        print open(_datapath + "/conn/__NOTEBOOK__/orphans/%s/%s/node.xml"
-                   % (nodeid[:2], nodeid[2:])).read()
+        print(open(_datapath + "/conn/__NOTEBOOK__/orphans/%s/%s/node.xml"
+                   % (nodeid[:2], nodeid[2:])).read())
 
         # move orphan out of orphandir
         attr["parentids"] = [rootid]
         conn.update_node(nodeid, attr)
-        print conn.read_node(nodeid)
+        print(conn.read_node(nodeid))
 
         # check orphan node dir is gone
         assert not os.path.exists(
@@ -166,7 +266,7 @@ class Test (unittest.TestCase):
         # move node into orphandir
         attr["parentids"] = []
         conn.update_node(nodeid, attr)
-        print conn.read_node(nodeid)
+        print(conn.read_node(nodeid))
 
         # check orphan node dir is gone
         self.assertTrue(os.path.exists(